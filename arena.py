@@ -0,0 +1,425 @@
+# PyCParser - arena storage
+# code under BSD 2-Clause License
+
+# Stores the C objects of a parsed State in columns, where the objects refer to each other
+# by integer node IDs instead of Python references.
+# There is one array.array column each for the class, the parent link, the type, the body,
+# the name and the definition position, and one tuple per object for all the other fields
+# (where a reference to another object is a NodeId).
+# So there are no reference cycles (e.g. via the parent links) and almost no objects
+# which the garbage collector has to track. An Arena can be copied and pickled cheaply,
+# it is freed by reference counting, and e.g. the depth or the name of an object
+# is just a lookup in the columns.
+#
+# Arena.toState() gives you the usual object API on top of it, in the same way as a snapshot
+# (see snapshot.py): the dicts (funcs, typedefs, ...) and the contentlist of the State are lazy,
+# and a C object is only created when it is accessed, together with all the objects it refers to.
+
+import sys
+import array
+if sys.version_info.major == 2:
+    import cparser
+    import caching
+    import snapshot
+    from cparser_utils import *
+else:
+    from . import cparser
+    from . import caching
+    from . import snapshot
+    from .cparser_utils import *
+
+# Special values in the columns. Otherwise, it is a node ID, or a string index for the name and defPos.
+_None, _Unset, _StateRef, _Extra = -1, -2, -3, -4
+
+RefColumns = ("parent", "type", "body")
+StrColumns = ("name", "defPos")
+
+_AtomicTypes = set([type(None), bool, int, long, float, str, unicode, bytes])
+_StrTypes = (str, unicode)
+_StateTypes = (cparser.State, caching.StateWrapper)
+
+
+class ArenaError(Exception): pass
+
+
+class NodeId(int):
+    """
+    Reference to an object in the arena, in the extra fields.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "NodeId(%i)" % self
+
+    def __reduce__(self):
+        return NodeId, (int(self),)
+
+
+_objClassCache = {}
+
+def _isObjClass(cls):
+    """
+    Whether we store instances of this class as objects in the arena.
+    That are all classes from the cparser module (like snapshot._SnapshotWriter._isObjClass).
+    """
+    r = _objClassCache.get(cls)
+    if r is None:
+        r = cls.__module__ == cparser.__name__ and getattr(cparser, cls.__name__, None) is cls
+        _objClassCache[cls] = r
+    return r
+
+
+_slotsCache = {}
+
+def _getFields(obj):
+    """
+    :return: all fields which are set, from the __dict__ and the __slots__
+    :rtype: list[(str,object)]
+    """
+    cls = obj.__class__
+    slots = _slotsCache.get(cls)
+    if slots is None:
+        slots = _slotsCache[cls] = cparser._getSlotNames(cls) if isinstance(cls, type) else []
+    fields = list(getattr(obj, "__dict__", {}).items())
+    for name in slots:
+        # The cached hash of an interned type is only valid in this process.
+        if name != "_hash" and hasattr(obj, name):
+            fields.append((name, getattr(obj, name)))
+    return fields
+
+
+class Arena(object):
+    def __init__(self):
+        self.classes = []  # class index -> class
+        self.strings = []  # string index -> str
+        self.clsIdxs = array.array("l")  # node ID -> class index
+        self.parents = array.array("l")  # node ID -> node ID of the parent
+        self.types = array.array("l")  # node ID -> node ID of the type
+        self.bodies = array.array("l")  # node ID -> node ID of the body
+        self.names = array.array("l")  # node ID -> string index of the name
+        self.defPos = array.array("l")  # node ID -> string index of the defPos
+        self.extras = []  # node ID -> tuple (field name, encoded value, field name, encoded value, ...)
+        self.roots = {}  # State attrib -> encoded value (node IDs for the dicts and the contentlist)
+        self._state = None  # the State which we loaded into. see toState
+        self._objs = None  # node ID -> object or None. see getObj
+        self._pending = []
+        self._filling = False
+        self._children = None  # see getChildren
+
+    @classmethod
+    def fromState(cls, state):
+        """
+        :param cparser.State state:
+        :rtype: Arena
+        """
+        arena = cls()
+        _ArenaWriter(arena, state).write()
+        return arena
+
+    def __len__(self):
+        return len(self.clsIdxs)
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in (
+            "classes", "strings", "clsIdxs", "parents", "types", "bodies", "names", "defPos", "extras", "roots")])
+
+    def __setstate__(self, d):
+        self.__init__()
+        for k, v in d.items():
+            setattr(self, k, v)
+
+    def copy(self):
+        """
+        :return: a new Arena with the same objects, which is not bound to a State yet
+        :rtype: Arena
+        """
+        # The columns are never modified after fromState, so we can share them.
+        arena = Arena()
+        arena.__setstate__(self.__getstate__())
+        return arena
+
+    def getClass(self, idx):
+        return self.classes[self.clsIdxs[idx]]
+
+    def getName(self, idx):
+        """
+        :rtype: str|None
+        """
+        s = self.names[idx]
+        if s < 0: return None
+        return self.strings[s]
+
+    def getDefPos(self, idx):
+        """
+        :rtype: str|None
+        """
+        s = self.defPos[idx]
+        if s < 0: return None
+        return self.strings[s]
+
+    def getParent(self, idx):
+        """
+        :return: node ID of the parent, or None if it has no parent (or the parent is the State)
+        :rtype: int|None
+        """
+        p = self.parents[idx]
+        if p < 0: return None
+        return p
+
+    def depth(self, idx):
+        """
+        Like _CBaseWithOptBody.depth().
+        """
+        parents = self.parents
+        d = 1
+        while parents[idx] >= 0:
+            idx = parents[idx]
+            d += 1
+        return d
+
+    def getChildren(self, idx):
+        """
+        :return: node IDs of all objects which have this object as their parent
+        :rtype: list[int]
+        """
+        if self._children is None:
+            children = {}
+            for i, p in enumerate(self.parents):
+                if p >= 0: children.setdefault(p, []).append(i)
+            self._children = children
+        return self._children.get(idx, [])
+
+    def find(self, name, cls=None):
+        """
+        :param str name:
+        :param type|None cls: if given, only instances of this class (or subclasses)
+        :return: node IDs of all objects with this name
+        :rtype: list[int]
+        """
+        try:
+            s = self.strings.index(name)
+        except ValueError:
+            return []
+        return [
+            i for (i, n) in enumerate(self.names)
+            if n == s and (cls is None or issubclass(self.getClass(i), cls))]
+
+    def toState(self, state=None):
+        """
+        :param cparser.State|None state: where to load into. a new State if None
+        :return: the State, which loads the objects from the arena when they are accessed
+        :rtype: cparser.State
+        """
+        if self._state is not None:
+            raise ArenaError("arena already loaded into a State, use copy()")
+        if state is None:
+            state = cparser.State()
+        self._state = state
+        self._objs = [None] * len(self)
+        return snapshot._loadInto(self, state)
+
+    def readRoot(self):
+        """
+        Like snapshot._SnapshotReader.readRoot, for snapshot._loadInto.
+        """
+        attribs = []
+        for attrib, v in self.roots.items():
+            if attrib in snapshot.LazyDictAttribs:
+                attribs.append((attrib, snapshot._AttribLazyDict, dict([
+                    (k, snapshot._LazyRef(x) if isinstance(x, NodeId) else self._decode(x))
+                    for (k, x) in v.items()])))
+            elif attrib in snapshot.LazyListAttribs:
+                attribs.append((attrib, snapshot._AttribLazyList, [
+                    snapshot._LazyRef(x) if isinstance(x, NodeId) else self._decode(x) for x in v]))
+            else:
+                attribs.append((attrib, snapshot._AttribValue, self._decode(v)))
+        return {}, attribs
+
+    def getObj(self, idx):
+        """
+        :param int idx: node ID
+        :return: the C object, together with all the objects it refers to
+        """
+        obj = self._objs[idx]
+        if obj is not None: return obj
+        cls = self.getClass(idx)
+        obj = self._objs[idx] = snapshot._newInstance(cls)
+        if snapshot._isFilledDirectly(cls):
+            self._fill(idx)
+            obj = self._objs[idx] = snapshot._internLoaded(obj)
+            return obj
+        # Fill the fields without recursion, the object graph can be deep.
+        self._pending.append(idx)
+        if not self._filling:
+            self._filling = True
+            try:
+                while self._pending:
+                    self._fill(self._pending.pop())
+            finally:
+                self._filling = False
+        return obj
+
+    def _fill(self, idx):
+        obj = self._objs[idx]
+        for attrib, column in (("parent", self.parents), ("type", self.types), ("body", self.bodies)):
+            v = column[idx]
+            if v >= 0: v = self.getObj(v)
+            elif v == _None: v = None
+            elif v == _StateRef: v = self._state
+            else: continue
+            setattr(obj, attrib, v)
+        for attrib, column in (("name", self.names), ("defPos", self.defPos)):
+            v = column[idx]
+            if v >= 0: setattr(obj, attrib, self.strings[v])
+            elif v == _None: setattr(obj, attrib, None)
+        extra = self.extras[idx]
+        for i in range(0, len(extra), 2):
+            setattr(obj, extra[i], self._decode(extra[i + 1]))
+
+    def _decode(self, v):
+        t = type(v)
+        if t is NodeId:
+            return self.getObj(v)
+        if t is not tuple:
+            return v
+        tag = v[0]
+        if tag == "l": return [self._decode(x) for x in v[1:]]
+        if tag == "t": return tuple([self._decode(x) for x in v[1:]])
+        if tag == "d": return dict([(self._decode(v[i]), self._decode(v[i + 1])) for i in range(1, len(v), 2)])
+        if tag == "s": return set([self._decode(x) for x in v[1:]])
+        if tag == "f": return frozenset([self._decode(x) for x in v[1:]])
+        if tag == "E": return cparser._emptyList
+        if tag == "S": return self._state
+        if tag == "c": return v[1]
+        if tag == "x":
+            attrib, name = v[1:]
+            d = getattr(self._state, attrib)
+            if name not in d:
+                raise ArenaError(
+                    "%s %r not found. maybe the global include wrappers are not setup" % (attrib, name))
+            return d[name]
+        raise ArenaError("invalid encoded value %r" % (v,))
+
+
+class _ArenaWriter:
+    def __init__(self, arena, state):
+        """
+        :param Arena arena:
+        :param cparser.State state:
+        """
+        self.arena = arena
+        self.state = state
+        self.objs = []  # node ID -> object
+        self.objIndex = {}  # id(obj) -> node ID
+        self.classIndex = {}
+        self.stringIndex = {}
+        self.externals = {}  # id(obj) -> (attrib, name). see snapshot.ExternalTypes
+        for attrib in snapshot.LazyDictAttribs:
+            for name, v in getattr(state, attrib).items():
+                if isinstance(v, snapshot.ExternalTypes):
+                    self.externals[id(v)] = (attrib, name)
+
+    def str(self, s):
+        idx = self.stringIndex.get(s)
+        if idx is None:
+            idx = self.stringIndex[s] = len(self.arena.strings)
+            self.arena.strings.append(s)
+        return idx
+
+    def ref(self, obj):
+        idx = self.objIndex.get(id(obj))
+        if idx is None:
+            idx = self.objIndex[id(obj)] = len(self.objs)
+            self.objs.append(obj)
+        return idx
+
+    def encode(self, v):
+        t = type(v)
+        if t in _AtomicTypes:
+            return v
+        if v is cparser._emptyList:
+            return ("E",)
+        idx = self.objIndex.get(id(v))
+        if idx is not None:
+            return NodeId(idx)
+        if t is list: return ("l",) + tuple([self.encode(x) for x in v])
+        if t is tuple: return ("t",) + tuple([self.encode(x) for x in v])
+        if t is set: return ("s",) + tuple([self.encode(x) for x in v])
+        if t is frozenset: return ("f",) + tuple([self.encode(x) for x in v])
+        if t is dict:
+            items = ("d",)
+            for k, x in v.items():
+                items += (self.encode(k), self.encode(x))
+            return items
+        if isinstance(v, _StateTypes):
+            return ("S",)
+        if id(v) in self.externals:
+            return ("x",) + self.externals[id(v)]
+        if isinstance(v, type) or t.__name__ == "classobj":
+            return ("c", v)
+        if _isObjClass(v.__class__):
+            return NodeId(self.ref(v))
+        raise ArenaError("cannot store %r" % (v,))
+
+    def encodeRef(self, v):
+        """
+        :return: column value, or _Extra
+        :rtype: int
+        """
+        if v is None: return _None
+        if isinstance(v, _StateTypes): return _StateRef
+        idx = self.objIndex.get(id(v))
+        if idx is not None: return idx
+        if id(v) not in self.externals and _isObjClass(v.__class__):
+            return self.ref(v)
+        return _Extra
+
+    def write(self):
+        arena = self.arena
+        state = self.state
+        for attrib in snapshot.LazyDictAttribs:
+            arena.roots[attrib] = dict([
+                (k, self.encode(v)) for (k, v) in getattr(state, attrib).items()
+                if not isinstance(v, snapshot.ExternalTypes)])
+        for attrib in snapshot.LazyListAttribs:
+            arena.roots[attrib] = [self.encode(v) for v in getattr(state, attrib)]
+        for attrib in snapshot.ValueAttribs:
+            arena.roots[attrib] = self.encode(getattr(state, attrib))
+
+        # addObj can add new objects.
+        i = 0
+        while i < len(self.objs):
+            self.addObj(self.objs[i])
+            i += 1
+
+    def addObj(self, obj):
+        arena = self.arena
+        cls = obj.__class__
+        clsIdx = self.classIndex.get(cls)
+        if clsIdx is None:
+            clsIdx = self.classIndex[cls] = len(arena.classes)
+            arena.classes.append(cls)
+        columns = {}
+        extra = []
+        for name, v in _getFields(obj):
+            # The ctypes type (see _getCTypeStruct) is created dynamically. It will be created again.
+            if name.startswith("_ctype"): continue
+            if name in RefColumns:
+                c = columns[name] = self.encodeRef(v)
+                if c != _Extra: continue
+            elif name in StrColumns:
+                if v is None:
+                    columns[name] = _None
+                    continue
+                if type(v) in _StrTypes:
+                    columns[name] = self.str(v)
+                    continue
+                columns[name] = _Extra
+            extra += [name, self.encode(v)]
+        arena.clsIdxs.append(clsIdx)
+        arena.parents.append(columns.get("parent", _Unset))
+        arena.types.append(columns.get("type", _Unset))
+        arena.bodies.append(columns.get("body", _Unset))
+        arena.names.append(columns.get("name", _Unset))
+        arena.defPos.append(columns.get("defPos", _Unset))
+        arena.extras.append(tuple(extra))
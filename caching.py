@@ -22,21 +22,52 @@ else:
     from . import cparser
     from .cparser_utils import *
 import types
+import pickle
+import tempfile
 
-# Note: It might make sense to make this somehow configureable.
-# However, for now, I'd like to keep things as simple as possible.
-# Using /tmp or (a bit better) /var/tmp might have been another
-# possibility. However, it makes sense to keep this more permanent
-# because when compiling a lot, it can be very time-critical if
-# we just remove all the data.
-# If wasted space becomes an issue, it is easy to write a script
-# which would remove all old/obsolete entries from the cache.
-# It makes sense also to keep this global for the whole system
-# because the caching system should be able to handle this
-# and it should thus only improve the performance.
-# It is saved though in the user directory because most probably
-# we wouldn't have write permission otherwise.
+# The caching dir is kept permanent and global for the whole system
+# (it is in the user directory because most probably we wouldn't have
+# write permission otherwise). When compiling a lot, it can be very
+# time-critical if we just remove all the data, and the caching system
+# should be able to handle the sharing, thus it only improves the performance.
+# It can be configured via the env var CPARSER_CACHING_DIR or setCachingDir().
+# Nothing gets removed automatically unless CACHING_MAX_BYTES is set
+# (env var CPARSER_CACHING_MAX_BYTES, e.g. "500M"). Otherwise, use the
+# CacheManager or the command line (`python -m cparser.caching --help`)
+# to inspect and prune the cache.
 CACHING_DIR = os.path.expanduser("~/.cparser_caching/")
+CACHING_MAX_BYTES = None
+
+def setCachingDir(path):
+    global CACHING_DIR
+    path = os.path.expanduser(path)
+    if not path.endswith("/"): path += "/"
+    CACHING_DIR = path
+
+def parseBytes(s):
+    """
+    :param str|int s: e.g. "1024", "10k", "500M", "2G"
+    :rtype: int
+    """
+    if isinstance(s, (int,long)): return s
+    s = s.strip().upper()
+    if s.endswith("B"): s = s[:-1]
+    for i, unit in enumerate("KMGT"):
+        if s.endswith(unit):
+            return int(float(s[:-1]) * 1024 ** (i + 1))
+    return int(s)
+
+def formatBytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024 or unit == "GB": break
+        n /= 1024.0
+    if unit == "B": return "%i%s" % (n, unit)
+    return "%.1f%s" % (n, unit)
+
+if os.environ.get("CPARSER_CACHING_DIR"):
+    setCachingDir(os.environ["CPARSER_CACHING_DIR"])
+if os.environ.get("CPARSER_CACHING_MAX_BYTES"):
+    CACHING_MAX_BYTES = parseBytes(os.environ["CPARSER_CACHING_MAX_BYTES"])
 
 def sha1(obj):
     import hashlib
@@ -59,16 +90,33 @@ def sha1(obj):
             h_update(sha1(v))
             h_update(",")
         h_update("}")
-    elif isinstance(obj, (list,tuple)):
+    elif isinstance(obj, list):
         h_update("[")
         for v in sorted(obj):
             h_update(sha1(v))
             h_update(",")
         h_update("]")
+    elif isinstance(obj, tuple):
+        # The order is relevant here, and the entries might not be comparable.
+        h_update("(")
+        for v in obj:
+            h_update(sha1(v))
+            h_update(",")
+        h_update(")")
     else:
         h_update(str(obj))
     return h.hexdigest()
 
+def sha1_file(filename):
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(64 * 1024)
+            if not block: break
+            h.update(block)
+    return h.hexdigest()
+
 class MyDict(dict):
     def __setattr__(self, key, value):
         assert isinstance(key, (str,unicode))
@@ -79,40 +127,86 @@ class MyDict(dict):
     def __repr__(self): return "MyDict(" + dict.__repr__(self) + ")"
     def __str__(self): return "MyDict(" + dict.__str__(self) + ")"
 
+class CacheRefNotFound(Exception): pass
+
+class _CachePickler(pickle.Pickler):
+    # The C objects refer to the state (e.g. via the parent of top-level objects).
+    # We don't save it but bind the current state again when loading.
+    # Also, declarations which were not added by the cached file itself
+    # (e.g. a typedef from an earlier header) are saved by reference
+    # (external: id(obj) -> (attrib, name)), so that they stay identical.
+    def __init__(self, f, external=None):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self._external = external or {}
+    def persistent_id(self, obj):
+        if isinstance(obj, (StateWrapper, cparser.State)):
+            return "state"
+        return self._external.get(id(obj))
+
+class _CacheUnpickler(pickle.Unpickler):
+    def __init__(self, f, stateStruct=None):
+        pickle.Unpickler.__init__(self, f)
+        self._stateStruct = stateStruct
+    def persistent_load(self, pid):
+        if self._stateStruct is None:
+            raise pickle.UnpicklingError("need state for persistent id %r" % (pid,))
+        if pid == "state":
+            return self._stateStruct
+        attrib, name = pid
+        d = getattr(self._stateStruct, attrib)
+        if name not in d:
+            raise CacheRefNotFound("%s %r not found" % (attrib, name))
+        return d[name]
+
+# os.rename does not overwrite existing files on Windows.
+_replace_file = getattr(os, "replace", os.rename)
+
 class DbObj:
     @classmethod
-    def GetFilePath(cls, key):
+    def GetRelFilePath(cls, key):
         h = sha1(key)
-        prefix = CACHING_DIR + cls.Namespace
-        return prefix + "/" + h[:2] + "/" + h[2:]
+        return cls.Namespace + "/" + h[:2] + "/" + h[2:]
+    @classmethod
+    def GetFilePath(cls, key):
+        return CACHING_DIR + cls.GetRelFilePath(key)
     @classmethod
-    def Load(cls, key, create=False):
+    def Load(cls, key, create=False, stateStruct=None):
         fn = cls.GetFilePath(key)
-        try: f = open(fn, "b")
-        except:
+        try: f = open(fn, "rb")
+        except IOError:
             if create:
                 obj = cls()
                 obj.__dict__["_key"] = key
                 return obj
             else:
                 return None
-        import pickle
-        obj = pickle.load(f)
-        f.close()
+        with f:
+            obj = _CacheUnpickler(f, stateStruct=stateStruct).load()
+        # Mark it as recently used. See CacheManager.
+        try: os.utime(fn, None)
+        except OSError: pass
         return obj
     @classmethod
     def Delete(cls, key):
         fn = cls.GetFilePath(key)
         os.remove(fn)
     def delete(self): self.Delete(self._key)
-    def save(self):
+    def save(self, external=None):
         fn = self.GetFilePath(self._key)
-        try: os.makedirs(os.path.dirname(fn))
-        except: pass # ignore file-exists or other errors
-        f = open(fn, "wb")
-        import pickle
-        pickle.dump(self, f)
-        f.close()
+        dirname = os.path.dirname(fn)
+        try: os.makedirs(dirname)
+        except OSError: pass # ignore file-exists or other errors
+        # Write to a temporary file first and rename it then,
+        # so that readers (also other processes) never see a partially written file.
+        fd, tmpfn = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                _CachePickler(f, external=external).dump(self)
+            _replace_file(tmpfn, fn)
+        except BaseException:
+            try: os.remove(tmpfn)
+            except OSError: pass
+            raise
 
 def getLastChangeUnixTime(filename):
     import os.path
@@ -122,20 +216,33 @@ class FileCacheRef(MyDict):
     @classmethod
     def FromCacheData(cls, cache_data):
         ref = cls()
-        ref.filedepslist = map(lambda fn: (fn,getLastChangeUnixTime(fn)), cache_data.filenames)
+        ref.filedepslist = [
+            (fn, getLastChangeUnixTime(fn), sha1_file(fn))
+            for fn in sorted(cache_data.filenames)]
         ref.macros = {}
         for m in cache_data.macroAccessSet:
-            ref.macros[m] = cache_data.oldMacros[m]
+            ref.macros[m] = cache_data.oldMacros.get(m) # None if it was not defined
         return ref
     def match(self, stateStruct):
-        for macro in self.macros:
-            if stateStruct.macros[macro] != self.macros[macro]:
+        # Access the macros only via `in` and `[]` so that an outer cache level tracks it.
+        macros = stateStruct.macros
+        for macro, value in self.macros.items():
+            if macro in macros:
+                if value is None or macros[macro] != value:
+                    return False
+            elif value is not None:
                 return False
         return True
     def checkFileDepListUpToDate(self):
-        for fn,unixtime in self.filedepslist:
-            if getLastChangeUnixTime(fn) > unixtime:
-                return False
+        for fn,unixtime,h in self.filedepslist:
+            try:
+                if getLastChangeUnixTime(fn) == unixtime: continue
+                # The file was touched (e.g. by a checkout or a build system)
+                # but maybe the content is still the same.
+                if sha1_file(fn) == h: continue
+            except (IOError, OSError): # e.g. it was deleted
+                pass
+            return False
         return True
 
 class FileCacheRefs(DbObj, list):
@@ -148,8 +255,13 @@ class FileCache(DbObj, MyDict):
         obj = cls()
         obj.__dict__["_key"] = key
         obj.additions = cache_data.additions
+        obj.globalIncludes = cache_data.globalIncludes
         return obj
     def apply(self, stateStruct):
+        # The global include wrappers add their stuff directly to the real state,
+        # thus we don't have it in our additions and need to redo that.
+        for filename in self.globalIncludes:
+            for c in stateStruct.preprocess_file(filename, local=False): pass
         for k,l in self.additions.items():
             a = getattr(stateStruct, k)
             if isinstance(a, (list,StateListWrapper)):
@@ -160,66 +272,108 @@ class FileCache(DbObj, MyDict):
                         a.pop(dk)
                     else:
                         a[dk] = dv
+            elif isinstance(a, (set,StateSetWrapper)):
+                a.update(l)
             else:
                 assert False, "unknown attribute " + k + ": " + str(a)
 
+def _getExternalObjs(stateStruct, additions):
+    """
+    :return: id(obj) -> (attrib, name) for all declarations in the state which are not in additions.
+      See _CachePickler.
+    """
+    own = set()
+    for k in StateWrapper.WrappedDicts:
+        own.update([id(v) for (_, v) in additions[k]])
+    external = {}
+    for k in StateWrapper.ExternalRefDicts:
+        for name, v in getattr(stateStruct._stateStruct, k).items():
+            if id(v) not in own:
+                external[id(v)] = (k, name)
+    return external
+
 def check_cache(stateStruct, full_filename):
+    """
+    :return: (FileCacheRef, FileCache) or None
+    """
     filecaches = FileCacheRefs.Load(full_filename)
     if filecaches is None: return None
 
-    for filecacheref in filecaches:
+    for filecacheref in list(filecaches):
         if not filecacheref.match(stateStruct):
             continue
         if not filecacheref.checkFileDepListUpToDate():
-            FileCache.Delete(filecacheref)
+            try: FileCache.Delete(filecacheref)
+            except OSError: pass
             filecaches.remove(filecacheref)
             filecaches.save()
             return None
-        filecache = FileCache.Load(filecacheref)
-        assert filecache is not None, sha1(filecacheref) + " not found in " + FileCache.Namespace
-        return filecache
+        try:
+            filecache = FileCache.Load(filecacheref, stateStruct=stateStruct)
+        except CacheRefNotFound:
+            # We are in a different context, e.g. some typedef is not there.
+            continue
+        if filecache is None:
+            # Can happen if it was removed by some other process.
+            filecaches.remove(filecacheref)
+            filecaches.save()
+            continue
+        return filecacheref, filecache
 
     return None
 
-def save_cache(cache_data, full_filename):
-    filecaches = FileCacheRefs.Load(full_filename, create=True)
+def save_cache(stateStruct, cache_data, full_filename):
     filecacheref = FileCacheRef.FromCacheData(cache_data)
+    filecache = FileCache.FromCacheData(cache_data, key=filecacheref)
+    filecache.save(external=_getExternalObjs(stateStruct, cache_data.additions))
+    filecaches = FileCacheRefs.Load(full_filename, create=True)
+    key = sha1(filecacheref)
+    filecaches[:] = [ref for ref in filecaches if sha1(ref) != key]
     filecaches.append(filecacheref)
     filecaches.save()
-    filecache = FileCache.FromCacheData(cache_data, key=filecacheref)
-    filecache.save()
 
 # Note: This does more than State.preprocess. In case it hits a cache,
 # it applies all effects up to cpre3 and ignores the preprocessing.
 # Note also: This is a generator. In the cache hit case, it yields nothing.
 # Otherwise, it doesn't do any further processing and it just yields the rest.
 def State__cached_preprocess(stateStruct, reader, full_filename, filename):
-    if not full_filename:
-        # shortcut. we cannot use caching if we don't have the full filename.
+    assert isinstance(stateStruct, StateWrapper)
+    if not full_filename or not stateStruct._cpre3_atBaseLevel:
+        # We cannot use caching if we don't have the full filename.
+        # Also, the cache only covers complete C objects, thus cpre3 must be at the base level,
+        # i.e. we are not inside of a struct or so.
+        # If we are inside another cached file, its cache level covers all the effects.
+        if full_filename and stateStruct._cache_stack:
+            stateStruct._filenames.add(full_filename)
         for c in generic_class_method(cparser.State.preprocess)(stateStruct, reader, full_filename, filename):
             yield c
         return
 
-    if stateStruct._cpre3_atBaseLevel:
-        try:
-            cached_entry = check_cache(stateStruct, full_filename)
-            if cached_entry is not None:
-                cached_entry.apply(stateStruct)
-                return
-        except Exception as e:
-            print("(Safe to ignore) Error while reading C parser cache for %s : %s" % (filename, str(e)))
-            # Try to delete old references if possible. Otherwise we might always hit this.
-            try: FileCacheRefs.Delete(full_filename)
-            except: pass
+    try:
+        cached_entry = check_cache(stateStruct, full_filename)
+    except Exception as e:
+        print("(Safe to ignore) Error while reading C parser cache for %s : %s" % (filename, str(e)))
+        # Try to delete old references if possible. Otherwise we might always hit this.
+        try: FileCacheRefs.Delete(full_filename)
+        except Exception: pass
+        cached_entry = None
+    if cached_entry is not None:
+        filecacheref, filecache = cached_entry
+        filecache.apply(stateStruct)
+        if stateStruct._cache_stack:
+            stateStruct._filenames.update([fn for (fn, _, _) in filecacheref.filedepslist])
+        return
 
-    assert isinstance(stateStruct, StateWrapper)
     stateStruct.cache_pushLevel()
     stateStruct._filenames.add(full_filename)
     for c in generic_class_method(cparser.State.preprocess)(stateStruct, reader, full_filename, filename):
         yield c
     cache_data = stateStruct.cache_popLevel()
 
-    save_cache(cache_data, full_filename)
+    try:
+        save_cache(stateStruct, cache_data, full_filename)
+    except Exception as e:
+        print("(Safe to ignore) Error while writing C parser cache for %s : %s" % (filename, str(e)))
 
 class StateDictWrapper:
     def __init__(self, d, addList, addSet=None, accessSet=None):
@@ -244,7 +398,8 @@ class StateDictWrapper:
     def __contains__(self, k): return self.has_key(k)
     def has_key(self, k):
         haskey = self._dict.__contains__(k)
-        if haskey and self._accessSet is not None:
+        # Also if it is not there. E.g. `#ifdef` depends on that.
+        if self._accessSet is not None:
             assert self._addSet is not None
             if not k in self._addSet: # we only care about it if we didn't add it ourself
                 self._accessSet.add(k)
@@ -276,13 +431,33 @@ class StateListWrapper:
     def __repr__(self): return "StateListWrapper(" + repr(self._list) + ")"
     def __str__(self): return "StateListWrapper(" + str(self._list) + ")"
 
+class StateSetWrapper:
+    def __init__(self, s, addList):
+        self._addList = addList
+        self._set = s
+    def __getattr__(self, k):
+        return getattr(self._set, k)
+    def __contains__(self, k): return k in self._set
+    def add(self, v):
+        self._set.add(v)
+        self._addList.append(v)
+    def update(self, l):
+        l = list(l)
+        self._set.update(l)
+        self._addList.extend(l)
+    def __repr__(self): return "StateSetWrapper(" + repr(self._set) + ")"
+    def __str__(self): return "StateSetWrapper(" + str(self._set) + ")"
+
 class StateWrapper:
-    WrappedDicts = ("macros","typedefs","structs","unions","enums","funcs","vars","enumconsts")
-    WrappedLists = ("contentlist",)
-    LocalAttribs = ("_stateStruct", "_cache_stack", "_additions", "_macroAccessSet", "_macroAddSet", "_filenames", "_cpre3_atBaseLevel")
+    WrappedDicts = ("macros","typedefs","structs","unions","enums","funcs","vars","enumconsts","_include_guards")
+    WrappedLists = ("contentlist","_errors")
+    WrappedSets = ("_include_once",)
+    ExternalRefDicts = ("typedefs","structs","unions","enums","funcs","vars","enumconsts") # see _getExternalObjs
+    LocalAttribs = ("_stateStruct", "_cache_stack", "_additions", "_macroAccessSet", "_macroAddSet", "_filenames", "_globalIncludes", "_cpre3_atBaseLevel")
     def __init__(self, stateStruct):
         self._stateStruct = stateStruct
         self._cache_stack = []
+        self._cpre3_atBaseLevel = False # until cpre3_parse runs
     def __getattr__(self, k):
         if k in self.LocalAttribs: raise AttributeError # normally we shouldn't get here but just in case
         if len(self._cache_stack) > 0:
@@ -294,6 +469,8 @@ class StateWrapper:
                 return StateDictWrapper(**kwattr)
             if k in self.WrappedLists:
                 return StateListWrapper(getattr(self._stateStruct, k), addList=self._additions[k])
+            if k in self.WrappedSets:
+                return StateSetWrapper(getattr(self._stateStruct, k), addList=self._additions[k])
         attr = getattr(self._stateStruct, k)
         if isinstance(attr, types.MethodType):
             attr = rebound_instance_method(attr, self)
@@ -307,18 +484,20 @@ class StateWrapper:
         if k in self.WrappedLists and isinstance(v, StateListWrapper): return # ignore. probably iadd or so.
         setattr(self._stateStruct, k, v)
     def cache_pushLevel(self):
-        self._additions = {} # dict/list attrib -> addition list
-        for k in self.WrappedDicts + self.WrappedLists: self._additions[k] = []
+        self._additions = {} # dict/list/set attrib -> addition list
+        for k in self.WrappedDicts + self.WrappedLists + self.WrappedSets: self._additions[k] = []
         self._macroAccessSet = set()
         self._macroAddSet = set()
         self._filenames = set()
+        self._globalIncludes = []
         self._cache_stack.append(
             MyDict(
                 oldMacros = dict(self._stateStruct.macros),
                 additions = self._additions,
                 macroAccessSet = self._macroAccessSet,
                 macroAddSet = self._macroAddSet,
-                filenames = self._filenames
+                filenames = self._filenames,
+                globalIncludes = self._globalIncludes
             ))
     def cache_popLevel(self):
         cache_data = self._cache_stack.pop()
@@ -327,6 +506,7 @@ class StateWrapper:
             del self._macroAccessSet
             del self._macroAddSet
             del self._filenames
+            del self._globalIncludes
         else:
             # recover last
             last = self._cache_stack[-1]
@@ -334,15 +514,25 @@ class StateWrapper:
             self._macroAccessSet = last.macroAccessSet
             self._macroAddSet = last.macroAddSet
             self._filenames = last.filenames
+            self._globalIncludes = last.globalIncludes
             # merge with popped frame
-            for k in self.WrappedDicts + self.WrappedLists:
+            for k in self.WrappedDicts + self.WrappedLists + self.WrappedSets:
                 self._additions[k].extend(cache_data.additions[k])
             self._macroAddSet.update(cache_data.macroAddSet)
             for k in cache_data.macroAccessSet:
                 if k not in self._macroAddSet:
                     self._macroAccessSet.add(k)
             self._filenames.update(cache_data.filenames)
+            self._globalIncludes.extend(cache_data.globalIncludes)
         return cache_data
+    def preprocess_file(self, filename, local):
+        if not local and self._cache_stack:
+            # See FileCache.apply. Only needed if some global include wrapper handles it,
+            # otherwise all the effects go through us.
+            wrapper = self._stateStruct._global_include_wrapper
+            if wrapper is not None and wrapper.find_handler_func(filename) is not None:
+                self._globalIncludes.append(filename)
+        return generic_class_method(cparser.State.preprocess_file)(self, filename, local)
     preprocess = State__cached_preprocess
     def __getstate__(self):
         # many C structure objects refer to this as their parent.
@@ -351,6 +541,114 @@ class StateWrapper:
         # dump this whole object.
         return None
 
+class CacheManager:
+    """
+    Inspects and cleans up the caching dir.
+    The cache entries are the files of FileCacheRefs and FileCache.
+    Their mtime is the time of their last usage (see DbObj.Load),
+    which is used for the LRU eviction.
+    """
+    Namespaces = (FileCacheRefs.Namespace, FileCache.Namespace)
+    # Temp files (see DbObj.save) and FileCache entries without reference
+    # which are younger than this might still be in use by some other process.
+    GracePeriod = 60 * 60
+
+    def __init__(self, cachingDir=None):
+        if cachingDir is None: cachingDir = CACHING_DIR
+        self.cachingDir = cachingDir
+
+    def entries(self, namespace):
+        """
+        :return: yields (filename, size, mtime) for all files, including temp files
+        """
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.cachingDir, namespace)):
+            for fn in filenames:
+                fn = os.path.normpath(os.path.join(dirpath, fn))
+                try: st = os.stat(fn)
+                except OSError: continue # removed in the meantime
+                yield fn, st.st_size, st.st_mtime
+
+    def info(self):
+        """
+        :return: namespace -> (number of entries, number of bytes)
+        :rtype: dict[str,(int,int)]
+        """
+        res = {}
+        for namespace in self.Namespaces:
+            entries = list(self.entries(namespace))
+            res[namespace] = (len(entries), sum([size for (_, size, _) in entries]))
+        return res
+
+    def clear(self):
+        import shutil
+        for namespace in self.Namespaces:
+            shutil.rmtree(os.path.join(self.cachingDir, namespace), ignore_errors=True)
+
+    def _referencedFileCaches(self):
+        """
+        :return: all FileCache filenames which are referenced by some FileCacheRefs,
+          and all FileCacheRefs filenames which could not be loaded
+        :rtype: (set[str],list[str])
+        """
+        referenced = set()
+        broken = []
+        for fn, _, _ in self.entries(FileCacheRefs.Namespace):
+            if os.path.basename(fn).startswith(".tmp-"): continue
+            try:
+                with open(fn, "rb") as f:
+                    refs = _CacheUnpickler(f).load()
+            except Exception:
+                broken.append(fn)
+                continue
+            for ref in refs:
+                referenced.add(os.path.normpath(os.path.join(self.cachingDir, FileCache.GetRelFilePath(ref))))
+        return referenced, broken
+
+    def prune(self, maxBytes=None, maxAge=None, now=None):
+        """
+        Removes leftover temp files, unloadable or unreferenced entries,
+        entries which were not used for maxAge seconds and then
+        the least recently used entries until we are within maxBytes.
+
+        :param int|None maxBytes:
+        :param float|None maxAge: in seconds
+        :param float|None now: unix time
+        :return: number of removed files, number of removed bytes
+        :rtype: (int,int)
+        """
+        import time
+        if now is None: now = time.time()
+        referenced, broken = self._referencedFileCaches()
+        broken = set(broken)
+        entries = []
+        remove = []
+        for namespace in self.Namespaces:
+            for fn, size, mtime in self.entries(namespace):
+                if os.path.basename(fn).startswith(".tmp-"):
+                    if mtime < now - self.GracePeriod:
+                        remove.append((fn, size))
+                elif fn in broken:
+                    remove.append((fn, size))
+                elif namespace == FileCache.Namespace and fn not in referenced and mtime < now - self.GracePeriod:
+                    remove.append((fn, size))
+                elif maxAge is not None and mtime < now - maxAge:
+                    remove.append((fn, size))
+                else:
+                    entries.append((mtime, fn, size))
+        if maxBytes is not None:
+            totalSize = sum([size for (_, _, size) in entries])
+            for mtime, fn, size in sorted(entries):
+                if totalSize <= maxBytes: break
+                remove.append((fn, size))
+                totalSize -= size
+        count, removedBytes = 0, 0
+        for fn, size in remove:
+            try: os.remove(fn)
+            except OSError: continue # e.g. removed in the meantime
+            count += 1
+            removedBytes += size
+        return count, removedBytes
+
 def parse(filename, state = None):
     if state is None:
         state = cparser.State()
@@ -361,6 +659,12 @@ def parse(filename, state = None):
     tokens = cparser.cpre2_parse(wrappedState, preprocessed)
     cparser.cpre3_parse(wrappedState, tokens)
 
+    if CACHING_MAX_BYTES is not None:
+        try:
+            CacheManager().prune(maxBytes=CACHING_MAX_BYTES)
+        except Exception as e:
+            print("(Safe to ignore) Error while pruning C parser cache: %s" % str(e))
+
     return state
 
 def test():
@@ -371,5 +675,39 @@ def test():
 
     return state
 
+def main(argv=None):
+    import argparse
+    argparser = argparse.ArgumentParser(description="Inspect and clean up the PyCParser cache.")
+    argparser.add_argument("--dir", help="caching dir (default: %s)" % CACHING_DIR)
+    subparsers = argparser.add_subparsers(dest="command")
+    subparsers.add_parser("info", help="show the number of entries and their size")
+    pruneparser = subparsers.add_parser("prune", help="remove old, obsolete and least recently used entries")
+    pruneparser.add_argument("--max-bytes", help="byte budget, e.g. 500M (default: %s)" % CACHING_MAX_BYTES)
+    pruneparser.add_argument("--max-days", type=float, help="remove entries not used since that many days")
+    subparsers.add_parser("clear", help="remove all entries")
+    args = argparser.parse_args(argv)
+
+    manager = CacheManager(cachingDir=args.dir)
+    if args.command == "info":
+        print("caching dir: %s" % manager.cachingDir)
+        totalCount, totalSize = 0, 0
+        for namespace, (count, size) in sorted(manager.info().items()):
+            print("%s: %i entries, %s" % (namespace, count, formatBytes(size)))
+            totalCount += count
+            totalSize += size
+        print("total: %i entries, %s" % (totalCount, formatBytes(totalSize)))
+    elif args.command == "prune":
+        maxBytes = parseBytes(args.max_bytes) if args.max_bytes else CACHING_MAX_BYTES
+        maxAge = args.max_days * 24 * 60 * 60 if args.max_days is not None else None
+        count, size = manager.prune(maxBytes=maxBytes, maxAge=maxAge)
+        print("removed %i entries, %s" % (count, formatBytes(size)))
+    elif args.command == "clear":
+        manager.clear()
+        print("cleared %s" % manager.cachingDir)
+    else:
+        argparser.print_help()
+        return 1
+    return 0
+
 if __name__ == '__main__':
-    print(test())
+    sys.exit(main())
@@ -8,10 +8,15 @@ code under BSD 2-Clause License
 
 from __future__ import print_function
 import typing
+import re
+import array
+import bisect
+import itertools
 import ctypes
 import _ctypes
+import weakref
 from inspect import isclass
-from .cparser_utils import unicode, long, unichr
+from .cparser_utils import unicode, long, unichr, intern
 
 if typing.TYPE_CHECKING:
     from . import globalincludewrappers
@@ -154,92 +159,115 @@ def escape_cstr(s):
     return s.replace('"', '\\"')
 
 
-def parse_macro_def_rightside(stateStruct, argnames, input):
-    assert input is not None
-    if stateStruct is None:
-        class Dummy:
-            def error(self, s): pass
-        stateStruct = Dummy()
+class _MacroTemplate(object):
+    """
+    The compiled right side of a macro definition.
+    This is a list of parts, where each part is a literal str, an arg, a stringified arg (`#x`)
+    or a paste (`##`), which strips the whitespace of the output so far.
+    Expanding it is just a join over these parts.
+    """
 
-    def f(*args):
-        assert len(args) == len(argnames or ())
-        args = {k: v for (k, v) in zip(argnames or (), args)}
+    Literal, Arg, StringifyArg, Paste = range(4)
+
+    def __init__(self, argnames, input):
+        """
+        :param list[str]|tuple[str]|None argnames:
+        :param str input: right side of the macro definition
+        """
+        assert input is not None
+        self.numArgs = len(argnames or ())
+        self.parts = []  # type: typing.List[typing.Tuple[int,typing.Union[str,int,None]]]
+        self.errors = []  # type: typing.List[str]  # reported on every expansion
+        self._compile(argnames, input)
+
+    def _literal(self, s):
+        if not s: return
+        if self.parts and self.parts[-1][0] == self.Literal:
+            self.parts[-1] = (self.Literal, self.parts[-1][1] + s)
+        else:
+            self.parts.append((self.Literal, s))
 
-        ret = ""
+    def _identifier(self, args, name):
+        if name in args:
+            self.parts.append((self.Arg, args[name]))
+        else:
+            self._literal(name)
+
+    def _paste(self):
+        if not self.parts: return
+        if len(self.parts) == 1 and self.parts[0][0] == self.Literal:
+            # We can already do it here.
+            self.parts[0] = (self.Literal, self.parts[0][1].rstrip())
+        else:
+            self.parts.append((self.Paste, None))
+
+    def _compile(self, argnames, input):
+        args = {k: i for (i, k) in enumerate(argnames or ())}
         state = 0
         lastidentifier = ""
         for c in input:
             if state == 0:
-                if c in SpaceChars: ret += c
+                if c in SpaceChars: self._literal(c)
                 elif c in LetterChars + "_":
                     state = 1
                     lastidentifier = c
                 elif c in NumberChars:
                     state = 2
-                    ret += c
+                    self._literal(c)
                 elif c == '"':
                     state = 4
-                    ret += c
+                    self._literal(c)
                 elif c == "#": state = 6
-                else: ret += c
+                else: self._literal(c)
             elif state == 1: # identifier
                 if c in LetterChars + NumberChars + "_":
                     lastidentifier += c
                 elif c == "#":
-                    if lastidentifier in args:
-                        ret += args[lastidentifier]
-                    else:
-                        ret += lastidentifier
+                    self._identifier(args, lastidentifier)
                     lastidentifier = ""
                     state = 9
                 else:
-                    if lastidentifier in args:
-                        ret += args[lastidentifier]
-                    else:
-                        ret += lastidentifier
+                    self._identifier(args, lastidentifier)
                     lastidentifier = ""
-                    ret += c
+                    self._literal(c)
                     state = 0
             elif state == 2: # number
-                ret += c
+                self._literal(c)
                 if c in NumberChars: pass
                 elif c == "x": state = 3
                 elif c in LetterChars + "_": pass # even if invalid, stay in this state
                 else: state = 0
             elif state == 3: # hex number
-                ret += c
+                self._literal(c)
                 if c in NumberChars + LetterChars + "_": pass # also ignore invalids
                 else: state = 0
             elif state == 4: # str
-                ret += c
+                self._literal(c)
                 if c == "\\": state = 5
                 elif c == '"': state = 0
                 else: pass
             elif state == 5: # escape in str
                 state = 4
-                ret += simple_escape_char(c)
+                self._literal(simple_escape_char(c))
             elif state == 6: # after "#"
                 if c in SpaceChars + LetterChars + "_":
                     lastidentifier = c.strip()
                     state = 7
                 elif c == "#":
-                    ret = ret.rstrip()
+                    self._paste()
                     state = 8
                 else:
                     # unexpected, just recover
-                    stateStruct.error("unfold macro: unexpected char '" + c + "' after #")
+                    self.errors.append("unfold macro: unexpected char '" + c + "' after #")
                     state = 0
             elif state == 7: # after single "#"	with identifier
                 if c in LetterChars + NumberChars + "_":
                     lastidentifier += c
                 else:
-                    if lastidentifier not in args:
-                        stateStruct.error("unfold macro: cannot stringify " + lastidentifier + ": not found")
-                    else:
-                        ret += '"' + escape_cstr(args[lastidentifier]) + '"'
+                    self._stringify(args, lastidentifier)
                     lastidentifier = ""
                     state = 0
-                    ret += c
+                    self._literal(c)
             elif state == 8: # after "##"
                 if c in SpaceChars: pass
                 else:
@@ -248,26 +276,54 @@ def parse_macro_def_rightside(stateStruct, argnames, input):
             elif state == 9: # after identifier + "#"
                 if c == "#": state = 10
                 else:
-                    stateStruct.error("unfold macro: unexpected char %r after in state %i" % (c, state))
+                    self.errors.append("unfold macro: unexpected char %r after in state %i" % (c, state))
                     state = 0  # recover
             elif state == 10: # after identifier + "##"
                 if c in LetterChars + "_":
                     lastidentifier = c
                     state = 1
                 else:
-                    stateStruct.error("unfold macro: unexpected char %r after in state %i" % (c, state))
+                    self.errors.append("unfold macro: unexpected char %r after in state %i" % (c, state))
                     state = 0  # recover
             else:
-                stateStruct.error("unfold macro: internal error, char %r, in state %i" % (c, state))
+                self.errors.append("unfold macro: internal error, char %r, in state %i" % (c, state))
                 state = 0  # recover
         # Final check.
         if state == 1:
-            if lastidentifier in args:
-                ret += args[lastidentifier]
-            else:
-                ret += lastidentifier
+            self._identifier(args, lastidentifier)
+        elif state == 7:
+            self._stringify(args, lastidentifier)
+
+    def _stringify(self, args, name):
+        if name not in args:
+            self.errors.append("unfold macro: cannot stringify " + name + ": not found")
+        else:
+            self.parts.append((self.StringifyArg, args[name]))
+
+    def expand(self, stateStruct, args):
+        """
+        :param State|None stateStruct: for error reporting
+        :param list[str]|tuple[str] args:
+        :rtype: str
+        """
+        assert len(args) == self.numArgs
+        if stateStruct is not None:
+            for s in self.errors:
+                stateStruct.error(s)
+        ret = []
+        for kind, value in self.parts:
+            if kind == self.Literal: ret.append(value)
+            elif kind == self.Arg: ret.append(args[value])
+            elif kind == self.StringifyArg: ret.append('"' + escape_cstr(args[value]) + '"')
+            else: ret = ["".join(ret).rstrip()]
+        return "".join(ret)
 
-        return ret
+
+def parse_macro_def_rightside(stateStruct, argnames, input):
+    template = _MacroTemplate(argnames, input)
+
+    def f(*args):
+        return template.expand(stateStruct, args)
 
     return f
 
@@ -279,6 +335,7 @@ class Macro(object):
         self.rightside = rightside if (rightside is not None) else ""
         self.defPos = state.curPosAsStr() if state else "<unknown>"
         self._tokens = None
+        self._template = None  # (args, rightside, _MacroTemplate), see eval()
     def __str__(self):
         if self.args is not None:
             return "(" + ", ".join(self.args) + ") -> " + self.rightside
@@ -288,8 +345,11 @@ class Macro(object):
         return "<Macro: " + str(self) + ">"
     def eval(self, state, args):
         if len(args) != len(self.args or ()): raise TypeError("invalid number of args (" + str(args) + ") for " + repr(self))
-        func = parse_macro_def_rightside(state, self.args, self.rightside)
-        return func(*args)
+        # Compile the right side only once.
+        # Check args and rightside in case someone modified them afterwards.
+        if self._template is None or self._template[0] is not self.args or self._template[1] is not self.rightside:
+            self._template = (self.args, self.rightside, _MacroTemplate(self.args, self.rightside))
+        return self._template[2].expand(state, args)
     def __call__(self, *args):
         return self.eval(None, args)
     def __eq__(self, other):
@@ -335,6 +395,7 @@ class CType(object):
     def __repr__(self):
         return self.__class__.__name__ + " " + str(self.__dict__)
     def __eq__(self, other):
+        if self is other: return True  # common case for the interned types, see _InternedType
         if not hasattr(other, "__class__"): return False
         return self.__class__ is other.__class__ and self.__dict__ == other.__dict__
     def __ne__(self, other): return not self == other
@@ -345,26 +406,86 @@ class CType(object):
         raise NotImplementedError(str(self) + " asCCode not implemented")
 
 
+# (cls,) + key -> type instance. see _InternedTypeMeta.
+# Strong refs, because most types are temporary and would be recreated all the time.
+_internedTypes = {}
+_InternedTypesMaxCount = 10000
+
+
+def _internKeyOf(v):
+    if v is None or isinstance(v, (str, unicode, int, long, tuple, type)):
+        return v
+    if isinstance(v, _CBase):  # e.g. CNumber as the array len
+        return v.__class__, v.content
+    # Other types are interned themselves, or compare by identity anyway (e.g. CStruct).
+    # The interned type keeps v alive, so the id stays valid as long as the entry exists.
+    return "id", id(v)
+
+
+class _InternedTypeMeta(type):
+    """
+    Hash-consing: calling the class returns the existing instance for structurally equal args,
+    so equal types are usually also identical.
+    Objects created via cls.__new__ are not interned, thus still compare by their __dict__.
+    Snapshots and arenas intern the loaded types again (see snapshot._internLoaded).
+    """
+    def __call__(cls, *args, **kwargs):
+        key = (cls,) + cls._internKey(*args, **kwargs)
+        obj = _internedTypes.get(key)
+        if obj is None:
+            obj = type.__call__(cls, *args, **kwargs)
+            if len(_internedTypes) >= _InternedTypesMaxCount:
+                # Don't keep all the referenced objects (e.g. CStruct) alive forever.
+                # Equal types just won't be identical anymore, which is fine.
+                _internedTypes.clear()
+            _internedTypes[key] = obj
+        return obj
+
+
+class _InternedType(_InternedTypeMeta("_InternedTypeBase", (CType,), {})):
+    # The instances are shared, so they must not be modified after construction.
+    # Thus we can also cache the hash. It's in a slot, i.e. not in the __dict__ which we compare.
+    __slots__ = ("_hash",)
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = CType.__hash__(self)
+            return self._hash
+    @staticmethod
+    def _internKey():
+        return ()
+    def _internArgs(self):
+        return ()
+    def __reduce__(self):
+        return self.__class__, self._internArgs()
+
+
 class CUnknownType(CType):
     def asCCode(self, indent=""):
         return indent + "/* unknown */ int"
 
 
-class CVoidType(CType):
+class CVoidType(_InternedType):
     def __repr__(self): return "void"
     def getCType(self, stateStruct): return None
     def asCCode(self, indent=""): return indent + "void"
 
 
-class CVariadicArgsType(CType):
+class CVariadicArgsType(_InternedType):
     def getCType(self, stateStruct): return None
     def asCCode(self, indent=""): return indent + "..."
 
 
-class CPointerType(CType):
+class CPointerType(_InternedType):
     def __init__(self, ptr):
         super(CPointerType, self).__init__()
         self.pointerOf = ptr
+    @staticmethod
+    def _internKey(ptr):
+        return _internKeyOf(ptr),
+    def _internArgs(self):
+        return self.pointerOf,
 
     def getCType(self, stateStruct):
         try:
@@ -380,32 +501,47 @@ class CPointerType(CType):
     def asCCode(self, indent=""): return indent + asCCode(self.pointerOf) + "*"
 
 
-class CBuiltinType(CType):
+class CBuiltinType(_InternedType):
     def __init__(self, builtinType):
         super(CBuiltinType, self).__init__()
         assert isinstance(builtinType, tuple)
         self.builtinType = builtinType
+    @staticmethod
+    def _internKey(builtinType):
+        return builtinType,
+    def _internArgs(self):
+        return self.builtinType,
     def getCType(self, stateStruct):
         t = stateStruct.CBuiltinTypes[self.builtinType]
         return getCType(t, stateStruct)
     def asCCode(self, indent=""): return indent + " ".join(self.builtinType)
 
 
-class CStdIntType(CType):
+class CStdIntType(_InternedType):
     def __init__(self, name):
         super(CStdIntType, self).__init__()
         self.name = name
+    @staticmethod
+    def _internKey(name):
+        return name,
+    def _internArgs(self):
+        return self.name,
     def getCType(self, stateStruct):
         t = stateStruct.StdIntTypes[self.name]
         return getCType(t, stateStruct)
     def asCCode(self, indent=""): return indent + self.name
 
 
-class CArrayType(CType):
+class CArrayType(_InternedType):
     def __init__(self, arrayOf, arrayLen):
         super(CArrayType, self).__init__()
         self.arrayOf = arrayOf
         self.arrayLen = arrayLen
+    @staticmethod
+    def _internKey(arrayOf, arrayLen):
+        return _internKeyOf(arrayOf), _internKeyOf(arrayLen)
+    def _internArgs(self):
+        return self.arrayOf, self.arrayLen
     def getCType(self, stateStruct):
         try:
             t = getCType(self.arrayOf, stateStruct)
@@ -424,10 +560,79 @@ class CArrayType(CType):
     def asCCode(self, indent=""): return "%s%s[%s]" % (indent, asCCode(self.arrayOf), asCCode(self.arrayLen))
 
 
+_ctypeCacheGeneration = 0
+
+
+def invalidateCTypeCaches():
+    """
+    Clears all CTypeCache instances (lazily, on their next access).
+    Call this whenever the typedefs, structs, unions or enums of some State change,
+    e.g. when a pre-declared struct gets its definition.
+    """
+    global _ctypeCacheGeneration
+    _ctypeCacheGeneration += 1
+
+
+class CTypeCache(object):
+    """
+    Used by getCType. There is one per State (and CStateWrapper).
+    Maps C type objects (by identity, so no CType.__hash__) to their resolved ctypes type.
+    An entry is removed when its type object goes away.
+    """
+    NotCached = object()
+
+    def __init__(self):
+        self.generation = _ctypeCacheGeneration
+        self.types = {}  # id(t) -> (weakref to t, IndirectSimpleCTypes, ctype)
+
+    def clear(self):
+        self.generation = _ctypeCacheGeneration
+        self.types = {}  # don't clear in place, the weakref callbacks refer to the old dict
+
+    def get(self, t, indirect):
+        if self.generation != _ctypeCacheGeneration:
+            self.clear()
+            return self.NotCached
+        entry = self.types.get(id(t))
+        if entry is None or entry[1] != indirect or entry[0]() is not t:
+            return self.NotCached
+        return entry[2]
+
+    def add(self, t, indirect, ctype):
+        key = id(t)
+        types = self.types
+        def remove(ref):
+            entry = types.get(key)
+            if entry is not None and entry[0] is ref:
+                del types[key]
+        try:
+            ref = weakref.ref(t, remove)
+        except TypeError:  # e.g. some ctypes class without weakref support
+            return
+        types[key] = (ref, indirect, ctype)
+
+    def __len__(self):
+        return len(self.types)
+
+
 def getCType(t, stateStruct):
     """
     :type stateStruct: State
     """
+    cache = getattr(stateStruct, "_ctype_cache", None)
+    if cache is None:
+        return _getCType(t, stateStruct)
+    indirect = stateStruct.IndirectSimpleCTypes
+    ctype = cache.get(t, indirect)
+    if ctype is CTypeCache.NotCached:
+        ctype = _getCType(t, stateStruct)
+        # While constructing a struct, we might get incomplete types (see _getCTypeStruct).
+        if not stateStruct._construct_struct_type_stack:
+            cache.add(t, indirect, ctype)
+    return ctype
+
+
+def _getCType(t, stateStruct):
     assert not isinstance(t, CUnknownType)
     try:
         if issubclass(t, (_ctypes._SimpleCData,ctypes._Pointer,ctypes._CFuncPtr)):
@@ -461,6 +666,7 @@ def getCTypeWrapped(t, stateStruct):
 
 
 def isSameType(stateStruct, type1, type2):
+    if type1 is type2: return True  # see _InternedType
     ctype1 = getCType(type1, stateStruct)
     ctype2 = getCType(type2, stateStruct)
     return ctype1 == ctype2
@@ -524,6 +730,12 @@ class State(object):
         "uintptr_t": ctypes.c_ulong,
         "FILE": ctypes.c_int, # NOTE: not really correct but shouldn't matter unless we directly access it
     }
+    ReadBlockSize = 64 * 1024  # in chars. see readLocalInclude
+    UseTokenArray = False  # whether parse() materializes the tokens into a CTokenArray
+    # What cpre3_parse does with function bodies:
+    # "parse" -> CBody; "tokens" -> CFuncBodyTokens, parsed on first access (or via CFunc.parseBody,
+    # e.g. by Interpreter.getFunc); "skip" -> CFuncBodyTokens without tokens
+    FuncBodyMode = "parse"
     Attribs = [
         "const",
         "extern",
@@ -547,13 +759,23 @@ class State(object):
         self.enumconsts = {} # name -> CEnumConst
         self.contentlist = []
         self._preprocessIfLevels = []
-        self._preprocessIgnoreCurrent = False
         # 0->didnt got true yet, 1->in true part, 2->after true part. and that as a stack
+        self._preprocessInactiveDepth = 0  # number of entries in _preprocessIfLevels which are not 1
+        self._preprocessIgnoreCurrent = False  # _preprocessInactiveDepth > 0
         self._preprocessIncludeLevel = []
         self._errors = []
         self._global_include_wrapper = None  # type: typing.Optional[globalincludewrappers.Wrapper]
         self._global_include_list = []
         self._construct_struct_type_stack = []  # via _getCTypeStruct
+        self._include_guards = {}  # fullfilename -> macro name of the include guard. see preprocess_file
+        self._include_once = set()  # fullfilenames with `#pragma once`
+        self._preprocess_cond_trees = {}  # condition str -> compiled tree. see cpreprocess_evaluate_cond
+        self._preprocess_cond_results = {}  # condition str -> (value, macro deps)
+        self._tokens = {}  # identifier or op str -> shared token instance. see cpre2_parse
+        self._cpre3_tokenArray = None  # the CTokenArray which cpre3_parse is reading, for curPosAsStr
+        self._cpre3_scopes = CScopeSymbols()  # see cpre3_parse_body
+        self._ctype_cache = CTypeCache()  # see getCType
+        self._contributions = None  # see incremental.IncrementalParser
 
     @classmethod
     def getDictNameForType(cls, objType):
@@ -592,6 +814,16 @@ class State(object):
         self._global_include_wrapper = Wrapper(self)
         self._global_include_wrapper.install()
 
+    def loadSnapshotBundle(self, filename, validate=True):
+        """
+        :param str filename: bundle of parsed headers, see snapshot.buildBundle
+        :param bool validate: raise snapshot.BundleOutdated if some of the headers changed,
+            or if the bundle was built with other macros than the current ones of this state
+            (e.g. set up via autoSetupSystemMacros)
+        """
+        from .snapshot import loadBundle
+        loadBundle(filename, state=self, validate=validate, macros=self.macros)
+
     def incIncludeLineChar(self, fullfilename=None, inc=None, line=None, char=None, charMod=None):
         CharStartIndex = 0
         LineStartIndex = 1
@@ -609,7 +841,31 @@ class State(object):
                 c = c - (c - CharStartIndex) % charMod + CharStartIndex
             self._preprocessIncludeLevel[-1][3] = c
 
+    def incIncludeLineCharByStr(self, s):
+        """
+        :param str s: consumed input
+        Like calling incIncludeLineChar for every char in s, which is what cpreprocess_parse did before.
+        """
+        if not s: return
+        if len(self._preprocessIncludeLevel) == 0:
+            self.incIncludeLineChar()
+        l = self._preprocessIncludeLevel[-1]
+        numNewlines = s.count("\n")
+        if numNewlines:
+            l[2] += numNewlines
+            l[3] = 0
+            s = s[s.rindex("\n") + 1:]
+        if "\t" in s:
+            c = l[3]
+            for x in s:
+                if x == "\t": c = (c + 4) - (c + 4) % 4
+                else: c += 1
+            l[3] = c
+        else:
+            l[3] += len(s)
+
     def curPosAsStr(self):
+        if self._cpre3_tokenArray is not None: return self._cpre3_tokenArray.curPosAsStr()
         if len(self._preprocessIncludeLevel) == 0: return "<out-of-scope>"
         l = self._preprocessIncludeLevel[-1]
         return ":".join([l[1], str(l[2]), str(l[3])])
@@ -646,22 +902,25 @@ class State(object):
     def readLocalInclude(self, filename):
         """
         :param str filename:
+        :return: reader over blocks of the file content, and the full filename
         :rtype: (typing.Iterable[str],str)
         """
         fullfilename = self.findIncludeFullFilename(filename, True)
 
         try:
-            import codecs
-            f = codecs.open(fullfilename, "r", self.encoding)
+            import io
+            # newline="" to keep the content as-is, like codecs.open did.
+            f = io.open(fullfilename, "r", encoding=self.encoding, newline="")
         except Exception as e:
             self.error("cannot open local include-file '" + filename + "': " + str(e))
             return "", None
 
         def reader():
-            while True:
-                c = f.read(1)
-                if len(c) == 0: break
-                yield c
+            with f:
+                while True:
+                    block = f.read(self.ReadBlockSize)
+                    if len(block) == 0: break
+                    yield block
         reader = reader()
 
         return reader, fullfilename
@@ -677,14 +936,28 @@ class State(object):
             self.error("no handler for global include-file '" + filename + "'")
             return "", None
 
+    def isLocalIncludeSkipped(self, filename):
+        """
+        :param str filename:
+        :return: whether we don't need to read the file again because of `#pragma once`
+          or because of its include guard (which is still defined)
+        :rtype: bool
+        """
+        fullfilename = self.findIncludeFullFilename(filename, True)
+        if fullfilename in self._include_once: return True
+        guard = self._include_guards.get(fullfilename)
+        if guard is not None and guard in self.macros: return True
+        return False
+
     def preprocess_file(self, filename, local):
         """
         :param str filename:
         :param bool local:
-        :return: yields chars
+        :return: yields str chunks
         :rtype: typing.Generator[str]
         """
         if local:
+            if self.isLocalIncludeSkipped(filename): return
             reader, fullfilename = self.readLocalInclude(filename)
         else:
             reader, fullfilename = self.readGlobalInclude(filename)
@@ -696,7 +969,7 @@ class State(object):
         """
         :param str source_code:
         :param str dummy_filename:
-        :return: yields chars
+        :return: yields str chunks
         :rtype: typing.Generator[str]
         """
         for c in self.preprocess(source_code, dummy_filename, dummy_filename):
@@ -707,12 +980,17 @@ class State(object):
         :param reader:
         :param str|None fullfilename:
         :param str filename:
-        :return: yields chars
+        :return: yields str chunks
         :rtype: typing.Generator[str]
         """
         self.incIncludeLineChar(fullfilename=fullfilename, inc=filename)
-        for c in cpreprocess_parse(self, reader):
+        includeGuard = _IncludeGuardTracker() if fullfilename else None
+        for c in cpreprocess_parse(self, reader, includeGuard=includeGuard):
             yield c
+        if includeGuard is not None and includeGuard.getMacroName():
+            old = self._include_guards.get(fullfilename)
+            self._include_guards[fullfilename] = includeGuard.getMacroName()
+            _recordStateChange(self, "_include_guards", fullfilename, old)
         self._preprocessIncludeLevel = self._preprocessIncludeLevel[:-1]
 
     def depth(self): return 0
@@ -740,351 +1018,303 @@ def cpreprocess_evaluate_ifdef(state, arg):
     return arg in state.macros
 
 
-def cpreprocess_evaluate_single(state, arg):
-    if arg == "": return None
-    try: return int(arg) # is integer?
-    except ValueError: pass
-    try: return long(arg) # is long?
-    except ValueError: pass
-    try: return int(arg, 16) # is hex?
-    except ValueError: pass
-    if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"': return arg[1:-1] # is string?
+class CPreprocessorCondError(Exception): pass
 
-    if not is_valid_defname(arg):
-        state.error("preprocessor eval single: '" + arg + "' is not a valid macro name")
-        return 0
-    if arg not in state.macros:
-        # This is not an error.
-        return 0
+
+_cpreprocess_cond_token_re = re.compile(
+    r"\s*(?:"
+    r"(?P<number>[0-9][0-9A-Za-z_]*)|"
+    r"(?P<identifier>[A-Za-z_][0-9A-Za-z_]*)|"
+    r"(?P<str>\"(?:[^\"\\]|\\.)*\")|"
+    r"(?P<char>'(?:[^'\\]|\\.)*')|"
+    r"(?P<bracket>[()])|"
+    r"(?P<op>[" + re.escape(OpChars) + r"]+))")
+
+# We don't allow assignments and such.
+_cpreprocess_cond_binops = {
+    op for op in OpBinFuncs if op not in OpsRightToLeft}
+_cpreprocess_cond_prefixops = {"+", "-", "!", "~"}
+
+
+def _cpreprocess_tokenize_cond(condstr):
+    """
+    :param str condstr:
+    :return: list of (kind, value, start pos, end pos)
+    :rtype: list[(str,str,int,int)]
+    """
+    tokens = []
+    pos = 0
+    condstr = condstr.rstrip()
+    while pos < len(condstr):
+        m = _cpreprocess_cond_token_re.match(condstr, pos)
+        if not m:
+            raise CPreprocessorCondError("invalid char %r in %r" % (condstr[pos:].lstrip()[:1], condstr))
+        kind = m.lastgroup
+        if kind == "op":
+            # Split it up into the longest known ops.
+            opstr = m.group(kind)
+            start = m.start(kind)
+            while opstr:
+                n = 3
+                while n > 1 and opstr[:n] not in LongOps: n -= 1
+                tokens.append(("op", opstr[:n], start, start + n))
+                opstr = opstr[n:]
+                start += n
+        else:
+            tokens.append((kind, m.group(kind), m.start(kind), m.end(kind)))
+        pos = m.end()
+    return tokens
+
+
+class _CPreprocessorCondParser(object):
+    """
+    Precedence climbing parser for #if conditions, based on OpPrecedences.
+    The resulting tree consists of tuples:
+      ("value", v), ("identifier", name), ("defined", name), ("call", name, [raw arg str]),
+      ("prefix", op, sub), ("binop", op, a, b), ("?:", cond, a, b).
+    """
+
+    def __init__(self, condstr):
+        self.condstr = condstr
+        self.tokens = _cpreprocess_tokenize_cond(condstr)
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise CPreprocessorCondError("empty condition")
+        tree = self.parse_expr(OpPrecedences[","])
+        if self.pos < len(self.tokens):
+            raise CPreprocessorCondError("unexpected %r in %r" % (self.tokens[self.pos][1], self.condstr))
+        return tree
+
+    def peek(self):
+        if self.pos < len(self.tokens): return self.tokens[self.pos]
+        return None, None, len(self.condstr), len(self.condstr)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise CPreprocessorCondError("unexpected end of %r" % self.condstr)
+        self.pos += 1
+        return token
+
+    def expect(self, kind, value):
+        token = self.next()
+        if token[0] != kind or token[1] != value:
+            raise CPreprocessorCondError("expected %r but got %r in %r" % (value, token[1], self.condstr))
+
+    def parse_expr(self, maxPrecedence):
+        """
+        :param int maxPrecedence: only handle binary ops with precedence <= this
+        """
+        tree = self.parse_unary()
+        while True:
+            kind, op, _, _ = self.peek()
+            if kind != "op" or op not in OpPrecedences or OpPrecedences[op] > maxPrecedence:
+                return tree
+            if op == "?":
+                self.next()
+                a = self.parse_expr(OpPrecedences[","])
+                self.expect("op", ":")
+                b = self.parse_expr(OpPrecedences["?"])  # right-to-left
+                tree = ("?:", tree, a, b)
+            elif op in _cpreprocess_cond_binops:
+                self.next()
+                tree = ("binop", op, tree, self.parse_expr(OpPrecedences[op] - 1))
+            else:
+                raise CPreprocessorCondError("invalid op %r in %r" % (op, self.condstr))
+
+    def parse_unary(self):
+        kind, value, start, end = self.next()
+        if kind == "op":
+            if value not in _cpreprocess_cond_prefixops:
+                raise CPreprocessorCondError("invalid prefix op %r in %r" % (value, self.condstr))
+            return ("prefix", value, self.parse_unary())
+        if kind == "bracket":
+            if value != "(":
+                raise CPreprocessorCondError("runaway ')' in %r" % self.condstr)
+            tree = self.parse_expr(OpPrecedences[","])
+            self.expect("bracket", ")")
+            return tree
+        if kind == "number":
+            s = value.rstrip("ULul")
+            try:
+                if len(s) > 1 and s[0] == "0" and s[1] in "xX": return ("value", int(s, 16))
+                if len(s) > 1 and s[0] == "0": return ("value", int(s, 8))
+                return ("value", int(s))
+            except ValueError:
+                raise CPreprocessorCondError("invalid number %r in %r" % (value, self.condstr))
+        if kind == "str":
+            return ("value", "".join(self._unescape(value[1:-1])))
+        if kind == "char":
+            chars = self._unescape(value[1:-1])
+            if len(chars) != 1:
+                raise CPreprocessorCondError("invalid char %s in %r" % (value, self.condstr))
+            return ("value", ord(chars[0]))
+        assert kind == "identifier"
+        if value == "defined":
+            bracket = self.peek()[:2] == ("bracket", "(")
+            if bracket: self.next()
+            kind, macroname, _, _ = self.next()
+            if kind != "identifier":
+                raise CPreprocessorCondError("'defined' invalid in %r" % self.condstr)
+            if bracket: self.expect("bracket", ")")
+            return ("defined", macroname)
+        if self.peek()[:2] == ("bracket", "("):
+            return ("call", value, self.parse_call_args())
+        return ("identifier", value)
+
+    def parse_call_args(self):
+        self.expect("bracket", "(")
+        args = []
+        level = 0
+        argStart = self.peek()[2]
+        while True:
+            kind, value, start, end = self.next()
+            if kind == "bracket" and value == "(":
+                level += 1
+            elif kind == "bracket" and value == ")":
+                if level == 0:
+                    arg = self.condstr[argStart:start].strip()
+                    if arg or args: args.append(arg)
+                    return args
+                level -= 1
+            elif kind == "op" and value == "," and level == 0:
+                args.append(self.condstr[argStart:start].strip())
+                argStart = end
+
+    @staticmethod
+    def _unescape(s):
+        chars = []
+        i = 0
+        while i < len(s):
+            if s[i] == "\\" and i + 1 < len(s):
+                chars.append(simple_escape_char(s[i + 1]))
+                i += 2
+            else:
+                chars.append(s[i])
+                i += 1
+        return [c for c in chars if c]
+
+
+def _cpreprocess_compile_cond(stateStruct, condstr):
+    """
+    :param State stateStruct: the compiled conditions are cached there
+    :param str condstr:
+    :return: the tree, see _CPreprocessorCondParser
+    """
+    cache = stateStruct._preprocess_cond_trees
+    if condstr in cache:
+        tree = cache[condstr]
+    else:
+        try:
+            tree = _CPreprocessorCondParser(condstr).parse()
+        except CPreprocessorCondError as e:
+            tree = e
+        except AssertionError as e:  # e.g. from simple_escape_char
+            tree = CPreprocessorCondError(str(e))
+        cache[condstr] = tree
+    if isinstance(tree, CPreprocessorCondError):
+        raise tree
+    return tree
+
+
+def _cIntDiv(a, b):
+    # C truncates toward zero, while Python's // rounds down.
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0): return -q
+    return q
+
+
+# Like OpBinFuncs, but the integer arithmetic like in C.
+_CPreprocessorCondBinFuncs = dict(OpBinFuncs)
+_CPreprocessorCondBinFuncs["/"] = _cIntDiv
+_CPreprocessorCondBinFuncs["%"] = lambda a, b: a - b * _cIntDiv(a, b)
+
+
+def _cpreprocess_eval_tree(stateStruct, tree, deps, depth=0):
+    """
+    :param State stateStruct:
+    :param tuple tree: from _CPreprocessorCondParser
+    :param list[(str,Macro|None)] deps: we add all macros which we access
+    :param int depth: macro expansion depth
+    """
+    kind = tree[0]
+    if kind == "value":
+        return tree[1]
+    if kind == "binop":
+        op = tree[1]
+        a = _cpreprocess_eval_tree(stateStruct, tree[2], deps, depth)
+        # Short-circuit evaluation.
+        if op == "&&" and not a: return a
+        if op == "||" and a: return a
+        b = _cpreprocess_eval_tree(stateStruct, tree[3], deps, depth)
+        if op in ("/", "%") and not b:
+            raise CPreprocessorCondError("division by zero")
+        return _CPreprocessorCondBinFuncs[op](a, b)
+    if kind == "prefix":
+        return OpPrefixFuncs[tree[1]](_cpreprocess_eval_tree(stateStruct, tree[2], deps, depth))
+    if kind == "?:":
+        if _cpreprocess_eval_tree(stateStruct, tree[1], deps, depth):
+            return _cpreprocess_eval_tree(stateStruct, tree[2], deps, depth)
+        return _cpreprocess_eval_tree(stateStruct, tree[3], deps, depth)
+    macroname = tree[1]
+    # Note: Access the macros only via `in` and `[]`, so that caching.StateWrapper can track it.
+    macro = stateStruct.macros[macroname] if macroname in stateStruct.macros else None
+    deps.append((macroname, macro))
+    if kind == "defined":
+        if macroname in ("__FILE__", "__LINE__"): return True
+        return macro is not None
+    if kind == "identifier":
+        if macro is None: return 0  # This is not an error.
+        args = ()
+    else:
+        assert kind == "call"
+        if macro is None:
+            raise CPreprocessorCondError("call: '" + macroname + "' is unknown")
+        args = tree[2]
+    if depth > 100:
+        raise CPreprocessorCondError("macro expansion too deep in '" + macroname + "'")
     try:
-        resolved = state.macros[arg]()
+        resolved = macro.eval(stateStruct, args)
     except Exception as e:
-        state.error("preprocessor eval single error on '" + arg + "': " + str(e))
-        return 0
-    return cpreprocess_evaluate_cond(state, resolved)
+        raise CPreprocessorCondError("error on '" + macroname + "': " + str(e))
+    if not resolved.strip(): return 0  # e.g. `#define X` and then `#if X`
+    return _cpreprocess_eval_tree(stateStruct, _cpreprocess_compile_cond(stateStruct, resolved), deps, depth + 1)
 
 
 def cpreprocess_evaluate_cond(stateStruct, condstr):
-    state = 0
-    bracketLevel = 0
-    substr = ""
-    laststr = ""
-    lasteval = None
-    op = None
-    prefixOp = None
-    opstr = ""
-    args = []
-    i = 0
-    while i < len(condstr):
-        c = condstr[i]
-        i += 1
-        breakLoop = False
-        while not breakLoop:
-            breakLoop = True
+    """
+    :param State stateStruct:
+    :param str condstr: the condition of #if or #elif
+    :return: the value of the condition, or None on error
+    The conditions are compiled only once, and we also cache the result
+    together with the macros which it depends on.
+    """
+    condstr = condstr or ""
+    cache = stateStruct._preprocess_cond_results
+    if condstr in cache:
+        value, deps = cache[condstr]
+        for macroname, macro in deps:
+            if macroname in stateStruct.macros:
+                if stateStruct.macros[macroname] is not macro: break
+            elif macro is not None: break
+        else:
+            return value
+    deps = []
+    try:
+        value = _cpreprocess_eval_tree(stateStruct, _cpreprocess_compile_cond(stateStruct, condstr), deps)
+    except CPreprocessorCondError as e:
+        stateStruct.error("preprocessor eval: " + str(e))
+        return None
+    cache[condstr] = (value, deps)
+    return value
 
-            if state == 0:
-                if c == "(":
-                    if laststr == "":
-                        state = 1
-                        bracketLevel = 1
-                    else:
-                        state = 10
-                        breakLoop = False
-                elif c == ")":
-                    stateStruct.error("preprocessor: runaway ')' in " + repr(condstr))
-                    return
-                elif c in SpaceChars:
-                    if laststr == "defined": state = 5
-                    elif laststr != "": state = 10
-                    else: pass
-                elif c in OpChars:
-                    state = 10
-                    breakLoop = False
-                elif c == '"':
-                    if laststr == "":
-                        state = 20
-                    else:
-                        stateStruct.error("preprocessor: '\"' not expected")
-                        return
-                elif c == "'":
-                    if laststr == "":
-                        state = 22
-                    else:
-                        stateStruct.error("preprocessor: \"'\" not expected")
-                        return
-                else:
-                    laststr += c
-            elif state == 1: # in bracket
-                if c == "(":
-                    bracketLevel += 1
-                if c == ")":
-                    bracketLevel -= 1
-                    if bracketLevel == 0:
-                        neweval = cpreprocess_evaluate_cond(stateStruct, substr)
-                        state = 18
-                        if prefixOp is not None:
-                            neweval = prefixOp(neweval)
-                            prefixOp = None
-                        if op is not None: lasteval = op(lasteval, neweval)
-                        else: lasteval = neweval
-                        substr = ""
-                    else: # bracketLevel > 0
-                        substr += c
-                elif c == '"':
-                    state = 2
-                    substr += c
-                else:
-                    substr += c
-            elif state == 2: # in str in bracket
-                substr += c
-                if c == "\\": state = 3
-                elif c == '"': state = 1
-                else: pass
-            elif state == 3: # in escape in str in bracket
-                substr += c
-                state = 2
-            elif state == 5: # after "defined" without brackets (yet)
-                if c in SpaceChars: pass
-                elif c == "(":
-                    state = 10
-                    breakLoop = False
-                elif c == ")":
-                    stateStruct.error("preprocessor eval: 'defined' invalid in '" + condstr + "'")
-                    return
-                else:
-                    laststr = c
-                    state = 6
-            elif state == 6: # chars after "defined"
-                if c in LetterChars + "_" + NumberChars:
-                    laststr += c
-                else:
-                    macroname = laststr
-                    if not is_valid_defname(macroname):
-                        stateStruct.error("preprocessor eval defined-check: '" + macroname + "' is not a valid macro name")
-                        return
-                    neweval = macroname in stateStruct.macros
-                    if prefixOp is not None:
-                        neweval = prefixOp(neweval)
-                        prefixOp = None
-                    oldlast = lasteval
-                    if op is not None: lasteval = op(lasteval, neweval)
-                    else: lasteval = neweval
-                    opstr = ""
-                    laststr = ""
-                    state = 18
-                    breakLoop = False
-            elif state == 10: # after identifier
-                if c in SpaceChars: pass
-                elif c in OpChars:
-                    if laststr != "":
-                        neweval = cpreprocess_evaluate_single(stateStruct, laststr)
-                        if prefixOp is not None:
-                            neweval = prefixOp(neweval)
-                            prefixOp = None
-                        if op is not None: lasteval = op(lasteval, neweval)
-                        else: lasteval = neweval
-                        laststr = ""
-                    opstr = ""
-                    state = 18
-                    breakLoop = False
-                elif c == "(":
-                    state = 11
-                    bracketLevel = 1
-                    args = []
-                else:
-                    stateStruct.error("preprocessor eval: '" + c + "' not expected after '" + laststr + "' in state 10 with '" + condstr + "'")
-                    return
-            elif state == 11: # after "(" after identifier
-                if c == "(":
-                    if len(args) == 0: args = [""]
-                    args[-1] += c
-                    bracketLevel += 1
-                    state = 12
-                elif c == ")":
-                    macroname = laststr
-                    if macroname == "defined":
-                        if len(args) != 1:
-                            stateStruct.error("preprocessor eval defined-check args invalid: " + str(args))
-                            return
-                        else:
-                            macroname = args[0]
-                            if not is_valid_defname(macroname):
-                                stateStruct.error("preprocessor eval defined-check: '" + macroname + "' is not a valid macro name")
-                                return
-                            neweval = macroname in stateStruct.macros
-                    else:
-                        if not is_valid_defname(macroname):
-                            stateStruct.error("preprocessor eval call: '" + macroname + "' is not a valid macro name in " + repr(condstr))
-                            return
-                        if macroname not in stateStruct.macros:
-                            stateStruct.error("preprocessor eval call: '" + macroname + "' is unknown")
-                            return
-                        macro = stateStruct.macros[macroname]
-                        try:
-                            resolved = macro.eval(stateStruct, args)
-                        except Exception as e:
-                            stateStruct.error("preprocessor eval call on '" + macroname + "': error " + str(e))
-                            return
-                        neweval = cpreprocess_evaluate_cond(stateStruct, resolved)
-
-                    if prefixOp is not None:
-                        neweval = prefixOp(neweval)
-                        prefixOp = None
-                    oldlast = lasteval
-                    if op is not None: lasteval = op(lasteval, neweval)
-                    else: lasteval = neweval
-                    #print "after ):", laststr, args, neweval, op.func_code.co_firstlineno if op else "no-op", oldlast, "->", lasteval
-                    laststr = ""
-                    opstr = ""
-                    state = 18
-                elif c == '"':
-                    if len(args) == 0: args = [""]
-                    args[-1] += c
-                    state = 13
-                elif c == ",": args += [""]
-                else:
-                    if len(args) == 0: args = [""]
-                    args[-1] += c
-            elif state == 12: # in additional "(" after "(" after identifier
-                args[-1] += c
-                if c == "(": bracketLevel += 1
-                elif c == ")":
-                    bracketLevel -= 1
-                    if bracketLevel == 1: state = 11
-                elif c == '"': state = 13
-                else: pass
-            elif state == 13: # in str after "(" after identifier
-                args[-1] += c
-                if c == "\\": state = 14
-                elif c == '"':
-                    if bracketLevel > 1: state = 12
-                    else: state = 11
-                else: pass
-            elif state == 14: # in escape in str after "(" after identifier
-                args[-1] += c
-                state = 13
-            elif state == 18: # op after identifier/expression
-                if c in OpChars: opstr += c
-                else:
-                    if opstr == "":
-                        if c in SpaceChars: pass
-                        else:
-                            stateStruct.error("preprocessor eval: expected op but got '" + c + "' in '" + condstr + "' in state 18")
-                            return
-                    else:
-                        if opstr == "&&":
-                            op = lambda x,y: x and y
-                            # short path check
-                            if not lasteval: return lasteval
-                        elif opstr == "||":
-                            op = lambda x,y: x or y
-                            # short path check
-                            if lasteval: return lasteval
-                        elif opstr in OpBinFuncs:
-                            op = OpBinFuncs[opstr]
-                            # HACK: add "()" in some way...
-                            j = i
-                            while j < len(condstr):
-                                if condstr[j] == "'":
-                                    j += 1
-                                    while j < len(condstr):
-                                        if condstr[j] == "'": break
-                                        if condstr[j] == "\\": j += 1
-                                        j += 1
-                                    continue
-                                if condstr[j] == '"':
-                                    j += 1
-                                    while j < len(condstr):
-                                        if condstr[j] == '"': break
-                                        if condstr[j] == "\\": j += 1
-                                        j += 1
-                                    continue
-                                if condstr[j] in OpChars:
-                                    nextopstr = ""
-                                    while j < len(condstr) and condstr[j] in OpChars:
-                                        nextopstr += condstr[j]
-                                        j += 1
-                                    if nextopstr in OpBinFuncs:
-                                        if OpPrecedences[opstr] > OpPrecedences[nextopstr]:
-                                            condstr = condstr[:i] + "(" + condstr[i:] + ")"
-                                    #if j < len(condstr):
-                                    #	condstr = condstr[:j] + "(" + condstr[j:] + ")"
-                                    break
-                                j += 1
-                        elif opstr in OpPrefixFuncs:
-                            newprefixop = OpPrefixFuncs[opstr]
-                            if prefixOp: prefixOp = lambda x: prefixOp(newprefixop(x))
-                            else: prefixOp = newprefixop
-                        else:
-                            stateStruct.error("invalid op '" + opstr + "' with '" + c + "' following in '" + condstr + "'")
-                            return
-                        opstr = ""
-                        laststr = ""
-                        state = 0
-                        breakLoop = False
-            elif state == 20: # in str
-                if c == "\\": state = 21
-                elif c == '"':
-                    state = 0
-                    neweval = laststr
-                    laststr = ""
-                    if prefixOp is not None:
-                        neweval = prefixOp(neweval)
-                        prefixOp = None
-                    if op is not None: lasteval = op(lasteval, neweval)
-                    else: lasteval = neweval
-                else: laststr += c
-            elif state == 21: # in escape in str
-                laststr += simple_escape_char(c)
-                state = 20
-            elif state == 22: # in char
-                if c == "\\": state = 23
-                elif c == "'":
-                    state = 0
-                    neweval = laststr
-                    laststr = ""
-                    if prefixOp is not None:
-                        neweval = prefixOp(neweval)
-                        prefixOp = None
-                    if op is not None: lasteval = op(lasteval, neweval)
-                    else: lasteval = neweval
-                else: laststr += c
-            elif state == 23: # in escape in char
-                laststr += simple_escape_char(c)
-                state = 22
-            else:
-                stateStruct.error("internal error in preprocessor evaluation: state " + str(state))
-                return
 
-    if state in (0,10):
-        if laststr != "":
-            neweval = cpreprocess_evaluate_single(stateStruct, laststr)
-            if prefixOp is not None:
-                neweval = prefixOp(neweval)
-                prefixOp = None
-            if op is not None: lasteval = op(lasteval, neweval)
-            else: lasteval = neweval
-    elif state == 6:
-        macroname = laststr
-        if not is_valid_defname(macroname):
-            stateStruct.error("preprocessor eval defined-check: '" + macroname + "' is not a valid macro name")
-            return
-        neweval = macroname in stateStruct.macros
-        if prefixOp is not None:
-            neweval = prefixOp(neweval)
-            prefixOp = None
-        oldlast = lasteval
-        if op is not None: lasteval = op(lasteval, neweval)
-        else: lasteval = neweval
-    elif state == 18: # expected op
-        if opstr != "":
-            stateStruct.error("preprocessor eval: unfinished op: '" + opstr + "'")
-        else: pass
-    else:
-        stateStruct.error("preprocessor eval: invalid argument: '" + condstr + "'. unfinished state " + str(state))
+def cpreprocess_evaluate_single(state, arg):
+    if arg == "": return None
+    return cpreprocess_evaluate_cond(state, arg)
 
-    #print "eval:", condstr, "->", lasteval
-    return lasteval
 
 def cpreprocess_handle_include(state, arg):
     arg = arg.strip()
@@ -1134,8 +1364,10 @@ def cpreprocess_handle_def(stateStruct, arg):
                           " previously defined at " + stateStruct.macros[macroname].defPos)
         # pass through to use new definition
 
+    old = stateStruct.macros.get(macroname)
     macro = Macro(stateStruct, macroname, args, rightside)
     stateStruct.macros[macroname] = macro
+    _recordStateChange(stateStruct, "macros", macroname, old)
     return macro
 
 
@@ -1147,57 +1379,69 @@ def cpreprocess_handle_undef(state, arg):
     if not arg in state.macros:
         # This is not an error. Just ignore.
         return
+    old = state.macros[arg]
     state.macros.pop(arg)
+    _recordStateChange(state, "macros", arg, old)
+
+
+def _cpreprocess_set_if_level(state, value):
+    """
+    Sets the top of state._preprocessIfLevels and keeps state._preprocessInactiveDepth in sync.
+    """
+    old = state._preprocessIfLevels[-1]
+    state._preprocessIfLevels[-1] = value
+    state._preprocessInactiveDepth += int(value != 1) - int(old != 1)
+
+
+def _cpreprocess_outer_inactive(state):
+    """
+    :return: whether any but the top of state._preprocessIfLevels is inactive
+    :rtype: bool
+    """
+    return state._preprocessInactiveDepth - int(state._preprocessIfLevels[-1] != 1) > 0
 
 
 def handle_cpreprocess_cmd(state, cmd, arg):
     #if not state._preprocessIgnoreCurrent:
     #	print "cmd", cmd, arg
 
-    if cmd == "ifdef":
-        state._preprocessIfLevels += [0]
-        if any(map(lambda x: x != 1, state._preprocessIfLevels[:-1])): return # we don't really care
-        check = cpreprocess_evaluate_ifdef(state, arg)
-        if check: state._preprocessIfLevels[-1] = 1
-
-    elif cmd == "ifndef":
-        state._preprocessIfLevels += [0]
-        if any(map(lambda x: x != 1, state._preprocessIfLevels[:-1])): return # we don't really care
-        check = not cpreprocess_evaluate_ifdef(state, arg)
-        if check: state._preprocessIfLevels[-1] = 1
-
-    elif cmd == "if":
-        state._preprocessIfLevels += [0]
-        if any(map(lambda x: x != 1, state._preprocessIfLevels[:-1])): return # we don't really care
-        check = cpreprocess_evaluate_cond(state, arg)
-        if check: state._preprocessIfLevels[-1] = 1
+    if cmd in ("ifdef", "ifndef", "if"):
+        outerInactive = state._preprocessInactiveDepth > 0
+        state._preprocessIfLevels.append(0)
+        state._preprocessInactiveDepth += 1
+        if outerInactive: return # we don't really care
+        if cmd == "ifdef": check = cpreprocess_evaluate_ifdef(state, arg)
+        elif cmd == "ifndef": check = not cpreprocess_evaluate_ifdef(state, arg)
+        else: check = cpreprocess_evaluate_cond(state, arg)
+        if check: _cpreprocess_set_if_level(state, 1)
 
     elif cmd == "elif":
-        if any(map(lambda x: x != 1, state._preprocessIfLevels[:-1])): return # we don't really care
         if len(state._preprocessIfLevels) == 0:
             state.error("preprocessor: elif without if")
             return
+        if _cpreprocess_outer_inactive(state): return # we don't really care
         if state._preprocessIfLevels[-1] >= 1:
-            state._preprocessIfLevels[-1] = 2 # we already had True
+            _cpreprocess_set_if_level(state, 2) # we already had True
         else:
             check = cpreprocess_evaluate_cond(state, arg)
-            if check: state._preprocessIfLevels[-1] = 1
+            if check: _cpreprocess_set_if_level(state, 1)
 
     elif cmd == "else":
-        if any(map(lambda x: x != 1, state._preprocessIfLevels[:-1])): return # we don't really care
         if len(state._preprocessIfLevels) == 0:
             state.error("preprocessor: else without if")
             return
+        if _cpreprocess_outer_inactive(state): return # we don't really care
         if state._preprocessIfLevels[-1] >= 1:
-            state._preprocessIfLevels[-1] = 2 # we already had True
+            _cpreprocess_set_if_level(state, 2) # we already had True
         else:
-            state._preprocessIfLevels[-1] = 1
+            _cpreprocess_set_if_level(state, 1)
 
     elif cmd == "endif":
         if len(state._preprocessIfLevels) == 0:
             state.error("preprocessor: endif without if")
             return
-        state._preprocessIfLevels = state._preprocessIfLevels[0:-1]
+        if state._preprocessIfLevels.pop() != 1:
+            state._preprocessInactiveDepth -= 1
 
     elif cmd == "include":
         if state._preprocessIgnoreCurrent: return
@@ -1212,7 +1456,13 @@ def handle_cpreprocess_cmd(state, cmd, arg):
         cpreprocess_handle_undef(state, arg)
 
     elif cmd == "pragma":
-        pass # ignore at all right now
+        if state._preprocessIgnoreCurrent: return
+        if (arg or "").strip() == "once":
+            fullfilename = state._preprocessIncludeLevel[-1][0] if state._preprocessIncludeLevel else None
+            if fullfilename and fullfilename not in state._include_once:
+                state._include_once.add(fullfilename)
+                _recordStateChange(state, "_include_once", fullfilename, None)
+        # ignore everything else right now
 
     elif cmd == "error":
         if state._preprocessIgnoreCurrent: return # we don't really care
@@ -1226,14 +1476,106 @@ def handle_cpreprocess_cmd(state, cmd, arg):
         if state._preprocessIgnoreCurrent: return # we don't really care
         state.error("preprocessor command " + cmd + " unknown")
 
-    state._preprocessIgnoreCurrent = any(map(lambda x: x != 1, state._preprocessIfLevels))
+    state._preprocessIgnoreCurrent = state._preprocessInactiveDepth > 0
+
+
+# Spans which cpreprocess_parse can handle in one go, depending on its state.
+# Spans which get yielded end at a newline, so that the line in the state
+# (e.g. used by __LINE__) is correct while the consumer handles it.
+# In state 0, this also covers complete str and char literals on the same line.
+_cpreprocess_plain_re = re.compile(
+    r"(?:[^#/\"'\n]|\"(?:[^\"\\\n]|\\.)*\"|'(?:[^'\\\n]|\\.)*')*\n?")  # state 0
+_cpreprocess_str_re = re.compile(r"[^\"\\\n]*\n?")  # state 10
+_cpreprocess_char_re = re.compile(r"[^'\\\n]*\n?")  # state 12
+_cpreprocess_span_res = {0: _cpreprocess_plain_re, 10: _cpreprocess_str_re, 12: _cpreprocess_char_re}
+# cpre2_parse finishes a token when it reads the char after it (e.g. ";" after an identifier),
+# and then the position must be the one of that char. So we yield spans of state 0 in pieces
+# which end at such chars: all chars except of identifier chars and whitespace,
+# the first whitespace after something else, and an identifier char after an op
+# (or at the start of a chunk, where we don't know what was before).
+# Not covered is an identifier directly after the name of a function-like macro without args,
+# or directly after the args. The macro gets the position of the char after that identifier then.
+_cpreprocess_token_end_re = re.compile(
+    r"[^0-9A-Za-z_ \t\n]|(?<![ \t\n])[ \t\n]|(?<=[&|=!+\-*/%<>^~?:,.])[0-9A-Za-z_]|\A[0-9A-Za-z_]")
+# In a disabled region (state._preprocessIgnoreCurrent), we only look for comments
+# and the next preprocessor command. Complete str and char literals are skipped as a whole,
+# so that e.g. "/*" in them doesn't start a comment.
+_cpreprocess_skip_re = re.compile(
+    r"(?P<comment>/[/*])|"
+    r"\n[ \t]*(?:(?P<cmd>)(?=#)|(?P<end>)\Z)|"
+    r"(?P<literal>\"(?:[^\"\\\n]|\\.)*\"|'(?:[^'\\\n]|\\.)*')")
+_cpreprocess_skip_tail_re = re.compile(r"[/\"']")  # might start a comment or literal which continues in the next chunk
+_cpreprocess_space_re = re.compile(r"[ \t]*")
+
+class _IncludeGuardTracker(object):
+    """
+    Detects whether a file is completely wrapped in an include guard, i.e.
 
+        #ifndef X  // or: #if !defined(X)
+        ...
+        #endif
 
-def cpreprocess_parse(stateStruct, input):
+    with only whitespace, comments and pragmas outside of it, and without #else or #elif for it.
+    As long as X is defined, including the file again would not yield anything,
+    so State.preprocess_file() can skip it.
+    """
+
+    Start, Inside, After, Invalid = range(4)
+    _ifNotDefinedRe = re.compile(r"^\s*!\s*defined\s*(?:\(\s*(\w+)\s*\)|(\w+))\s*$")
+
+    def __init__(self):
+        self.state = self.Start
+        self.macroname = None
+        self.depth = None  # len(_preprocessIfLevels) outside of the guard
+
+    def text(self, s):
+        """
+        :param str s: yielded output
+        """
+        if self.state == self.Start or self.state == self.After:
+            if s.strip(): self.state = self.Invalid
+
+    def directive(self, stateStruct, cmd, arg):
+        """
+        Called before the preprocessor command is handled.
+        """
+        if cmd == "pragma": return
+        if self.state == self.Start:
+            macroname = None
+            if cmd == "ifndef":
+                macroname = (arg or "").strip()
+            elif cmd == "if":
+                m = self._ifNotDefinedRe.match(arg or "")
+                if m: macroname = m.group(1) or m.group(2)
+            if macroname and is_valid_defname(macroname):
+                self.state = self.Inside
+                self.macroname = macroname
+                self.depth = len(stateStruct._preprocessIfLevels)
+            else:
+                self.state = self.Invalid
+        elif self.state == self.Inside:
+            if len(stateStruct._preprocessIfLevels) == self.depth + 1:
+                if cmd in ("else", "elif"): self.state = self.Invalid
+                elif cmd == "endif": self.state = self.After
+        elif self.state == self.After:
+            self.state = self.Invalid
+
+    def getMacroName(self):
+        """
+        :return: the include guard macro name, if the whole file was wrapped in it
+        :rtype: str|None
+        """
+        if self.state == self.After: return self.macroname
+        return None
+
+
+def cpreprocess_parse(stateStruct, input, includeGuard=None):
     """
     :param State stateStruct:
-    :param str|typing.Iterable[str] input: not-yet preprocessed C code (str or iterable over chars)
-    :returns preprocessed C code, iterator of chars
+    :param str|typing.Iterable[str] input: not-yet preprocessed C code
+      (str or iterable over str chunks, e.g. single chars or whole blocks)
+    :param _IncludeGuardTracker|None includeGuard: gets informed about all output and preprocessor commands
+    :returns preprocessed C code, iterator of str chunks
     This removes comments and can skip over parts, which is controlled by
     the C preprocessor commands (`#if 0` parts or so).
     We will not do C preprocessor macro substitutions here.
@@ -1244,150 +1586,234 @@ def cpreprocess_parse(stateStruct, input):
     arg = ""
     state = 0
     statebeforecomment = None
-    for c in input:
-        breakLoop = False
-        while not breakLoop:
-            breakLoop = True
+    atLineStart = True  # only spaces since the last newline. only needed for the disabled region skipping
+    pending = ""  # the deferred last line of the previous chunk, see below. None after the last chunk
+    if isinstance(input, (str, unicode)): input = [input]
+    for chunk in itertools.chain(input, [None]):
+        if chunk is None:
+            if not pending: break
+            chunk, pending = pending, None
+        elif pending:
+            chunk, pending = pending + chunk, ""
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if state == 0 and stateStruct._preprocessIgnoreCurrent:
+                # Fast path for disabled regions: Skip to the next preprocessor command.
+                if pending is not None:
+                    tailStart = chunk.rfind("\n", i) + 1
+                    if tailStart < n and _cpreprocess_skip_tail_re.search(chunk, max(tailStart, i)):
+                        # The last line continues in the next chunk, and we can only know
+                        # whether there is a comment or literal in it when we have the whole line.
+                        # E.g. "/" at the end might start a comment.
+                        # So handle it together with the next chunk.
+                        pending = chunk[max(tailStart, i):]
+                        chunk = chunk[:max(tailStart, i)]
+                        n = len(chunk)
+                        if i >= n: break
+                j = None
+                if atLineStart:
+                    j = _cpreprocess_space_re.match(chunk, i).end()
+                    if j < n and chunk[j] != "#": j = None
+                if j is None:
+                    for m in _cpreprocess_skip_re.finditer(chunk, i):
+                        if m.lastgroup != "literal": break
+                    else:
+                        m = None
+                    if m is None:
+                        j = n
+                        atLineStart = False
+                    elif m.lastgroup == "comment":
+                        j = m.start() # the comment itself is handled below
+                        atLineStart = False
+                    else: # next command or end of chunk
+                        j = m.end()
+                        atLineStart = True
+                if j > i:
+                    stateStruct.incIncludeLineCharByStr(chunk[i:j])
+                    i = j
+                    continue
+                # Otherwise we are at "#" or at the start of a comment. Handle it below.
+
+            # Fast path: Handle a whole span of chars which don't change the state.
+            if state in _cpreprocess_span_res:
+                j = _cpreprocess_span_res[state].match(chunk, i).end()
+                if j > i:
+                    if not stateStruct._preprocessIgnoreCurrent:
+                        if includeGuard is not None: includeGuard.text(chunk[i:j])
+                        if state == 0:
+                            # While the consumer handles a piece, the position is the one of its last char,
+                            # like when we yield char by char. See _cpreprocess_token_end_re.
+                            k = i  # we have advanced the position up to here
+                            for m in _cpreprocess_token_end_re.finditer(chunk, i, j):
+                                stateStruct.incIncludeLineCharByStr(chunk[k:m.start()])
+                                k = m.start()
+                                yield chunk[i:k + 1]
+                                i = k + 1
+                            if i < j: yield chunk[i:j]
+                            i = k
+                        else:
+                            yield chunk[i:j]
+                    stateStruct.incIncludeLineCharByStr(chunk[i:j])
+                    i = j
+                    continue
+            elif state == 21 or state == 25: # inside of a comment
+                j = chunk.find("*" if state == 21 else "\n", i)
+                if j < 0: j = n
+                if j > i:
+                    stateStruct.incIncludeLineCharByStr(chunk[i:j])
+                    i = j
+                    continue
 
-            if state == 0:
-                if c == "#":
-                    cmd = ""
-                    arg = None
-                    state = 1
-                elif c == "/":
-                    statebeforecomment = 0
-                    state = 20
-                elif c == '"':
+            c = chunk[i]
+            i += 1
+            breakLoop = False
+            while not breakLoop:
+                breakLoop = True
+
+                if state == 0:
+                    if c == "#":
+                        cmd = ""
+                        arg = None
+                        state = 1
+                    elif c == "/":
+                        statebeforecomment = 0
+                        state = 20
+                    elif c == '"' or c == "'":
+                        if not stateStruct._preprocessIgnoreCurrent:
+                            if includeGuard is not None: includeGuard.text(c)
+                            yield c
+                        state = 10 if c == '"' else 12
+                    else:
+                        if not stateStruct._preprocessIgnoreCurrent:
+                            if includeGuard is not None: includeGuard.text(c)
+                            yield c
+                elif state == 1: # start of preprocessor command
+                    if c in SpaceChars: pass
+                    elif c == "\n": state = 0
+                    else:
+                        cmd = c
+                        state = 2
+                elif state == 2: # in the middle of the preprocessor command
+                    if c in SpaceChars:
+                        if arg is None: arg = ""
+                        else: arg += c
+                    elif c == "(":
+                        if arg is None: arg = c
+                        else: arg += c
+                    elif c == "/":
+                        state = 20
+                        statebeforecomment = 2
+                    elif c == '"':
+                        state = 3
+                        if arg is None: arg = ""
+                        arg += c
+                    elif c == "'":
+                        state = 4
+                        if arg is None: arg = ""
+                        arg += c
+                    elif c == "\\": state = 5 # escape next
+                    elif c == "\n":
+                        if includeGuard is not None: includeGuard.directive(stateStruct, cmd, arg)
+                        for s in handle_cpreprocess_cmd(stateStruct, cmd, arg): yield s
+                        state = 0
+                    else:
+                        if arg is None: cmd += c
+                        else: arg += c
+                elif state == 3: # in '"' in arg in command
+                    arg += c
+                    if c == "\n":
+                        stateStruct.error("preproc parse: unfinished str")
+                        state = 0
+                    elif c == "\\": state = 35
+                    elif c == '"': state = 2
+                elif state == 35: # in esp in '"' in arg in command
+                    arg += c
+                    state = 3
+                elif state == 4: # in "'" in arg in command
+                    arg += c
+                    if c == "\n":
+                        stateStruct.error("preproc parse: unfinished char str")
+                        state = 0
+                    elif c == "\\": state = 45
+                    elif c == "'": state = 2
+                elif state == 45: # in esp in "'" in arg in command
+                    arg += c
+                    state = 4
+                elif state == 5: # after escape in arg in command
+                    if c == "\n": state = 2
+                    else: pass # ignore everything, wait for newline
+                elif state == 10: # after '"'
+                    if not stateStruct._preprocessIgnoreCurrent: yield c
+                    if c == "\\": state = 11
+                    elif c == '"': state = 0
+                    else: pass
+                elif state == 11: # escape in "str
                     if not stateStruct._preprocessIgnoreCurrent: yield c
                     state = 10
-                elif c == "'":
+                elif state == 12: # after "'"
                     if not stateStruct._preprocessIgnoreCurrent: yield c
-                    state = 12
-                else:
+                    if c == "\\": state = 13
+                    elif c == "'": state = 0
+                    else: pass
+                elif state == 13: # escape in 'str
                     if not stateStruct._preprocessIgnoreCurrent: yield c
-            elif state == 1: # start of preprocessor command
-                if c in SpaceChars: pass
-                elif c == "\n": state = 0
-                else:
-                    cmd = c
-                    state = 2
-            elif state == 2: # in the middle of the preprocessor command
-                if c in SpaceChars:
-                    if arg is None: arg = ""
-                    else: arg += c
-                elif c == "(":
-                    if arg is None: arg = c
-                    else: arg += c
-                elif c == "/":
-                    state = 20
-                    statebeforecomment = 2
-                elif c == '"':
-                    state = 3
-                    if arg is None: arg = ""
-                    arg += c
-                elif c == "'":
-                    state = 4
-                    if arg is None: arg = ""
-                    arg += c
-                elif c == "\\": state = 5 # escape next
-                elif c == "\n":
-                    for c in handle_cpreprocess_cmd(stateStruct, cmd, arg): yield c
-                    state = 0
-                else:
-                    if arg is None: cmd += c
-                    else: arg += c
-            elif state == 3: # in '"' in arg in command
-                arg += c
-                if c == "\n":
-                    stateStruct.error("preproc parse: unfinished str")
-                    state = 0
-                elif c == "\\": state = 35
-                elif c == '"': state = 2
-            elif state == 35: # in esp in '"' in arg in command
-                arg += c
-                state = 3
-            elif state == 4: # in "'" in arg in command
-                arg += c
-                if c == "\n":
-                    stateStruct.error("preproc parse: unfinished char str")
-                    state = 0
-                elif c == "\\": state = 45
-                elif c == "'": state = 2
-            elif state == 45: # in esp in "'" in arg in command
-                arg += c
-                state = 4
-            elif state == 5: # after escape in arg in command
-                if c == "\n": state = 2
-                else: pass # ignore everything, wait for newline
-            elif state == 10: # after '"'
-                if not stateStruct._preprocessIgnoreCurrent: yield c
-                if c == "\\": state = 11
-                elif c == '"': state = 0
-                else: pass
-            elif state == 11: # escape in "str
-                if not stateStruct._preprocessIgnoreCurrent: yield c
-                state = 10
-            elif state == 12: # after "'"
-                if not stateStruct._preprocessIgnoreCurrent: yield c
-                if c == "\\": state = 13
-                elif c == "'": state = 0
-                else: pass
-            elif state == 13: # escape in 'str
-                if not stateStruct._preprocessIgnoreCurrent: yield c
-                state = 12
-            elif state == 20: # after "/", possible start of comment
-                if c == "*": state = 21 # C-style comment
-                elif c == "/": state = 25 # C++-style comment
-                else:
-                    state = statebeforecomment
-                    statebeforecomment = None
-                    if state == 0:
-                        if not stateStruct._preprocessIgnoreCurrent:
-                            yield "/"
-                            yield c
-                    elif state == 2:
-                        if arg is None: arg = ""
-                        arg += "/" + c
+                    state = 12
+                elif state == 20: # after "/", possible start of comment
+                    if c == "*": state = 21 # C-style comment
+                    elif c == "/": state = 25 # C++-style comment
                     else:
-                        stateStruct.error("preproc parse: internal error after possible comment. didn't expect state " + str(state))
-                        state = 0 # best we can do
-            elif state == 21: # C-style comment
-                if c == "*": state = 22
-                else: pass
-            elif state == 22: # C-style comment after "*"
-                if c == "/":
-                    state = statebeforecomment
-                    statebeforecomment = None
-                elif c == "*": pass
-                else: state = 21
-            elif state == 25: # C++-style comment
-                if c == "\n":
-                    state = statebeforecomment
-                    statebeforecomment = None
-                    breakLoop = False # rehandle return
-                else: pass
-            else:
-                stateStruct.error("internal error: invalid state " + str(state))
-                state = 0 # reset. it's the best we can do
+                        state = statebeforecomment
+                        statebeforecomment = None
+                        if state == 0:
+                            if not stateStruct._preprocessIgnoreCurrent:
+                                if includeGuard is not None: includeGuard.text("/" + c)
+                                yield "/" + c
+                        elif state == 2:
+                            if arg is None: arg = ""
+                            arg += "/" + c
+                        else:
+                            stateStruct.error("preproc parse: internal error after possible comment. didn't expect state " + str(state))
+                            state = 0 # best we can do
+                elif state == 21: # C-style comment
+                    if c == "*": state = 22
+                    else: pass
+                elif state == 22: # C-style comment after "*"
+                    if c == "/":
+                        state = statebeforecomment
+                        statebeforecomment = None
+                    elif c == "*": pass
+                    else: state = 21
+                elif state == 25: # C++-style comment
+                    if c == "\n":
+                        state = statebeforecomment
+                        statebeforecomment = None
+                        breakLoop = False # rehandle return
+                    else: pass
+                else:
+                    stateStruct.error("internal error: invalid state " + str(state))
+                    state = 0 # reset. it's the best we can do
 
-        if c == "\n": stateStruct.incIncludeLineChar(line=1)
-        elif c == "\t": stateStruct.incIncludeLineChar(char=4, charMod=4)
-        else: stateStruct.incIncludeLineChar(char=1)
+            atLineStart = c == "\n" and state == 0
+            if c == "\n": stateStruct.incIncludeLineChar(line=1)
+            elif c == "\t": stateStruct.incIncludeLineChar(char=4, charMod=4)
+            else: stateStruct.incIncludeLineChar(char=1)
 
     # yield dummy additional new-line at end
     yield "\n"
 
 
 class _CBase(object):
-    def __init__(self, content=None, rawstr=None, **kwargs):
+    # There are lots of tokens (see cpre2_parse), so keep them small.
+    __slots__ = ("content", "rawstr")
+    def __init__(self, content=None, rawstr=None):
         self.content = content
         self.rawstr = rawstr
-        for k,v in kwargs.items():
-            setattr(self, k, v)
     def __repr__(self):
         if self.content is None: return "<" + self.__class__.__name__ + ">"
         return "<" + self.__class__.__name__ + " " + repr(self.content) + ">"
     def __eq__(self, other):
+        if self is other: return True  # common case for the shared tokens, see cpre2_parse
         return self.__class__ is other.__class__ and self.content == other.content
     def __ne__(self, other):
         return not self == other
@@ -1396,16 +1822,18 @@ class _CBase(object):
 
 
 class CStr(_CBase):
+    __slots__ = ()
     def __repr__(self): return "<" + self.__class__.__name__ + " " + repr(self.content) + ">"
     def asCCode(self, indent=""): return indent + '"' + escape_cstr(self.content) + '"'
 
 
 class CChar(_CBase):
-    def __init__(self, content=None, rawstr=None, **kwargs):
+    __slots__ = ()
+    def __init__(self, content=None, rawstr=None):
         if isinstance(content, (unicode,str)): content = ord(content)
         assert isinstance(content, int), "CChar expects int, got " + repr(content)
         assert 0 <= content <= 255, "CChar expects number in range 0-255, got " + str(content)
-        _CBase.__init__(self, content, rawstr, **kwargs)
+        _CBase.__init__(self, content, rawstr)
     def __repr__(self): return "<" + self.__class__.__name__ + " " + repr(self.content) + ">"
     def asCCode(self, indent=""):
         if isinstance(self.content, str):
@@ -1416,24 +1844,38 @@ class CChar(_CBase):
 
 
 class CNumber(_CBase):
+    __slots__ = ()
     typeSpec = None  # prefix like "f", "i" or so, or None
     def asCCode(self, indent=""): return indent + self.rawstr
 
 
-class CIdentifier(_CBase): pass
+class CIdentifier(_CBase):
+    __slots__ = ()
 
 
-class COp(_CBase): pass
+class COp(_CBase):
+    __slots__ = ()
 
 
 class CSemicolon(_CBase):
+    __slots__ = ()
     def asCCode(self, indent=""): return indent + ";"
 
 
-class COpeningBracket(_CBase): pass
+class _CBracket(_CBase):
+    # level is the number of open brackets outside of this bracket pair.
+    __slots__ = ("level",)
+    def __init__(self, content=None, level=0):
+        _CBase.__init__(self, content)
+        self.level = level
+
 
+class COpeningBracket(_CBracket):
+    __slots__ = ()
 
-class CClosingBracket(_CBase): pass
+
+class CClosingBracket(_CBracket):
+    __slots__ = ()
 
 
 def cpre2_parse_number(stateStruct, s):
@@ -1462,7 +1904,7 @@ def cpre2_parse_number(stateStruct, s):
 def _cpre2_parse_args(stateStruct, input, brackets, separator=COp(",")):
     """
     :type stateStruct: State
-    :param iterable[char] input: like cpre2_parse
+    :param _Pre2ParseStream input: like cpre2_parse
     :param list[str] brackets: opening brackets stack
     :param sep_type: the separator type, e.g. CSemicolon or COp
     :returns list of args, where each arg is a list of tokens from cpre2_parse.
@@ -1489,43 +1931,98 @@ def _cpre2_parse_args(stateStruct, input, brackets, separator=COp(",")):
 class _Pre2ParseStream:
     def __init__(self, input):
         """
-        :param str|typing.Iterable[str] input:
+        :param str|typing.Iterable[str] input: str or iterable over str chunks
         """
-        if isinstance(input, str):
-            input = iter(input)
-        self.input = input
+        if isinstance(input, (str, unicode)):
+            input = [input]
+        self.input = iter(input)
+        self.chunk = ""  # current input chunk
+        self.chunk_pos = 0
         self.macro_blacklist = set()
-        self.buffer_stack = [[None, ""]]  # list[(macroname,buffer)]
+        # The buffers are never sliced; we only move the position forward.
+        self.buffer_stack = [[None, "", 0]]  # list[(macroname,buffer,pos)]
+
+    def _current_buffer(self):
+        """
+        :return: the top-most not yet consumed buffer, or None if we should read from the input
+        :rtype: list|None
+        """
+        i = len(self.buffer_stack) - 1
+        while i >= 0:
+            entry = self.buffer_stack[i]
+            if entry[2] < len(entry[1]): return entry
+            i -= 1
+        return None
 
     def next_char(self):
-        for i in reversed(range(len(self.buffer_stack))):
-            if not self.buffer_stack[i][1]: continue
-            c = self.buffer_stack[i][1][0]
-            self.buffer_stack[i][1] = self.buffer_stack[i][1][1:]
+        entry = self.buffer_stack[-1]
+        if entry[2] >= len(entry[1]):
+            entry = self._current_buffer()
+        if entry is not None:
+            c = entry[1][entry[2]]
+            entry[2] += 1
             # finalize handling will be in finalize_char()
             return c
-        try:
-            return next(self.input)
-        except StopIteration:
-            return None
+        while self.chunk_pos >= len(self.chunk):
+            try:
+                self.chunk = next(self.input)
+            except StopIteration:
+                return None
+            self.chunk_pos = 0
+        c = self.chunk[self.chunk_pos]
+        self.chunk_pos += 1
+        return c
+
+    def read_span(self, regex):
+        """
+        :param typing.Pattern regex: should match the empty string
+        :return: chars matching the regex. This is like calling next_char() as long as the chars match,
+          but it stays inside the current buffer or input chunk.
+        :rtype: str
+        """
+        entry = self._current_buffer()
+        if entry is not None:
+            buffer, pos = entry[1], entry[2]
+            end = regex.match(buffer, pos).end()
+            entry[2] = end
+            return buffer[pos:end]
+        end = regex.match(self.chunk, self.chunk_pos).end()
+        span = self.chunk[self.chunk_pos:end]
+        self.chunk_pos = end
+        return span
 
     def add_macro(self, macroname, resolved, c):
-        self.buffer_stack += [[macroname, resolved]]
+        # Push back c into the previous buffer.
+        # Usually, it was just read from there, so we can just step back.
+        entry = self.buffer_stack[-1]
+        if entry[2] > 0 and entry[1][entry[2] - 1] == c:
+            entry[2] -= 1
+        else:
+            entry[1] = c + entry[1][entry[2]:]
+            entry[2] = 0
+        self.buffer_stack.append([macroname, resolved, 0])
         self.macro_blacklist.add(macroname)
-        self.buffer_stack[-2][1] = c + self.buffer_stack[-2][1]
 
     def finalize_char(self, laststr):
         # Finalize buffer_stack here. Here because the macro_blacklist needs to be active
         # in the code above.
-        if not laststr and len(self.buffer_stack) > 1 and not self.buffer_stack[-1][1]:
-            self.macro_blacklist.remove(self.buffer_stack[-1][0])
-            self.buffer_stack = self.buffer_stack[:-1]
+        if not laststr and len(self.buffer_stack) > 1:
+            entry = self.buffer_stack[-1]
+            if entry[2] >= len(entry[1]):
+                self.macro_blacklist.remove(entry[0])
+                self.buffer_stack.pop()
 
 
+# Runs of chars which cpre2_parse reads in one go. See _Pre2ParseStream.read_span().
+_cpre2_space_re = re.compile(r"[ \t\n]*")
+_cpre2_identifier_re = re.compile(r"[0-9A-Za-z_]*")  # also for numbers
+_cpre2_str_re = re.compile(r'[^"\\]*')
+_cpre2_char_re = re.compile(r"[^'\\]*")
+
 def cpre2_parse(stateStruct, input, brackets=None):
     """
     :param State stateStruct:
-    :param str|typing.Iterable[str]|_Pre2ParseStream input: chars of preprocessed C code.
+    :param str|typing.Iterable[str]|_Pre2ParseStream input: chunks of preprocessed C code.
         except of macro substitution. usually via cpreprocess_parse().
     :param list[str]|None brackets: opening brackets stack
     :returns token iterator. this will also substitute macros
@@ -1534,6 +2031,8 @@ def cpre2_parse(stateStruct, input, brackets=None):
     """
     state = 0
     if brackets is None: brackets = []
+    # Identifiers (incl. keywords) and ops are immutable, so we share them.
+    tokens = stateStruct._tokens
     if not isinstance(input, _Pre2ParseStream):
         input = _Pre2ParseStream(input)
     laststr = ""
@@ -1547,28 +2046,28 @@ def cpre2_parse(stateStruct, input, brackets=None):
         while not breakLoop:
             breakLoop = True
             if state == 0:
-                if c in SpaceChars + "\n": pass
+                if c in SpaceChars + "\n": input.read_span(_cpre2_space_re)
                 elif c in NumberChars:
-                    laststr = c
+                    laststr = c + input.read_span(_cpre2_identifier_re)
                     state = 10
                 elif c == '"':
-                    laststr = ""
+                    laststr = input.read_span(_cpre2_str_re)
                     state = 20
                 elif c == "'":
-                    laststr = ""
+                    laststr = input.read_span(_cpre2_char_re)
                     state = 25
                 elif c in LetterChars + "_":
-                    laststr = c
+                    laststr = c + input.read_span(_cpre2_identifier_re)
                     state = 30
                 elif c in OpeningBrackets:
-                    yield COpeningBracket(c, brackets=list(brackets))
+                    yield COpeningBracket(c, len(brackets))
                     brackets.append(c)
                 elif c in ClosingBrackets:
                     if len(brackets) == 0 or ClosingBrackets[len(OpeningBrackets) - OpeningBrackets.index(brackets[-1]) - 1] != c:
                         stateStruct.error("cpre2 parse: got '" + c + "' but bracket level was " + str(brackets))
                     else:
-                        brackets[:] = brackets[:-1]
-                        yield CClosingBracket(c, brackets=list(brackets))
+                        brackets.pop()
+                        yield CClosingBracket(c, len(brackets))
                 elif c in OpChars:
                     laststr = ""
                     state = 40
@@ -1596,7 +2095,7 @@ def cpre2_parse(stateStruct, input, brackets=None):
                     laststr = ""
                     state = 0
                 elif c == "\\": state = 21
-                else: laststr += c
+                else: laststr += c + input.read_span(_cpre2_str_re)
             elif state == 21: # escape in "str
                 laststr += simple_escape_char(c)
                 state = 20
@@ -1609,7 +2108,7 @@ def cpre2_parse(stateStruct, input, brackets=None):
                     laststr = ""
                     state = 0
                 elif c == "\\": state = 26
-                else: laststr += c
+                else: laststr += c + input.read_span(_cpre2_char_re)
             elif state == 26: # escape in 'str
                 laststr += simple_escape_char(c)
                 state = 25
@@ -1630,7 +2129,10 @@ def cpre2_parse(stateStruct, input, brackets=None):
                         elif laststr == "__LINE__":
                             yield CNumber(stateStruct.curLine())
                         else:
-                            yield CIdentifier(laststr)
+                            token = tokens.get(laststr)
+                            if token is None:
+                                token = tokens[laststr] = CIdentifier(intern(laststr))
+                            yield token
                         laststr = ""
                         state = 0
                         breakLoop = False
@@ -1658,11 +2160,17 @@ def cpre2_parse(stateStruct, input, brackets=None):
             elif state == 40: # op
                 if c in OpChars:
                     if laststr != "" and laststr + c not in LongOps:
-                        yield COp(laststr)
+                        token = tokens.get(laststr)
+                        if token is None:
+                            token = tokens[laststr] = COp(intern(laststr))
+                        yield token
                         laststr = ""
                     laststr += c
                 else:
-                    yield COp(laststr)
+                    token = tokens.get(laststr)
+                    if token is None:
+                        token = tokens[laststr] = COp(intern(laststr))
+                    yield token
                     laststr = ""
                     state = 0
                     breakLoop = False
@@ -1716,7 +2224,7 @@ def cpre2_tokenstream_asCCode(input):
 class CBody(object):
     def __init__(self, parent):
         self.parent = parent
-        self._bracketlevel = []
+        self._bracketlevel = 0
         self.typedefs = {}
         self.structs = {}
         self.unions = {}
@@ -1786,7 +2294,60 @@ def asCCode(stmnt, indent="", fullDecl=False):
     assert False, "don't know how to handle " + str(stmnt)
 
 
+class _EmptyList(list):
+    """
+    Shared empty default for the list attribs of _CBaseWithOptBody, see _emptyList.
+    `obj.attr += [x]` creates a new list for obj. All in-place modifications are errors.
+    """
+    __slots__ = ()
+
+    def __iadd__(self, other):
+        return list(other)
+
+    def _readOnly(self, *args):
+        raise TypeError("shared empty list is read-only, assign a new list instead")
+
+    append = extend = insert = pop = remove = sort = reverse = _readOnly
+    __setitem__ = __delitem__ = __imul__ = __setslice__ = __delslice__ = _readOnly
+
+    def __reduce__(self):
+        return "_emptyList"  # the global instance
+
+_emptyList = _EmptyList()
+
+
+def _getSlotNames(cls):
+    """
+    :rtype: list[str]
+    """
+    names = []
+    for c in cls.__mro__:
+        for name in c.__dict__.get("__slots__", ()):
+            if name not in ("__dict__", "__weakref__"):
+                names.append(name)
+    return names
+
+
+def _getObjAttribs(obj):
+    """
+    :return: all attribs which are set in the instance, from its __dict__ and its __slots__
+    :rtype: dict[str]
+    """
+    d = dict(getattr(obj, "__dict__", ()))
+    for name in _getSlotNames(obj.__class__):
+        if hasattr(obj, name):
+            d[name] = getattr(obj, name)
+    return d
+
+
 class _CBaseWithOptBody(object):
+    # The attribs which every node uses are slots. Others (e.g. CStatement._state, CVarDecl.bitsize)
+    # go into the __dict__, which is only allocated when needed.
+    # Subclasses must not add slots, because overtake() changes the class of an existing instance.
+    __slots__ = ("parent", "name", "type", "body", "value", "defPos", "_bracketlevel", "_finalized",
+                 "_type_tokens", "attribs", "args", "arrayargs",
+                 "__dict__", "__weakref__")
+    _SlotAttribs = __slots__[:-2]
     NameIsRelevant = True
     AutoAddToContent = True
     AlwaysNonZero = False
@@ -1799,15 +2360,13 @@ class _CBaseWithOptBody(object):
     ]
 
     def __init__(self, **kwargs):
-        self._type_tokens = []
+        # Shared empty lists. A new list is assigned when an item is added, see _EmptyList.
+        self._type_tokens = self.attribs = self.args = self.arrayargs = _emptyList
         self._bracketlevel = None
         self._finalized = False
         self.defPos = None
         self.type = None
-        self.attribs = []
         self.name = None
-        self.args = []
-        self.arrayargs = []
         self.body = None
         self.value = None
         self.parent = None
@@ -1856,6 +2415,18 @@ class _CBaseWithOptBody(object):
 
     __bool__ = __nonzero__
 
+    def __getstate__(self):
+        # The ctypes type from getCType() (see _getCTypeStruct) is created dynamically
+        # and cannot be pickled. It will just be created again when needed.
+        d = self.__dict__
+        if "_ctype" in d:
+            d = {k: v for (k, v) in d.items() if not k.startswith("_ctype")}
+        slots = {}
+        for name in self._SlotAttribs:
+            if hasattr(self, name):
+                slots[name] = getattr(self, name)
+        return d or None, slots
+
     def finalize(self, stateStruct, addToContent = None):
         if self._finalized:
             stateStruct.error("internal error: " + str(self) + " finalized twice")
@@ -1889,7 +2460,7 @@ class _CBaseWithOptBody(object):
             return {k: self._copy(v, parent=parent) for (k, v) in value.items()}
         elif isinstance(value, (_CBase, _CBaseWithOptBody, CType, CBody)):
             new = value.__class__.__new__(value.__class__)
-            for k, v in vars(value).items():
+            for k, v in _getObjAttribs(value).items():
                 if k in leave_out_attribs:
                     continue
                 if k == "parent":
@@ -1904,8 +2475,12 @@ class _CBaseWithOptBody(object):
         return self._copy(self, parent=self.parent, leave_out_attribs=leave_out_attribs)
 
     def depth(self):
-        if self.parent is None: return 1
-        return self.parent.depth() + 1
+        d = 1
+        obj = self.parent
+        while isinstance(obj, _CBaseWithOptBody):
+            d += 1
+            obj = obj.parent
+        return d
 
     def getCType(self, stateStruct):
         raise Exception(str(self) + " cannot be converted to a C type")
@@ -1918,10 +2493,8 @@ class _CBaseWithOptBody(object):
             elif isinstance(self, CEnum): D = "enums"
             self = getattr(stateStruct, D).get(self.name, self)
         if self.body is None: return None
-        for c in self.body.contentlist:
-            if not isinstance(c, CVarDecl): continue
-            if c.name == attrib: return c
-        return None
+        # The members are added to body.vars via _addToParent, so this is the name -> member index.
+        return self.body.vars.get(attrib)
 
     def asCCode(self, indent=""):
         raise NotImplementedError(str(self) + " asCCode not implemented")
@@ -1943,7 +2516,10 @@ class CTypedef(_CBaseWithOptBody):
             stateStruct.error("finalize typedef " + str(self) + ": name is unset")
             return
 
+        old = self.parent.body.typedefs.get(self.name)
         self.parent.body.typedefs[self.name] = self
+        _addedToBody(stateStruct, self.parent, "typedefs", self.name, old)
+        invalidateCTypeCaches()
     def getCType(self, stateStruct): return getCType(self.type, stateStruct)
     def asCCode(self, indent=""):
         return indent + "typedef\n" + asCCode(self.type, indent, fullDecl=True) + " " + self.name
@@ -1991,6 +2567,8 @@ def _addToParent(obj, stateStruct, dictName=None, listName=None, allowPredec=Tru
             # might be part of a typedef, so don't error
             return
 
+        old = d.get(obj.name)
+        shadowed = None
         if obj.name in d:
             if allowPredec and d[obj.name].body is None:
                 # If the body is empty, it was a pre-declaration and it is ok to overwrite it now.
@@ -1998,11 +2576,18 @@ def _addToParent(obj, stateStruct, dictName=None, listName=None, allowPredec=Tru
             elif "extern" in d[obj.name].attribs:
                 # Otherwise, if we explicitely use the "extern" attribute, it's also ok.
                 d[obj.name] = obj
+            elif getattr(obj, "body", None) is None and _isStateBody(stateStruct, obj.parent.body):
+                # A global redeclaration after the definition is also ok. Keep the definition.
+                # This happens e.g. when a header is parsed again, see incremental.IncrementalParser.
+                shadowed = obj
             else:
                 # Otherwise however, it is an error.
                 stateStruct.error("finalize " + str(obj) + ": a previous equally named declaration exists: " + str(d[obj.name]))
         else:
             d[obj.name] = obj
+        _addedToBody(stateStruct, obj.parent, dictName, obj.name, old, shadowed)
+        if dictName in ("typedefs", "structs", "unions", "enums"):
+            invalidateCTypeCaches()
     else:
         assert listName is not None
         d.append(obj)
@@ -2026,6 +2611,37 @@ def _finalizeBasicType(obj, stateStruct, dictName=None, listName=None, addToCont
 
 class CFunc(_CBaseWithOptBody):
     finalize = lambda *args, **kwargs: _finalizeBasicType(*args, dictName="funcs", **kwargs)
+    def getState(self):
+        obj = self
+        while obj.parent is not None:
+            obj = obj.parent
+        return obj.body
+    def parseBody(self, stateStruct=None):
+        """
+        If the body was not parsed yet (see State.FuncBodyMode), parse it now.
+
+        :param State|None stateStruct: where we report errors. by default the State we are defined in
+        :return: the body, or None if it was skipped
+        :rtype: CBody|None
+        """
+        body = self.body
+        if not isinstance(body, CFuncBodyTokens): return body
+        if stateStruct is None: stateStruct = self.getState()
+        if body.isSkipped():
+            stateStruct.error("cannot parse the skipped body of %s" % self)
+            return None
+        tokenArray = body.tokenArray()
+        self.body = CBody(parent=self.parent.body)
+        self._bracketlevel = body.bracketlevel
+        oldTokenArray = stateStruct._cpre3_tokenArray
+        oldAtBaseLevel = getattr(stateStruct, "_cpre3_atBaseLevel", False)
+        stateStruct._cpre3_tokenArray = tokenArray
+        try:
+            cpre3_parse_body(stateStruct, self, tokenArray)
+        finally:
+            stateStruct._cpre3_tokenArray = oldTokenArray
+            stateStruct._cpre3_atBaseLevel = oldAtBaseLevel
+        return self.body
     def getCType(self, stateStruct):
         restype = getCType(self.type, stateStruct)
         argtypes = map(lambda a: getCType(a, stateStruct), self.args)
@@ -2142,10 +2758,82 @@ def _getCTypeStruct(baseClass, obj, stateStruct):
     return ctype
 
 
+class CStructFieldLayout(object):
+    __slots__ = ("decl", "ctype", "offset", "size", "bitsize", "bitoffset")
+    def __init__(self, decl, ctype, offset, size, bitsize=None, bitoffset=None):
+        """
+        :param CVarDecl decl:
+        :param ctype: the ctypes type of the field
+        :param int offset: in bytes
+        :param int size: in bytes. for bitfields, of the underlying type
+        :param int|None bitsize:
+        :param int|None bitoffset: inside the underlying type
+        """
+        self.decl = decl
+        self.ctype = ctype
+        self.offset = offset
+        self.size = size
+        self.bitsize = bitsize
+        self.bitoffset = bitoffset
+    def __repr__(self):
+        if self.bitsize is None:
+            return "<%s %r offset %i size %i>" % (self.__class__.__name__, self.decl.name, self.offset, self.size)
+        return "<%s %r offset %i bits %i:%i>" % (
+            self.__class__.__name__, self.decl.name, self.offset, self.bitoffset, self.bitsize)
+
+
+class CStructLayout(object):
+    def __init__(self, obj, ctype):
+        """
+        :param CStruct|CUnion obj:
+        :param ctype: via _getCTypeStruct
+        """
+        self.ctype = ctype
+        self.size = ctypes.sizeof(ctype)
+        self.fields = {}  # name -> CStructFieldLayout
+        for field in ctype._fields_:
+            name, fieldType = field[:2]
+            decl = obj.body.vars.get(name)
+            if decl is None: continue  # unnamed, e.g. a padding bitfield like `int :4;`. see _getCTypeStruct
+            f = getattr(ctype, name)
+            if len(field) > 2:
+                if hasattr(f, "bit_size"):  # Python >= 3.14
+                    bitsize, bitoffset = f.bit_size, f.bit_offset
+                else:  # ctypes encodes it as (bitsize << 16) + bitoffset
+                    bitsize, bitoffset = f.size >> 16, f.size & 0xffff
+                self.fields[name] = CStructFieldLayout(
+                    decl=decl, ctype=fieldType, offset=f.offset, size=ctypes.sizeof(fieldType),
+                    bitsize=bitsize, bitoffset=bitoffset)
+            else:
+                self.fields[name] = CStructFieldLayout(
+                    decl=decl, ctype=fieldType, offset=f.offset, size=f.size)
+    def __repr__(self):
+        return "<%s %s size %i>" % (self.__class__.__name__, self.ctype.__name__, self.size)
+
+
+def getStructLayout(obj, stateStruct):
+    """
+    :param CStruct|CUnion obj:
+    :rtype: CStructLayout
+    """
+    if obj.body is None:
+        # it probably is the pre-declaration. but we might find the real-one
+        obj = getattr(stateStruct, "structs" if isinstance(obj, CStruct) else "unions").get(obj.name, obj)
+    if hasattr(obj, "_ctype_layout"):
+        return obj._ctype_layout
+    ctype = getCType(obj, stateStruct)
+    layout = CStructLayout(obj, ctype)
+    if not getattr(obj, "_ctype_is_constructing", False):
+        obj._ctype_layout = layout  # like _ctype, not stored in caches or snapshots
+    return layout
+
+
 class CStruct(_CBaseWithOptBody):
     finalize = lambda *args, **kwargs: _finalizeBasicType(*args, dictName="structs", **kwargs)
     def getCType(self, stateStruct):
         return _getCTypeStruct(ctypes.Structure, self, stateStruct)
+    def getLayout(self, stateStruct):
+        return getStructLayout(self, stateStruct)
     def asCCode(self, indent=""):
         s = indent + "struct " + self.name
         if self.body is None: return s
@@ -2156,6 +2844,8 @@ class CUnion(_CBaseWithOptBody):
     finalize = lambda *args, **kwargs: _finalizeBasicType(*args, dictName="unions", **kwargs)
     def getCType(self, stateStruct):
         return _getCTypeStruct(ctypes.Union, self, stateStruct)
+    def getLayout(self, stateStruct):
+        return getStructLayout(self, stateStruct)
     def asCCode(self, indent=""):
         s = indent + "union " + self.name
         if self.body is None: return s
@@ -2235,7 +2925,9 @@ class CEnumConst(_CBaseWithOptBody):
 
         if self.name:
             # self.parent.parent is the parent of the enum
+            old = self.parent.parent.body.enumconsts.get(self.name)
             self.parent.parent.body.enumconsts[self.name] = self
+            _addedToBody(stateStruct, self.parent.parent, "enumconsts", self.name, old)
     def getConstValue(self, stateStruct):
         return self.value
     def asCCode(self, indent=""):
@@ -2264,9 +2956,8 @@ class CFuncArgDecl(_CBaseWithOptBody):
 
 
 def _isBracketLevelOk(parentLevel, curLevel):
-    if parentLevel is None: parentLevel = []
-    if len(parentLevel) > len(curLevel): return False
-    return curLevel[:len(parentLevel)] == parentLevel
+    if parentLevel is None: parentLevel = 0
+    return parentLevel <= curLevel
 
 
 def _body_parent_chain(stateStruct, parentCObj):
@@ -2307,25 +2998,217 @@ def getObjInBody(body, name):
         return CStdIntType(name)
     return None
 
-def findObjInNamespace(stateStruct, curCObj, name):
-    for cobj in _obj_parent_chain(stateStruct, curCObj):
-        if isinstance(cobj.body, (CBody,State)):
-            obj = getObjInBody(cobj.body, name)
-            if obj is not None: return obj
+def _findObjInCObj(stateStruct, cobj, name):
+    """
+    :param stateStruct: or None, if cobj is not a global one (see CScopeSymbols)
+    """
+    # stateStruct might also be some wrapper, e.g. caching.StateWrapper.
+    if isinstance(cobj.body, (CBody,State)) or (stateStruct is not None and cobj.body is stateStruct):
+        obj = getObjInBody(cobj.body, name)
+        if obj is not None: return obj
+    if isinstance(cobj, CFunc):
+        for arg in cobj.args:
+            assert isinstance(arg, CFuncArgDecl)
+            if arg.name is not None and arg.name == name:
+                return arg
+        if cobj.name == name:
+            return cobj
+    return None
+
+
+class CScopeSymbols(object):
+    """
+    Symbol table of the nested scopes which cpre3_parse_body is currently in (State._cpre3_scopes).
+    With it, findObjInNamespace and findCObjTypeInNamespace do a single dict probe (and then check the State)
+    instead of walking the parent chain and checking every body on the way.
+    The outermost objects (e.g. with the State as the body) are not part of the table
+    because the State dicts are also modified from outside (e.g. by the global include wrappers).
+    """
+    NameDictNames = ("funcs", "typedefs", "vars", "enumconsts")  # see getObjInBody
+    TagDictNames = ("structs", "unions", "enums")
+
+    def __init__(self):
+        self.levels = []  # cobjs of the parent chain with a CBody, outermost first
+        self.levelIdxs = {}  # id(cobj) -> idx in levels
+        self.globalLevels = []  # the outermost cobjs, innermost first, e.g. the one with the State as body
+        self.names = {}  # name -> obj, as _findObjInCObj would find it in the levels
+        self.tags = dict([(D, {}) for D in self.TagDictNames])  # DictName -> name -> obj
+
+    def top(self):
+        """
+        :return: the innermost cobj which the table covers, or None
+        """
+        if self.levels: return self.levels[-1]
+        if self.globalLevels: return self.globalLevels[0]
+        return None
+
+    def _isGlobal(self, stateStruct, cobj):
+        return _isStateBody(stateStruct, cobj.body)
+
+    def push(self, stateStruct, cobj):
+        """
+        :param stateStruct:
+        :param cobj: which cpre3_parse_body is going to parse
+        :return: what to pass to pop()
+        """
+        top = self.top()
+        chain = []  # innermost first
+        obj = cobj
+        while obj is not None and obj is not top:
+            chain.append(obj)
+            obj = obj.parent
+        if obj is not None and not [c for c in chain if self._isGlobal(stateStruct, c)]:
+            marker = len(self.levels)
+            for c in reversed(chain):
+                self._addLevel(c)
+            return marker
+        # Not inside the current scopes (e.g. via CFunc.parseBody while parsing something else). Start over.
+        saved = self.__dict__.copy()
+        self.__init__()
+        while obj is not None:
+            chain.append(obj)
+            obj = obj.parent
+        i = 0
+        while i < len(chain) and not self._isGlobal(stateStruct, chain[i]):
+            i += 1
+        self.globalLevels = chain[i:]
+        for c in reversed(chain[:i]):
+            self._addLevel(c)
+        return saved
+
+    def pop(self, marker):
+        """
+        :param marker: from push()
+        """
+        if isinstance(marker, dict):
+            self.__dict__.update(marker)
+            return
+        levels = self.levels[marker:]
+        del self.levels[marker:]
+        for cobj in levels:
+            del self.levelIdxs[id(cobj)]
+        for cobj in levels:
+            for name in self._levelNames(cobj):
+                self._update(name)
+            if isinstance(cobj.body, CBody):
+                for D in self.TagDictNames:
+                    for name in getattr(cobj.body, D):
+                        self._updateTag(D, name)
+
+    def _addLevel(self, cobj):
+        if not isinstance(cobj.body, CBody) and not isinstance(cobj, CFunc):
+            return  # nothing to find there
+        self.levelIdxs[id(cobj)] = len(self.levels)
+        self.levels.append(cobj)
+        for name in self._levelNames(cobj):
+            obj = _findObjInCObj(None, cobj, name)
+            if obj is not None: self.names[name] = obj
+        if isinstance(cobj.body, CBody):
+            for D in self.TagDictNames:
+                d = getattr(cobj.body, D)
+                if d: self.tags[D].update(d)
+
+    def _levelNames(self, cobj):
+        names = []
+        if isinstance(cobj.body, CBody):
+            for D in self.NameDictNames:
+                names.extend(getattr(cobj.body, D))
         if isinstance(cobj, CFunc):
-            for arg in cobj.args:
-                assert isinstance(arg, CFuncArgDecl)
-                if arg.name is not None and arg.name == name:
-                    return arg
-            if cobj.name == name:
-                return cobj
+            names.extend([a.name for a in cobj.args if a.name is not None])
+            if cobj.name is not None: names.append(cobj.name)
+        return names
+
+    def _update(self, name):
+        for cobj in reversed(self.levels):
+            obj = _findObjInCObj(None, cobj, name)
+            if obj is not None:
+                self.names[name] = obj
+                return
+        self.names.pop(name, None)
+
+    def _updateTag(self, DictName, name):
+        for cobj in reversed(self.levels):
+            if not isinstance(cobj.body, CBody): continue
+            d = getattr(cobj.body, DictName)
+            if name in d:
+                self.tags[DictName][name] = d[name]
+                return
+        self.tags[DictName].pop(name, None)
+
+    def added(self, cobj, DictName, name):
+        """
+        Must be called when something was added to the body of cobj, see _addToParent.
+        """
+        if id(cobj) not in self.levelIdxs: return
+        if DictName in self.TagDictNames:
+            self._updateTag(DictName, name)
+        else:
+            self._update(name)
+
+
+def _isStateBody(stateStruct, body):
+    # Like in _findObjInCObj. Note that body might also be a CFuncBodyTokens.
+    return not isinstance(body, CBody) and (isinstance(body, State) or body is stateStruct)
+
+
+def _addedToBody(stateStruct, cobj, DictName, name, old=None, shadowed=None):
+    scopes = getattr(stateStruct, "_cpre3_scopes", None)
+    if scopes is not None:
+        scopes.added(cobj, DictName, name)
+    if _isStateBody(stateStruct, cobj.body):
+        _recordStateChange(stateStruct, DictName, name, old, shadowed)
+
+
+def _recordStateChange(stateStruct, attrib, name, old, shadowed=None):
+    """
+    Called after we have set or removed a top-level entry, i.e. `getattr(stateStruct, attrib)[name]`.
+    See incremental.IncrementalParser.
+
+    :param str attrib: e.g. "funcs" or "macros"
+    :param str name:
+    :param old: the previous value, or None if there was none
+    :param shadowed: a redeclaration which we did not set because we kept the old value
+    """
+    contributions = getattr(stateStruct, "_contributions", None)
+    if contributions is not None:
+        contributions.record(attrib, name, old, shadowed)
+
+
+def findObjInNamespace(stateStruct, curCObj, name):
+    scopes = getattr(stateStruct, "_cpre3_scopes", None)
+    top = scopes.top() if scopes is not None else None
+    cobj = curCObj
+    while cobj is not None and cobj is not top:
+        obj = _findObjInCObj(stateStruct, cobj, name)
+        if obj is not None: return obj
+        cobj = cobj.parent
+    if cobj is None: return None  # walked through the whole chain
+    obj = scopes.names.get(name)
+    if obj is not None: return obj
+    for cobj in scopes.globalLevels:
+        obj = _findObjInCObj(stateStruct, cobj, name)
+        if obj is not None: return obj
     return None
 
 
 def findCObjTypeInNamespace(stateStruct, curCObj, DictName, name):
-    for body in _body_parent_chain(stateStruct, curCObj):
-        d = getattr(body, DictName)
+    scopes = getattr(stateStruct, "_cpre3_scopes", None)
+    top = scopes.top() if scopes is not None else None
+    cobj = curCObj
+    while cobj is not None and cobj is not top:
+        if isinstance(cobj.body, CBody):
+            d = getattr(cobj.body, DictName)
+            if name in d: return d[name]
+        cobj = cobj.parent
+    if cobj is not None:
+        d = scopes.tags[DictName]
         if name in d: return d[name]
+        for cobj in scopes.globalLevels:
+            if isinstance(cobj.body, CBody):
+                d = getattr(cobj.body, DictName)
+                if name in d: return d[name]
+    d = getattr(stateStruct, DictName)
+    if name in d: return d[name]
     return None
 
 
@@ -2498,6 +3381,8 @@ def getCommonValueType(stateStruct, t1, t2):
         t1 = CBuiltinType(("void","*"))
     if t2 in (ctypes.c_void_p, CPointerType(CVoidType()), CPointerType(CBuiltinType(("void",)))):
         t2 = CBuiltinType(("void","*"))
+    if t1 is t2 and not isinstance(t1, (CBuiltinType, CStdIntType)):
+        return t1  # see _InternedType. the basic types are normalized below
     if t1 == CBuiltinType(("void","*")):
         if t2 == CBuiltinType(("void","*")):
             return t1
@@ -2677,7 +3562,6 @@ class CStatement(_CBaseWithOptBody):
     __bool__ = __nonzero__
     def __repr__(self):
         s = self.__class__.__name__
-        #s += " " + repr(self._tokens) # debug
         if self._leftexpr is not None: s += " " + repr(self._leftexpr)
         if self._op == COp("?:"):
             s += " ? " + repr(self._middleexpr)
@@ -2693,7 +3577,6 @@ class CStatement(_CBaseWithOptBody):
     __str__ = __repr__
     def _initStatement(self):
         self._state = 0
-        self._tokens = []
     def __init__(self, **kwargs):
         self._initStatement()
         _CBaseWithOptBody.__init__(self, **kwargs)
@@ -2715,13 +3598,11 @@ class CStatement(_CBaseWithOptBody):
         :type stateStruct: State
         :type token: iterator
         """
-        self._tokens += [token]
-
         if self._state == 5 and token == COp(":"):
             if self._leftexpr.name:
                 CGotoLabel.overtake(self)
                 self.name = self._leftexpr.name
-                self._type_tokens[:] = []
+                self._type_tokens = []
             else:
                 stateStruct.error("statement parsing: got ':' after " + repr(self._leftexpr) + "; looks like a goto-label but has no name")
             self.finalize(stateStruct)
@@ -2962,7 +3843,8 @@ class CStatement(_CBaseWithOptBody):
         if self._state == 0 and openingBracketToken.content == "{": # array args or struct args
             arrayArgs = CCurlyArrayArgs(parent=self)
             self._leftexpr = arrayArgs
-            arrayArgs._bracketlevel = list(openingBracketToken.brackets)
+            arrayArgs._bracketlevel = openingBracketToken.level
+            arrayArgs.args = []
             cpre3_parse_statements_in_brackets(stateStruct, arrayArgs, COp(","), arrayArgs.args, input_iter)
             arrayArgs.finalize(stateStruct)
             self._state = 5
@@ -2979,7 +3861,7 @@ class CStatement(_CBaseWithOptBody):
                 assert isinstance(funcCall.args[0], CStatement)
                 funcCall.args[0]._cpre3_parse_brackets(stateStruct, openingBracketToken, input_iter)
             else:
-                funcCall._bracketlevel = list(openingBracketToken.brackets)
+                funcCall._bracketlevel = openingBracketToken.level
                 subStatement = CStatement(parent=funcCall)
                 funcCall.args += [subStatement]
                 subStatement._cpre3_parse_brackets(stateStruct, openingBracketToken, input_iter)
@@ -3006,7 +3888,8 @@ class CStatement(_CBaseWithOptBody):
             else:
                 self._rightexpr = funcCall
             funcCall.base = ref
-            funcCall._bracketlevel = list(openingBracketToken.brackets)
+            funcCall._bracketlevel = openingBracketToken.level
+            funcCall.args = []
             cpre3_parse_statements_in_brackets(stateStruct, funcCall, COp(","), funcCall.args, input_iter)
             funcCall.finalize(stateStruct)
             return
@@ -3049,17 +3932,16 @@ class CStatement(_CBaseWithOptBody):
             if isinstance(token, COpeningBracket):
                 subStatement._cpre3_parse_brackets(stateStruct, token, input_iter)
             elif isinstance(token, CClosingBracket):
-                if token.brackets == openingBracketToken.brackets:
+                if token.level == openingBracketToken.level:
                     subStatement.finalize(stateStruct, addToContent=False)
-                    self._tokens += [subStatement]
                     finalized = True
                     break
                 else:
-                    stateStruct.error("cpre3 statement parse brackets: internal error, closing brackets " + str(token.brackets) + " not expected")
+                    stateStruct.error("cpre3 statement parse brackets: internal error, closing brackets " + str(token.level) + " not expected")
             else:
                 subStatement._cpre3_handle_token(stateStruct, token)
         if not finalized:
-            stateStruct.error("cpre3 statement parse brackets: incomplete, missing closing bracket '" + openingBracketToken.content + "' at level " + str(openingBracketToken.brackets))
+            stateStruct.error("cpre3 statement parse brackets: incomplete, missing closing bracket '" + openingBracketToken.content + "' at level " + str(openingBracketToken.level))
             return
         if openingBracketToken.content == "(" and subStatement.isCType():
             # This is a C-style-cast.
@@ -3190,19 +4072,31 @@ def cpre3_parse_union(stateStruct, curCObj, input_iter):
     curCObj.finalize(stateStruct)
 
 def cpre3_parse_funcbody(stateStruct, curCObj, input_iter):
-    curCObj.body = CBody(parent=curCObj.parent.body)
-    cpre3_parse_body(stateStruct, curCObj, input_iter)
+    mode = stateStruct.FuncBodyMode
+    if mode == "parse":
+        curCObj.body = CBody(parent=curCObj.parent.body)
+        cpre3_parse_body(stateStruct, curCObj, input_iter)
+    elif mode == "tokens":
+        curCObj.body = _cpre3_read_bracketcontent(stateStruct, curCObj._bracketlevel, input_iter)
+        curCObj.body.func = curCObj
+    elif mode == "skip":
+        _cpre3_parse_skipbracketcontent(stateStruct, curCObj._bracketlevel, input_iter)
+        curCObj.body = CFuncBodyTokens(bracketlevel=curCObj._bracketlevel, func=curCObj)
+    else:
+        stateStruct.error("cpre3 parse func body: unknown FuncBodyMode %r" % (mode,))
+        curCObj.body = CBody(parent=curCObj.parent.body)
+        cpre3_parse_body(stateStruct, curCObj, input_iter)
     curCObj.finalize(stateStruct)
 
 def cpre3_parse_funcpointername(stateStruct, curCObj, input_iter):
-    bracketLevel = list(curCObj._bracketlevel)
+    bracketLevel = curCObj._bracketlevel
     state = 0
     for token in input_iter:
         if isinstance(token, CClosingBracket):
-            if token.brackets == bracketLevel:
+            if token.level == bracketLevel:
                 return
-            if not _isBracketLevelOk(bracketLevel, token.brackets):
-                stateStruct.error("cpre3 parse func pointer name: internal error: bracket level messed up with closing bracket: " + str(token.brackets))
+            if not _isBracketLevelOk(bracketLevel, token.level):
+                stateStruct.error("cpre3 parse func pointer name: internal error: bracket level messed up with closing bracket: " + str(token.level))
 
         if state == 0:
             if token == COp("*"):
@@ -3229,7 +4123,7 @@ def cpre3_parse_funcpointername(stateStruct, curCObj, input_iter):
         elif state == 2: # after identifier in func ptr
             if token == COpeningBracket("["):
                 arrayBaseObj = curCObj.parent
-                arrayBaseObj._bracketlevel = list(token.brackets)
+                arrayBaseObj._bracketlevel = token.level
                 cpre3_parse_arrayargs(stateStruct, arrayBaseObj, input_iter)
                 arrayBaseObj._bracketlevel = bracketLevel
             else:
@@ -3278,7 +4172,7 @@ def cpre3_parse_enum(stateStruct, parentCObj, input_iter):
             else:
                 stateStruct.error("cpre3 parse enum: unexpected op ',' after " + str(curCObj) + " in state " + str(state))
         elif isinstance(token, CClosingBracket):
-            if token.brackets == parentCObj._bracketlevel:
+            if token.level == parentCObj._bracketlevel:
                 if curCObj:
                     if state == 2:
                         valueStmnt.finalize(stateStruct, addToContent=False)
@@ -3286,8 +4180,8 @@ def cpre3_parse_enum(stateStruct, parentCObj, input_iter):
                     curCObj.finalize(stateStruct)
                 parentCObj.finalize(stateStruct)
                 return
-            if not _isBracketLevelOk(parentCObj._bracketlevel, token.brackets):
-                stateStruct.error("cpre3 parse enum: internal error: bracket level messed up with closing bracket: " + str(token.brackets))
+            if not _isBracketLevelOk(parentCObj._bracketlevel, token.level):
+                stateStruct.error("cpre3 parse enum: internal error: bracket level messed up with closing bracket: " + str(token.level))
         elif state == 2:
             if isinstance(token, COpeningBracket):
                 valueStmnt._cpre3_parse_brackets(stateStruct, token, input_iter)
@@ -3298,14 +4192,40 @@ def cpre3_parse_enum(stateStruct, parentCObj, input_iter):
     stateStruct.error("cpre3 parse enum: incomplete, missing '}' on level " + str(parentCObj._bracketlevel))
 
 def _cpre3_parse_skipbracketcontent(stateStruct, bracketlevel, input_iter):
+    if isinstance(input_iter, CTokenArray) and input_iter.skipBracketContent(bracketlevel):
+        return
+    for token in input_iter:
+        if isinstance(token, CClosingBracket):
+            if token.level == bracketlevel:
+                return
+            if not _isBracketLevelOk(bracketlevel, token.level):
+                stateStruct.error("cpre3 parse skip brackets: internal error: bracket level messed up with closing bracket: " + str(token.level))
+    stateStruct.error("cpre3 parse: incomplete, missing closing bracket on level " + str(bracketlevel))
+
+def _iter_bracketcontent(stateStruct, bracketlevel, input_iter):
     for token in input_iter:
+        yield token
         if isinstance(token, CClosingBracket):
-            if token.brackets == bracketlevel:
+            if token.level == bracketlevel:
                 return
-            if not _isBracketLevelOk(bracketlevel, token.brackets):
-                stateStruct.error("cpre3 parse skip brackets: internal error: bracket level messed up with closing bracket: " + str(token.brackets))
+            if not _isBracketLevelOk(bracketlevel, token.level):
+                stateStruct.error("cpre3 read brackets: internal error: bracket level messed up with closing bracket: " + str(token.level))
     stateStruct.error("cpre3 parse: incomplete, missing closing bracket on level " + str(bracketlevel))
 
+def _cpre3_read_bracketcontent(stateStruct, bracketlevel, input_iter):
+    """
+    Like _cpre3_parse_skipbracketcontent, but keeps the tokens.
+
+    :rtype: CFuncBodyTokens
+    """
+    if isinstance(input_iter, CTokenArray):
+        start = input_iter.pos
+        if input_iter.skipBracketContent(bracketlevel):
+            return input_iter.span(start, input_iter.pos, bracketlevel=bracketlevel)
+    # Reading the tokens (from cpre2_parse) also records their preprocessor positions.
+    tokenArray = CTokenArray(_iter_bracketcontent(stateStruct, bracketlevel, input_iter), stateStruct)
+    return tokenArray.span(0, len(tokenArray), bracketlevel=bracketlevel)
+
 def cpre3_parse_funcargs(stateStruct, parentCObj, input_iter):
     curCObj = CFuncArgDecl(parent=parentCObj)
     typeObj = None
@@ -3347,7 +4267,7 @@ def cpre3_parse_funcargs(stateStruct, parentCObj, input_iter):
             else:
                 curCObj._type_tokens += [token.content]
         elif isinstance(token, COpeningBracket):
-            curCObj._bracketlevel = list(token.brackets)
+            curCObj._bracketlevel = token.level
             if token.content == "(":
                 if len(curCObj._type_tokens) == 1 and isinstance(curCObj._type_tokens[0], CFuncPointerDecl):
                     typeObj = curCObj._type_tokens[0]
@@ -3356,8 +4276,8 @@ def cpre3_parse_funcargs(stateStruct, parentCObj, input_iter):
                 elif curCObj.name is None:
                     typeObj = CFuncPointerDecl(parent=curCObj.parent)
                     typeObj._bracketlevel = curCObj._bracketlevel
-                    typeObj._type_tokens[:] = curCObj._type_tokens
-                    curCObj._type_tokens[:] = [typeObj]
+                    typeObj._type_tokens = list(curCObj._type_tokens)
+                    curCObj._type_tokens = [typeObj]
                     cpre3_parse_funcpointername(stateStruct, typeObj, input_iter)
                     curCObj.name = typeObj.name
                 else:
@@ -3369,12 +4289,12 @@ def cpre3_parse_funcargs(stateStruct, parentCObj, input_iter):
                 stateStruct.error("cpre3 parse func args: unexpected opening bracket '" + token.content + "'")
                 _cpre3_parse_skipbracketcontent(stateStruct, curCObj._bracketlevel, input_iter)
         elif isinstance(token, CClosingBracket):
-            if token.brackets == parentCObj._bracketlevel:
+            if token.level == parentCObj._bracketlevel:
                 if curCObj:
                     curCObj.finalize(stateStruct)
                 return
-            if not _isBracketLevelOk(parentCObj._bracketlevel, token.brackets):
-                stateStruct.error("cpre3 parse func args: internal error: bracket level messed up with closing bracket: " + str(token.brackets))
+            if not _isBracketLevelOk(parentCObj._bracketlevel, token.level):
+                stateStruct.error("cpre3 parse func args: internal error: bracket level messed up with closing bracket: " + str(token.level))
             # no error. we already errored on the opening bracket. and the cpre2 parsing ensures the rest
         else:
             stateStruct.error("cpre3 parse func args: unexpected token " + str(token))
@@ -3384,7 +4304,7 @@ def cpre3_parse_funcargs(stateStruct, parentCObj, input_iter):
 def cpre3_parse_arrayargs(stateStruct, curCObj, input_iter):
     valueStmnt = CStatement()
     valueStmnt._bracketlevel = curCObj._bracketlevel
-    valueStmnt._cpre3_parse_brackets(stateStruct, COpeningBracket("[", brackets=curCObj._bracketlevel), input_iter)
+    valueStmnt._cpre3_parse_brackets(stateStruct, COpeningBracket("[", level=curCObj._bracketlevel), input_iter)
     assert isinstance(valueStmnt._leftexpr, CArrayStatement)
     if isinstance(curCObj, (CVarDecl, CFuncArgDecl, CFuncPointerDecl)):
         arrayType = make_type_from_typetokens(stateStruct, curCObj, curCObj._type_tokens)
@@ -3432,13 +4352,13 @@ def cpre3_parse_typedef(stateStruct, curCObj, input_iter):
             elif token == COp("*"):
                 curCObj._type_tokens += ["*"]
             elif isinstance(token, COpeningBracket):
-                curCObj._bracketlevel = list(token.brackets)
+                curCObj._bracketlevel = token.level
                 if token.content == "(":
                     if len(curCObj._type_tokens) == 0 or not isinstance(curCObj._type_tokens[0], CFuncPointerDecl):
                         typeObj = CFuncPointerDecl(parent=curCObj.parent)
                         typeObj._bracketlevel = curCObj._bracketlevel
-                        typeObj._type_tokens[:] = curCObj._type_tokens
-                        curCObj._type_tokens[:] = [typeObj]
+                        typeObj._type_tokens = list(curCObj._type_tokens)
+                        curCObj._type_tokens = [typeObj]
                         if curCObj.name is None: # eg.: typedef int (*Function)();
                             cpre3_parse_funcpointername(stateStruct, typeObj, input_iter)
                             curCObj.name = typeObj.name
@@ -3474,10 +4394,10 @@ def cpre3_parse_typedef(stateStruct, curCObj, input_iter):
         elif state == 11: # unexpected bracket
             # just ignore everything until we get the closing bracket
             if isinstance(token, CClosingBracket):
-                if token.brackets == curCObj._bracketlevel:
+                if token.level == curCObj._bracketlevel:
                     state = 0
-                if not _isBracketLevelOk(curCObj._bracketlevel, token.brackets):
-                    stateStruct.error("cpre3 parse typedef: internal error: bracket level messed up with closing bracket: " + str(token.brackets))
+                if not _isBracketLevelOk(curCObj._bracketlevel, token.level):
+                    stateStruct.error("cpre3 parse typedef: internal error: bracket level messed up with closing bracket: " + str(token.level))
         else:
             stateStruct.error("cpre3 parse typedef: internal error. unexpected state " + str(state))
     stateStruct.error("cpre3 parse typedef: incomplete, missing ';'")
@@ -3638,7 +4558,7 @@ CControlStructures = dict(map(lambda c: (c.Keyword, c), [
 ]))
 
 def cpre3_parse_statements_in_brackets(stateStruct, parentCObj, sepToken, addToList, input_iter):
-    brackets = list(parentCObj._bracketlevel)
+    brackets = parentCObj._bracketlevel
     curCObj = _CBaseWithOptBody(parent=parentCObj)
     def _make_statement(o):
         assert not o.isDerived()
@@ -3675,7 +4595,7 @@ def cpre3_parse_statements_in_brackets(stateStruct, parentCObj, sepToken, addToL
                     # e.g. like "struct {...} X" and we parse "X"
                     oldObj = curCObj
                     curCObj = CVarDecl(parent=parentCObj)
-                    curCObj._type_tokens[:] = [oldObj]
+                    curCObj._type_tokens = [oldObj]
 
                 if curCObj.name is None:
                     curCObj.name = token.content
@@ -3706,7 +4626,7 @@ def cpre3_parse_statements_in_brackets(stateStruct, parentCObj, sepToken, addToL
                 CStatement.overtake(curCObj)
                 curCObj._cpre3_parse_brackets(stateStruct, token, input_iter)
         elif isinstance(token, CClosingBracket):
-            if token.brackets == brackets:
+            if token.level == brackets:
                 break
             stateStruct.error("cpre3 parse statements in brackets: unexpected closing bracket '" + token.content + "' after " + str(curCObj) + " at bracket level " + str(brackets))
         elif token == sepToken:
@@ -3737,7 +4657,7 @@ def cpre3_parse_single_next_statement(stateStruct, parentCObj, input_iter):
     for token in input_iter:
         if isinstance(token, COpeningBracket):
             if token.content == "{":
-                parentCObj._bracketlevel = list(token.brackets)
+                parentCObj._bracketlevel = token.level
                 cpre3_parse_body(stateStruct, parentCObj, input_iter)
                 return
             if curCObj is None:
@@ -3747,17 +4667,18 @@ def cpre3_parse_single_next_statement(stateStruct, parentCObj, input_iter):
             elif curCObj is not None and isinstance(curCObj.body, CStatement):
                 curCObj.body._cpre3_parse_brackets(stateStruct, token, input_iter)
             elif isinstance(curCObj, CControlStructureBase):
-                curCObj._bracketlevel = list(token.brackets)
+                curCObj._bracketlevel = token.level
                 if token.content == "(":
+                    curCObj.args = list(curCObj.args)
                     cpre3_parse_statements_in_brackets(stateStruct, curCObj, sepToken=CSemicolon(), addToList=curCObj.args, input_iter=input_iter)
-                    curCObj._bracketlevel = list(parentCObj._bracketlevel)
+                    curCObj._bracketlevel = parentCObj._bracketlevel
                     lasttoken = cpre3_parse_single_next_statement(stateStruct, curCObj, input_iter)
                     curCObj.finalize(stateStruct)
                     parentCObj.addToBody(curCObj)
                     return lasttoken
                 elif token.content == "[":
                     stateStruct.error("cpre3 parse single after " + str(curCObj) + ": got unexpected '['")
-                    _cpre3_parse_skipbracketcontent(stateStruct, list(token.brackets), input_iter)
+                    _cpre3_parse_skipbracketcontent(stateStruct, token.level, input_iter)
                     return
                 elif token.content == "{":
                     if curCObj.body is not None:
@@ -3768,12 +4689,12 @@ def cpre3_parse_single_next_statement(stateStruct, parentCObj, input_iter):
                     return
                 else:
                     stateStruct.error("cpre3 parse single after " + str(curCObj) + ": got unexpected/unknown opening bracket '" + token.content + "'")
-                    _cpre3_parse_skipbracketcontent(stateStruct, list(token.brackets), input_iter)
+                    _cpre3_parse_skipbracketcontent(stateStruct, token.level, input_iter)
                     return
             else:
                 stateStruct.error("cpre3 parse single: unexpected opening bracket '" + token.content + "' after " + str(curCObj))
         elif isinstance(token, CClosingBracket):
-            if token.brackets == parentCObj._bracketlevel:
+            if token.level == parentCObj._bracketlevel:
                 stateStruct.error("cpre3 parse single: closed brackets without expected statement")
                 return token
             stateStruct.error("cpre3 parse single: unexpected closing bracket '" + token.content + "' after " + str(curCObj) + " at bracket level " + str(parentCObj._bracketlevel))
@@ -3788,7 +4709,7 @@ def cpre3_parse_single_next_statement(stateStruct, parentCObj, input_iter):
             curCObj = CControlStructures[token.content](parent=parentCObj)
             curCObj.defPos = stateStruct.curPosAsStr()
             if isinstance(curCObj, (CElseStatement,CDoStatement)):
-                curCObj._bracketlevel = list(parentCObj._bracketlevel)
+                curCObj._bracketlevel = parentCObj._bracketlevel
                 lasttoken = cpre3_parse_single_next_statement(stateStruct, curCObj, input_iter)
                 # We finalize in any way, also for 'do'. We don't do any semantic checks here
                 # if there is a correct 'while' following or neither if the 'else' has a previous 'if'.
@@ -3830,6 +4751,15 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
     """
     if parentCObj.body is None:
         parentCObj.body = CBody(parent=parentCObj.parent.body)
+    scopes = stateStruct._cpre3_scopes
+    marker = scopes.push(stateStruct, parentCObj)
+    try:
+        _cpre3_parse_body(stateStruct, parentCObj, input_iter)
+    finally:
+        scopes.pop(marker)
+
+
+def _cpre3_parse_body(stateStruct, parentCObj, input_iter):
 
     curCObj = _CBaseWithOptBody(parent=parentCObj)
 
@@ -3854,7 +4784,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                     stateStruct.error("cpre3 parse after " + str(curCObj) + ": got second identifier '" + token.content + "'")
             elif isinstance(curCObj, CCaseStatement):
                 if not curCObj.args or not isinstance(curCObj.args[-1], CStatement):
-                    curCObj.args.append(CStatement(parent=parentCObj))
+                    curCObj.args += [CStatement(parent=parentCObj)]
                 curCObj.args[-1]._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CControlStructureBase):
                 stateStruct.error("cpre3 parse after " + str(curCObj) + ": didn't expected identifier '" + token.content + "'")
@@ -3883,12 +4813,12 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 CControlStructures[token.content].overtake(curCObj)
                 curCObj.defPos = stateStruct.curPosAsStr()
                 if isinstance(curCObj, (CElseStatement,CDoStatement)):
-                    curCObj._bracketlevel = list(parentCObj._bracketlevel)
+                    curCObj._bracketlevel = parentCObj._bracketlevel
                     lasttoken = cpre3_parse_single_next_statement(stateStruct, curCObj, input_iter)
                     # We finalize in any way, also for 'do'. We don't do any semantic checks here
                     # if there is a correct 'while' following or neither if the 'else' has a previous 'if'.
                     curCObj.finalize(stateStruct)
-                    if isinstance(lasttoken, CClosingBracket) and lasttoken.brackets == parentCObj._bracketlevel:
+                    if isinstance(lasttoken, CClosingBracket) and lasttoken.level == parentCObj._bracketlevel:
                         return
                     curCObj = _CBaseWithOptBody(parent=parentCObj)
                 elif isinstance(curCObj, CReturnStatement):
@@ -3912,7 +4842,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                     # e.g. like "struct {...} X" and we parse "X"
                     oldObj = curCObj
                     curCObj = CVarDecl(parent=parentCObj)
-                    curCObj._type_tokens[:] = [oldObj]
+                    curCObj._type_tokens = [oldObj]
 
                 if curCObj.name is None:
                     curCObj.name = token.content
@@ -3955,7 +4885,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                     curCObj = _CBaseWithOptBody(parent=parentCObj)
                 else:
                     if not curCObj.args or not isinstance(curCObj.args[-1], CStatement):
-                        curCObj.args.append(CStatement(parent=parentCObj))
+                        curCObj.args += [CStatement(parent=parentCObj)]
                     curCObj.args[-1]._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CCaseDefaultStatement) and token.content == ":":
                 curCObj.finalize(stateStruct)
@@ -3971,7 +4901,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                         curCObj.finalize(stateStruct)
                         oldObj = curCObj
                         curCObj = CVarDecl(parent=parentCObj)
-                        curCObj._type_tokens[:] = [oldObj, "*"]
+                        curCObj._type_tokens = [oldObj, "*"]
                     else:
                         CVarDecl.overtake(curCObj)
                         curCObj._type_tokens += [token.content]
@@ -4009,7 +4939,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 curCObj.body._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CCaseStatement):
                 if not curCObj.args or not isinstance(curCObj.args[-1], CStatement):
-                    curCObj.args.append(CStatement(parent=parentCObj))
+                    curCObj.args += [CStatement(parent=parentCObj)]
                 curCObj.args[-1]._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CControlStructureBase):
                 stateStruct.error("cpre3 parse after " + str(curCObj) + ": didn't expected number '" + str(token.content) + "'")
@@ -4017,9 +4947,9 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 CStatement.overtake(curCObj)
                 curCObj._cpre3_handle_token(stateStruct, token)
         elif isinstance(token, COpeningBracket):
-            curCObj._bracketlevel = list(token.brackets)
-            if not _isBracketLevelOk(parentCObj._bracketlevel, token.brackets):
-                stateStruct.error("cpre3 parse body: internal error: bracket level messed up with opening bracket: " + str(token.brackets) + " on level " + str(parentCObj._bracketlevel) + " in " + str(parentCObj))
+            curCObj._bracketlevel = token.level
+            if not _isBracketLevelOk(parentCObj._bracketlevel, token.level):
+                stateStruct.error("cpre3 parse body: internal error: bracket level messed up with opening bracket: " + str(token.level) + " on level " + str(parentCObj._bracketlevel) + " in " + str(parentCObj))
             if isinstance(curCObj, CStatement):
                 if token.content == "{":
                     cpre3_parse_body(stateStruct, curCObj, input_iter)
@@ -4031,20 +4961,21 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 curCObj.body._cpre3_parse_brackets(stateStruct, token, input_iter)
             elif isinstance(curCObj, CCaseStatement):
                 if not curCObj.args or not isinstance(curCObj.args[-1], CStatement):
-                    curCObj.args.append(CStatement(parent=parentCObj))
+                    curCObj.args += [CStatement(parent=parentCObj)]
                 curCObj.args[-1]._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CControlStructureBase):
                 if token.content == "(":
+                    curCObj.args = list(curCObj.args)
                     cpre3_parse_statements_in_brackets(stateStruct, curCObj, sepToken=CSemicolon(), addToList=curCObj.args, input_iter=input_iter)
-                    curCObj._bracketlevel = list(parentCObj._bracketlevel or [])
+                    curCObj._bracketlevel = parentCObj._bracketlevel or 0
                     lasttoken = cpre3_parse_single_next_statement(stateStruct, curCObj, input_iter)
                     curCObj.finalize(stateStruct)
-                    if isinstance(lasttoken, CClosingBracket) and lasttoken.brackets == parentCObj._bracketlevel:
+                    if isinstance(lasttoken, CClosingBracket) and lasttoken.level == parentCObj._bracketlevel:
                         return
                     curCObj = _CBaseWithOptBody(parent=parentCObj)
                 elif token.content == "[":
                     stateStruct.error("cpre3 parse after " + str(curCObj) + ": got unexpected '['")
-                    _cpre3_parse_skipbracketcontent(stateStruct, list(token.brackets), input_iter)
+                    _cpre3_parse_skipbracketcontent(stateStruct, token.level, input_iter)
                 elif token.content == "{":
                     if curCObj.body is not None:
                         stateStruct.error("cpre3 parse after " + str(curCObj) + ": got multiple bodies")
@@ -4053,7 +4984,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                     curCObj = _CBaseWithOptBody(parent=parentCObj)
                 else:
                     stateStruct.error("cpre3 parse after " + str(curCObj) + ": got unexpected/unknown opening bracket '" + token.content + "'")
-                    _cpre3_parse_skipbracketcontent(stateStruct, list(token.brackets), input_iter)
+                    _cpre3_parse_skipbracketcontent(stateStruct, token.level, input_iter)
             elif token.content == "(":
                 if len(curCObj._type_tokens) == 0:
                     CStatement.overtake(curCObj)
@@ -4061,9 +4992,9 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 elif curCObj.name is None:
                     typeObj = CFuncPointerDecl(parent=curCObj)
                     typeObj._bracketlevel = curCObj._bracketlevel
-                    typeObj._type_tokens[:] = curCObj._type_tokens
+                    typeObj._type_tokens = list(curCObj._type_tokens)
                     CVarDecl.overtake(curCObj)
-                    curCObj._type_tokens[:] = [typeObj]
+                    curCObj._type_tokens = [typeObj]
                     cpre3_parse_funcpointername(stateStruct, typeObj, input_iter)
                     curCObj.name = typeObj.name
                 elif len(curCObj._type_tokens) == 1 and isinstance(curCObj._type_tokens[0], CFuncPointerDecl):
@@ -4106,10 +5037,10 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 curCObj = _CBaseWithOptBody(parent=parentCObj)
             else:
                 stateStruct.error("cpre3 parse: unexpected closing bracket '" + token.content + "' after " + str(curCObj))
-            if token.brackets == parentCObj._bracketlevel:
+            if token.level == parentCObj._bracketlevel:
                 return
-            if not _isBracketLevelOk(parentCObj._bracketlevel, token.brackets):
-                stateStruct.error("cpre3 parse body: internal error: bracket level messed up with closing bracket: " + str(token.brackets) + " on level " + str(parentCObj._bracketlevel) + " in " + str(parentCObj))
+            if not _isBracketLevelOk(parentCObj._bracketlevel, token.level):
+                stateStruct.error("cpre3 parse body: internal error: bracket level messed up with closing bracket: " + str(token.level) + " on level " + str(parentCObj._bracketlevel) + " in " + str(parentCObj))
         elif isinstance(token, CSemicolon):
             if not curCObj.isDerived() and curCObj:
                 CVarDecl.overtake(curCObj)
@@ -4123,7 +5054,7 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
                 curCObj.body._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CCaseStatement):
                 if not curCObj.args or not isinstance(curCObj.args[-1], CStatement):
-                    curCObj.args.append(CStatement(parent=parentCObj))
+                    curCObj.args += [CStatement(parent=parentCObj)]
                 curCObj.args[-1]._cpre3_handle_token(stateStruct, token)
             elif isinstance(curCObj, CControlStructureBase):
                 stateStruct.error("cpre3 parse after " + str(curCObj) + ": didn't expected " + str(token))
@@ -4142,15 +5073,217 @@ def cpre3_parse_body(stateStruct, parentCObj, input_iter):
         stateStruct.error("cpre3 parse: read until end without closing brackets " + str(parentCObj._bracketlevel) + " in " + str(parentCObj))
 
 
+class CTokenArray(object):
+    """
+    Materialized cpre2_parse output, with random access.
+    It can be used as the input for cpre3_parse.
+    The index of the matching bracket of every bracket token is calculated in advance,
+    so that we can skip over the content of brackets (e.g. a function body) in O(1).
+    """
+
+    def __init__(self, tokens, stateStruct=None):
+        """
+        :param typing.Iterable[_CBase] tokens: e.g. from cpre2_parse
+        :param State|None stateStruct: if given, we record the preprocessor position for the tokens,
+            which will be used by stateStruct.curPosAsStr() while cpre3_parse reads them
+        """
+        # The position is the same as when cpre3_parse would have read directly from cpre2_parse.
+        # We store it only when it changes.
+        self._posIdxs = array.array("l")  # token index where the position changes
+        self._posStrs = []  # for each entry in _posIdxs
+        if stateStruct is None:
+            self._startPos = "<out-of-scope>"
+            tokens = list(tokens)
+        else:
+            self._startPos = stateStruct.curPosAsStr()
+            tokens = self._readTokensWithPos(tokens, stateStruct)
+        self.tokens = tokens
+        self.matching = matching = array.array("l", [-1]) * len(tokens)
+        openIdxs = []
+        for i, token in enumerate(tokens):
+            if token.__class__ is COpeningBracket:
+                openIdxs.append(i)
+            elif token.__class__ is CClosingBracket and openIdxs:
+                j = openIdxs.pop()
+                matching[i] = j
+                matching[j] = i
+        # All iteration (also via `for token in tokenArray`) goes over this list iterator.
+        self._iter = iter(tokens)
+
+    def _readTokensWithPos(self, tokens, stateStruct):
+        tokenList = []
+        lastLevel, lastLine, lastChar = None, None, None
+        for token in tokens:
+            tokenList.append(token)
+            levels = stateStruct._preprocessIncludeLevel
+            level = levels[-1] if levels else None
+            if level is lastLevel and (level is None or (level[2] == lastLine and level[3] == lastChar)):
+                continue
+            lastLevel = level
+            if level is not None:
+                lastLine, lastChar = level[2], level[3]
+            self._posIdxs.append(len(tokenList) - 1)
+            self._posStrs.append(stateStruct.curPosAsStr())
+        return tokenList
+
+    def curPosAsStr(self):
+        """
+        :return: the preprocessor position after the last consumed token
+        :rtype: str
+        """
+        i = bisect.bisect_right(self._posIdxs, self.pos - 1) - 1
+        if i < 0: return self._startPos
+        return self._posStrs[i]
+
+    def __iter__(self):
+        return self._iter
+
+    def __next__(self):
+        return next(self._iter)
+
+    next = __next__  # Python 2
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @property
+    def pos(self):
+        """
+        :return: index of the next token
+        :rtype: int
+        """
+        return len(self.tokens) - self._iter.__length_hint__()
+
+    def peek(self, offset=0):
+        """
+        :return: the token at pos + offset without consuming anything, or None
+        :rtype: _CBase|None
+        """
+        idx = self.pos + offset
+        if 0 <= idx < len(self.tokens): return self.tokens[idx]
+        return None
+
+    def seek(self, idx):
+        """
+        :param int idx: the next token will be tokens[idx]
+        """
+        pos = self.pos
+        if hasattr(self._iter, "__setstate__"):
+            self._iter.__setstate__(idx)
+        elif idx >= pos:  # Python 2
+            next(itertools.islice(self._iter, idx - pos, idx - pos), None)
+        else:
+            raise ValueError("cannot seek backwards in Python 2")
+
+    def span(self, start, end, bracketlevel=None):
+        """
+        :param int start: token index
+        :param int end: token index (exclusive)
+        :param int|None bracketlevel: see CFuncBodyTokens
+        :return: copy of the tokens in [start, end), with their positions
+        :rtype: CFuncBodyTokens
+        """
+        i = bisect.bisect_right(self._posIdxs, start - 1) - 1
+        startPos = self._posStrs[i] if i >= 0 else self._startPos
+        j = bisect.bisect_left(self._posIdxs, start)
+        k = bisect.bisect_left(self._posIdxs, end)
+        return CFuncBodyTokens(
+            tokens=self.tokens[start:end], bracketlevel=bracketlevel,
+            posIdxs=[idx - start for idx in self._posIdxs[j:k]], posStrs=self._posStrs[j:k], startPos=startPos)
+
+    def skipBracketContent(self, bracketlevel):
+        """
+        Assumes that we just consumed an opening bracket.
+        Consumes everything until and including the matching closing bracket.
+
+        :param int bracketlevel: of the opening bracket
+        :return: whether we could do that
+        :rtype: bool
+        """
+        idx = self.pos - 1
+        if idx < 0: return False
+        opening = self.tokens[idx]
+        if opening.__class__ is not COpeningBracket or opening.level != bracketlevel: return False
+        closingIdx = self.matching[idx]
+        if closingIdx < 0: return False
+        self.seek(closingIdx + 1)
+        return True
+
+
+class CFuncBodyTokens(object):
+    """
+    Unparsed function body, i.e. the tokens after the opening '{', including the closing '}',
+    together with their preprocessor positions. See State.FuncBodyMode and CFunc.parseBody.
+    If tokens is None, the body was skipped.
+
+    This is a lazy handle for the CBody: on the first access of any CBody attribute (e.g. contentlist),
+    the function body gets parsed, and CFunc.body is replaced by the CBody.
+    """
+
+    def __init__(self, tokens=None, bracketlevel=None, posIdxs=(), posStrs=(), startPos=None, func=None):
+        self.tokens = tokens
+        self.bracketlevel = bracketlevel
+        self.posIdxs = list(posIdxs)
+        self.posStrs = list(posStrs)
+        self.startPos = startPos
+        self.func = func  # type: typing.Optional[CFunc]
+
+    def __getattr__(self, attr):
+        # Only called for attribs which we don't have. Never for special attribs, e.g. via pickle or copy.
+        if attr.startswith("__") or "func" not in self.__dict__ or self.func is None:
+            raise AttributeError(attr)
+        body = self.func.parseBody()
+        if body is None:
+            raise AttributeError("%s: function body of %s was skipped" % (attr, self.func.name))
+        return getattr(body, attr)
+
+    def __nonzero__(self):
+        return True
+
+    __bool__ = __nonzero__
+
+    def isSkipped(self):
+        return self.tokens is None
+
+    def tokenArray(self):
+        """
+        :return: the tokens to be read by cpre3_parse_body, which reports their original positions
+        :rtype: CTokenArray
+        """
+        assert self.tokens is not None, "function body was skipped"
+        tokenArray = CTokenArray(self.tokens)
+        tokenArray._posIdxs = array.array("l", self.posIdxs)
+        tokenArray._posStrs = self.posStrs
+        tokenArray._startPos = self.startPos
+        return tokenArray
+
+    def __str__(self):
+        if self.tokens is None: return "CFuncBodyTokens <skipped>"
+        return "CFuncBodyTokens <%i tokens>" % len(self.tokens)
+
+    def __repr__(self): return "<%s>" % self
+
+    def asCCode(self, indent=""):
+        if self.tokens is None: return indent + "{ /* skipped */ }"
+        return indent + "{\n" + "".join(cpre2_tokenstream_asCCode(self.tokens[:-1])) + "\n" + indent + "}"
+
+
 def cpre3_parse(stateStruct, input):
     """
     :param State stateStruct:
-    :param input:
+    :param typing.Iterable[_CBase]|CTokenArray input: tokens from cpre2_parse
     """
-    input_iter = iter(input)
     parentObj = _CBaseWithOptBody()
     parentObj.body = stateStruct
-    cpre3_parse_body(stateStruct, parentObj, input_iter)
+    if isinstance(input, CTokenArray):
+        oldTokenArray = stateStruct._cpre3_tokenArray
+        stateStruct._cpre3_tokenArray = input
+        try:
+            cpre3_parse_body(stateStruct, parentObj, input)
+        finally:
+            stateStruct._cpre3_tokenArray = oldTokenArray
+    else:
+        cpre3_parse_body(stateStruct, parentObj, iter(input))
 
 
 def parse(filename, state=None):
@@ -4165,6 +5298,8 @@ def parse(filename, state=None):
 
     preprocessed = state.preprocess_file(filename, local=True)
     tokens = cpre2_parse(state, preprocessed)
+    if state.UseTokenArray:
+        tokens = CTokenArray(tokens, state)
     cpre3_parse(state, tokens)
 
     return state
@@ -4183,6 +5318,8 @@ def parse_code(source_code, state=None):
     try:
         preprocessed = state.preprocess_source_code(source_code)
         tokens = cpre2_parse(state, preprocessed)
+        if state.UseTokenArray:
+            tokens = CTokenArray(tokens, state)
         cpre3_parse(state, tokens)
     except Exception as e:
         state.error("internal exception: %r" % e)
@@ -28,6 +28,14 @@ else:
     # noinspection PyUnresolvedReferences
     unichr = __builtins__["unichr"]
 
+if sys.version_info.major >= 3:
+    intern = sys.intern
+else:
+    _interned = {}
+    def intern(s):
+        # The builtin intern() only accepts str, but we also get unicode.
+        return _interned.setdefault(s, s)
+
 
 def setup_Structure_debug_helper():
     import ctypes
@@ -50,9 +50,10 @@ class CStateWrapper:
     """
 
     WrappedDicts = ("macros","typedefs","structs","unions","enums","funcs","vars","enumconsts")
-    LocalAttribs = ("_cwrapper")
+    LocalAttribs = ("_cwrapper", "_ctype_cache")
     def __init__(self, cwrapper):
         self._cwrapper = cwrapper
+        self._ctype_cache = cparser.CTypeCache()  # see cparser.getCType
     def __getattr__(self, k):
         if k in self.LocalAttribs: raise AttributeError # normally we shouldn't get here but just in case
         if k == "_errors": return getattr(self._cwrapper, k) # fallthrough to CWrapper to collect all errors there
@@ -111,6 +112,7 @@ class CWrapper:
     def register(self, stateStruct, clib):
         stateStruct.clib = clib
         self.stateStructs.append(stateStruct)
+        cparser.invalidateCTypeCaches()
         def iterAllAttribs():
             for attrib in stateStruct.macros:
                 if stateStruct.macros[attrib].args is not None: continue
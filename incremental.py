@@ -0,0 +1,240 @@
+# PyCParser - incremental parsing
+# code under BSD 2-Clause License
+
+# Parses multiple files into one State and allows to parse a single file again after it was changed,
+# without parsing all the other files again.
+# While a file is parsed, the State reports every change of its global dicts
+# (see cparser._recordStateChange), so we know which top-level declarations
+# (and macros, include guards) the file contributed.
+# When we parse the file again, we first retract these: for every entry, we restore the value
+# which we would have without this file, i.e. the value of a later parsed file or the value before.
+# Then we parse the new content and notify the registered Interpreters about the changed names
+# (see interpreter.Interpreter.invalidate).
+#
+# A header is contributed by the file which included it first, because for the following files,
+# it is skipped via its include guard. So it will be parsed again together with that file.
+# C objects of other files which refer to a retracted object (e.g. a typedef of a struct)
+# keep the old object. The lookups by name (e.g. in the Interpreter) get the new one.
+# Note that this does not work together with the caching (caching.py), because a cached header
+# is applied without reporting the changes.
+
+import sys
+if sys.version_info.major == 2:
+    import cparser
+    from cparser_utils import *
+else:
+    from . import cparser
+    from .cparser_utils import *
+
+
+class FileContributions(object):
+    """
+    What one file has contributed to the State.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.changes = []  # (attrib, name, old value), in order. see record
+        self.shadowed = {}  # (attrib, name) -> redeclaration which was not set
+        self.contentlist = []
+        self.errors = []
+
+    def record(self, attrib, name, old, shadowed=None):
+        """
+        Called via cparser._recordStateChange.
+
+        :param str attrib: e.g. "funcs"
+        :param str name:
+        :param old: the previous value, or None
+        :param shadowed: a redeclaration which was not set because the old value was kept
+        """
+        self.changes.append((attrib, name, old))
+        if shadowed is not None:
+            self.shadowed[(attrib, name)] = shadowed
+
+    def keys(self):
+        """
+        :return: all (attrib, name) which this file has changed, in order
+        :rtype: list[(str,str)]
+        """
+        keys = []
+        seen = set()
+        for attrib, name, _ in self.changes:
+            if (attrib, name) in seen: continue
+            seen.add((attrib, name))
+            keys.append((attrib, name))
+        return keys
+
+    def __repr__(self):
+        return "<FileContributions %r: %i changes>" % (self.filename, len(self.changes))
+
+
+def _getValue(state, attrib, name):
+    """
+    :return: the value in the State, or None if there is none
+    """
+    collection = getattr(state, attrib)
+    if isinstance(collection, set):
+        if name in collection: return True
+        return None
+    return collection.get(name)
+
+
+def _setValue(state, attrib, name, value):
+    """
+    :param value: the new value, or None to remove it
+    """
+    collection = getattr(state, attrib)
+    if isinstance(collection, set):
+        if value is None: collection.discard(name)
+        else: collection.add(name)
+    elif value is None:
+        collection.pop(name, None)
+    else:
+        collection[name] = value
+
+
+def _isSameValue(attrib, a, b):
+    """
+    :return: whether b can be used instead of a, e.g. whether we would get the same interpreted code
+    :rtype: bool
+    """
+    if a is b: return True
+    if a is None or b is None: return False
+    if attrib == "macros":
+        if (a.args is None) != (b.args is None): return False
+        return list(a.args or ()) == list(b.args or ()) and a.rightside == b.rightside
+    if attrib == "enumconsts":
+        return a.value == b.value
+    if attrib == "_include_guards":
+        return a == b
+    return False
+
+
+class IncrementalParser(object):
+    """
+    Parses files into a State, and allows to parse them again when they change.
+    """
+
+    def __init__(self, state=None):
+        """
+        :param cparser.State|None state: where we parse into
+        """
+        if state is None:
+            state = cparser.State()
+            state.autoSetupSystemMacros()
+        self.state = state
+        self.files = {}  # filename -> FileContributions
+        self.interpreters = []
+        # (attrib, name) -> (value without any parsed files, [(FileContributions, value), ...] in parse order).
+        # The value in the State is always the last one.
+        self._layers = {}
+
+    def register(self, interpreter):
+        """
+        Registers the State in the Interpreter, and invalidates it when we parse a file again.
+
+        :param interpreter.Interpreter interpreter:
+        """
+        interpreter.register(self.state)
+        self.interpreters.append(interpreter)
+
+    def parse(self, filename):
+        """
+        Parses the file, or parses it again if we have already parsed it before.
+
+        :param str filename:
+        :return: the changed (attrib, name), e.g. [("funcs", "main")]
+        :rtype: list[(str,str)]
+        """
+        oldValues = {}  # (attrib, name) -> value before
+        if filename in self.files:
+            self._retract(self.files.pop(filename), oldValues)
+        contrib = FileContributions(filename)
+        state = self.state
+        numContent = len(state.contentlist)
+        numErrors = len(state._errors)
+        state._contributions = contrib
+        try:
+            cparser.parse(filename, state)
+        finally:
+            state._contributions = None
+            # Also in case of an exception, so that we can retract what we got so far.
+            contrib.contentlist = state.contentlist[numContent:]
+            contrib.errors = state._errors[numErrors:]
+            self.files[filename] = contrib
+            self._apply(contrib)
+        for attrib, name, old in contrib.changes:
+            oldValues.setdefault((attrib, name), old)
+        return self._changed(oldValues)
+
+    def _apply(self, contrib):
+        """
+        :param FileContributions contrib: which was just parsed
+        """
+        firstOld = {}
+        for attrib, name, old in contrib.changes:
+            firstOld.setdefault((attrib, name), old)
+        for key in contrib.keys():
+            value = _getValue(self.state, *key)
+            if value is firstOld[key]:
+                # E.g. a redeclaration, where we kept the definition of a later parsed file.
+                # Put it below that, so that we get it back when that file is retracted.
+                if key in self._layers and key in contrib.shadowed:
+                    self._layers[key][1].insert(len(self._layers[key][1]) - 1, (contrib, contrib.shadowed[key]))
+                continue
+            if key not in self._layers:
+                self._layers[key] = (firstOld[key], [])
+            self._layers[key][1].append((contrib, value))
+
+    def retract(self, filename):
+        """
+        Removes everything which the file has contributed, e.g. because it was deleted.
+
+        :param str filename:
+        :return: the changed (attrib, name)
+        :rtype: list[(str,str)]
+        """
+        oldValues = {}
+        self._retract(self.files.pop(filename), oldValues)
+        return self._changed(oldValues)
+
+    def _retract(self, contrib, oldValues):
+        """
+        :param FileContributions contrib:
+        :param dict[(str,str)] oldValues: we add the current values of the changed entries
+        """
+        state = self.state
+        for key in contrib.keys():
+            if key not in self._layers: continue
+            base, layers = self._layers[key]
+            isTop = layers[-1][0] is contrib
+            topValue = layers[-1][1]
+            layers = [(c, v) for (c, v) in layers if c is not contrib]
+            current = _getValue(state, *key)
+            oldValues.setdefault(key, current)
+            if isTop and current is topValue:
+                # Otherwise, it was overwritten by someone else in the meantime, so keep that.
+                if layers: _setValue(state, key[0], key[1], layers[-1][1])
+                else: _setValue(state, key[0], key[1], base)
+            if layers: self._layers[key] = (base, layers)
+            else: del self._layers[key]
+        contentIds = set(map(id, contrib.contentlist))
+        state.contentlist[:] = [obj for obj in state.contentlist if id(obj) not in contentIds]
+        errorIds = set(map(id, contrib.errors))
+        state._errors[:] = [err for err in state._errors if id(err) not in errorIds]
+
+    def _changed(self, oldValues):
+        """
+        :param dict[(str,str)] oldValues: (attrib, name) -> value before
+        :return: the changed (attrib, name), which we also pass to the registered Interpreters
+        :rtype: list[(str,str)]
+        """
+        changes = []
+        for key, old in sorted(oldValues.items(), key=lambda item: item[0]):
+            if not _isSameValue(key[0], old, _getValue(self.state, *key)):
+                changes.append(key)
+        cparser.invalidateCTypeCaches()
+        for interpreter in self.interpreters:
+            interpreter.invalidate(changes)
+        return changes
@@ -129,7 +129,8 @@ class GlobalScope:
                 assert bodyType is None, "not expected: %r" % bodyType
             assert arrayLen, "array without explicit len and without body"
             if not decl_type.arrayLen:
-                decl_type.arrayLen = CNumber(arrayLen)
+                # The types are interned (see cparser._InternedType), so don't modify it.
+                decl_type = decl.type = CArrayType(arrayOf=decl_type.arrayOf, arrayLen=CNumber(arrayLen))
 
         return decl_type, bodyAst, bodyType
 
@@ -195,6 +196,8 @@ def evalValueAst(funcEnv, valueAst, srccode_name=None):
 
 
 class GlobalsWrapper:
+    LocalAttribs = ("globalScope",)
+
     def __init__(self, globalScope):
         """
         :type globalScope: GlobalScope
@@ -227,6 +230,8 @@ class GlobalsWrapper:
 
 
 class GlobalsTypeWrapper:
+    LocalAttribs = ("globalScope", "attrib")
+
     def __init__(self, globalScope, attrib):
         self.globalScope = globalScope
         self.attrib = attrib
@@ -574,11 +579,12 @@ def _makeVal(funcEnv, f_arg_type, s_arg_ast, s_arg_type):
     return s_arg_ast
 
 
-def getAstNode_newTypeInstance(funcEnv, objType, argAst=None, argType=None):
+def getAstNode_newTypeInstance(funcEnv, objType, argAst=None, argType=None, decl=None):
     """
     Create a new instance of type `objType`.
     It can optionally be initialized with `argAst` (already AST) which is of type `argType`.
     If `argType` is None, `argAst` is supposed to be a value (e.g. via getAstNode_valueFromObj).
+    If `decl` is given and has an array type with implicit length, we set the complete type there.
     :type interpreter: Interpreter
     """
     interpreter = funcEnv.interpreter
@@ -612,8 +618,10 @@ def getAstNode_newTypeInstance(funcEnv, objType, argAst=None, argType=None):
                 assert isinstance(argType, CArrayType)
                 arrayLen = getConstValue(interpreter.globalScope.stateStruct, argType.arrayLen)
                 assert arrayLen is not None
-            # Write back to type so that future getCType calls will succeed.
-            objType.arrayLen = CNumber(arrayLen)
+            # Write back so that future getCType calls will succeed.
+            # The types are interned (see cparser._InternedType), so don't modify it.
+            if decl is not None and decl.type is objType:
+                decl.type = CArrayType(arrayOf=objType.arrayOf, arrayLen=CNumber(arrayLen))
 
         typeAst = ast.BinOp(left=arrayOf, op=ast.Mult(), right=ast.Num(n=arrayLen))
     else:
@@ -773,9 +781,9 @@ class FuncCodeblockScope:
                 if v is not None and not v:
                     # If we want to init with 0, we can skip this because we are always zero initialized.
                     bodyAst = t = None
-                a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type, bodyAst, t)
+                a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type, bodyAst, t, decl=varDecl)
             else:
-                a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type)
+                a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type, decl=varDecl)
         elif isinstance(varDecl, CFunc):
             # TODO: register func, ...
             a.value = ast.Name(id="None", ctx=ast.Load())
@@ -1375,12 +1383,9 @@ def _resolveOffsetOf(stateStruct, stmnt):
         while isinstance(base, CTypedef):
             base = base.type
         assert isinstance(base, (CStruct, CUnion))
-        c_type = getCType(base, stateStruct)
-        field = getattr(c_type, k)
+        field = base.getLayout(stateStruct).fields[k]
         offset += field.offset
-        sub = base.findAttrib(stateStruct, k)
-        assert isinstance(sub, CVarDecl)
-        base = sub.type
+        base = field.decl.type
     return offset
 
 def makeFuncPtrValue(argAst, argType):
@@ -1886,6 +1891,7 @@ class Interpreter:
         self._cStateWrapper.error = self._cStateWrapperError
         self.globalScope = GlobalScope(self, self._cStateWrapper)
         self._func_cache = {}
+        self._func_dependents = {}  # name -> set of funcnames which might refer to it. see invalidate
         self.globalsWrapper = GlobalsWrapper(self.globalScope)
         self.globalsStructWrapper = GlobalsTypeWrapper(self.globalScope, "structs")
         self.globalsUnionsWrapper = GlobalsTypeWrapper(self.globalScope, "unions")
@@ -1922,6 +1928,7 @@ class Interpreter:
         :param State stateStruct:
         """
         self.stateStructs += [stateStruct]
+        invalidateCTypeCaches()
         if stateStruct._global_include_wrapper:
             stateStruct._global_include_wrapper.interpreter = self
 
@@ -2094,6 +2101,8 @@ class Interpreter:
         assert func.name is not None
         base.func = func
         base.astNode.name = func.name
+        # The body might not be parsed yet (see State.FuncBodyMode).
+        body = func.parseBody()
         base.pushScope(base.astNode.body)
         for arg in func.args:
             if isinstance(arg.type, CVariadicArgsType):
@@ -2104,7 +2113,7 @@ class Interpreter:
                 name = base.registerNewVar(arg.name, arg)
                 assert name
                 base.astNode.args.args.append(ast.Name(id=name, ctx=ast.Param()))
-        if func.body is None:
+        if body is None:
             # TODO: search in other C files
             # Hack for now: ignore :)
             if noBodyMode == "warn-empty":
@@ -2119,7 +2128,7 @@ class Interpreter:
             else:
                 assert False, "unknown no-body-mode: %r" % noBodyMode
         else:
-            cCodeToPyAstList(base, func.body)
+            cCodeToPyAstList(base, body)
         base.popScope()
         base.astNode.body.append(astForCReturn(base, None))
         if base.needGotoHandling:
@@ -2168,8 +2177,59 @@ class Interpreter:
         else:
             func = self._translateFuncToPy(funcname)
             self._func_cache[funcname] = func
+            self._addFuncDependencies(funcname, func.__code__)
             return func
 
+    def _addFuncDependencies(self, funcname, code):
+        # The translated code refers to other globals by name, e.g. `g.f` or `structs.A`, see getAstNodeAttrib.
+        # We just take all names from the code object (and the nested ones),
+        # which is a superset of these but much faster than to walk through the AST.
+        names = set([funcname])
+        codes = [code]
+        while codes:
+            code = codes.pop()
+            names.update(code.co_names)
+            codes.extend([c for c in code.co_consts if isinstance(c, type(code))])
+        for name in names:
+            self._func_dependents.setdefault(name, set()).add(funcname)
+
+    def invalidate(self, changes):
+        """
+        Forgets everything which depends on the given global declarations,
+        i.e. the translated functions, the global vars and the bindings in the globals wrappers.
+        This is called by incremental.IncrementalParser when a file was parsed again.
+
+        :param list[(str,str)] changes: (attrib, name), e.g. ("funcs", "main")
+        """
+        globalNames = set()  # via self.globalsWrapper
+        typeBindings = []  # (wrapper, name)
+        for attrib, name in changes:
+            if attrib in GlobalScope.StateScopeDicts:
+                globalNames.add(name)
+            elif attrib in ("structs", "unions"):
+                wrapper = {"structs": self.globalsStructWrapper, "unions": self.globalsUnionsWrapper}[attrib]
+                typeBindings.append((wrapper, name))
+            elif attrib in ("macros", "enumconsts"):
+                # Their values are directly in the translated code, so we don't know the dependents.
+                globalNames.update(self._func_cache.keys())
+        funcnames = set()
+        for name in globalNames | set([name for (_, name) in typeBindings]):
+            funcnames.update(self._func_dependents.pop(name, ()))
+        for funcname in funcnames:
+            self._func_cache.pop(funcname, None)
+        # The other functions refer to them via the globals wrapper, so they get the new ones.
+        globalNames.update(funcnames)
+        for name in globalNames:
+            typeBindings.append((self.globalsWrapper, name))
+            decl = self.globalScope.identifiers.pop(name, None)
+            if decl is not None:
+                self.globalScope.names.pop(id(decl), None)
+            self.globalScope.vars.pop(name, None)
+        for wrapper, name in typeBindings:
+            if name not in wrapper.LocalAttribs:
+                wrapper.__dict__.pop(name, None)
+        invalidateCTypeCaches()
+
     def runSingleStatement(self, statement, dump=False):
         """
         :param CStatement|cparser.CControlStructureBase statement:
@@ -0,0 +1,278 @@
+# PyCParser - parallel parsing
+# code under BSD 2-Clause License
+
+# Parses independent translation units (C files) in worker processes.
+# Every worker starts with a fresh State where we load a snapshot (snapshot.py) of the
+# given base State, so it has all the macros and declarations of the headers which were
+# parsed into the base State. Then it parses its file and sends back pickled what the file
+# has added (see cparser._recordStateChange), in the same way as caching.py stores it:
+# the objects from the global include wrappers and from the base State are stored by reference.
+# Then we merge the per-file States into the base State, like a linker would do:
+# a declaration is replaced by its definition, and two different definitions of the same name
+# are reported as a MergeConflict. A static function or var has internal linkage,
+# so if its name is already defined by another file, it gets a new unique name in the merged State.
+#
+# The merged C objects keep their parent links to their per-file State,
+# so name lookups inside a function body still go to its own translation unit.
+# Instead of merging, you can also register every per-file State
+# in the Interpreter (or CWrapper), which gives you a merged view over all of them.
+
+import sys
+import gc
+import io
+import pickle
+if sys.version_info.major == 2:
+    import cparser
+    import caching
+    import snapshot
+    import incremental
+    from cparser_utils import *
+else:
+    from . import cparser
+    from . import caching
+    from . import snapshot
+    from . import incremental
+    from .cparser_utils import *
+
+class MergeConflict(object):
+    def __init__(self, attrib, name, kept, other):
+        """
+        :param str attrib: e.g. "funcs"
+        :param str name:
+        :param kept: the object which is in the merged State
+        :param other: the object which was ignored
+        """
+        self.attrib = attrib
+        self.name = name
+        self.kept = kept
+        self.other = other
+
+    def __repr__(self):
+        return "<MergeConflict %s %r: %s vs %s>" % (
+            self.attrib, self.name, getattr(self.kept, "defPos", None), getattr(self.other, "defPos", None))
+
+
+def _parseWorker(args):
+    """
+    :param (str,bytes,bool,str) args: filename, snapshot of the base State (see snapshot.dumps),
+        with global include wrappers, State.FuncBodyMode
+    :return: pickled global include list, then pickled dict attrib -> value
+    :rtype: bytes
+    """
+    filename, baseData, withGlobalIncludeWrappers, funcBodyMode = args
+    state = cparser.State()
+    state.FuncBodyMode = funcBodyMode
+    if withGlobalIncludeWrappers:
+        state.autoSetupGlobalIncludeWrappers()
+    snapshot.loads(baseData, state)
+    numContent = len(state.contentlist)
+    numErrors = len(state._errors)
+    contrib = incremental.FileContributions(filename)
+    state._contributions = contrib
+    try:
+        cparser.parse(filename, state)
+    except Exception as e:
+        state.error("internal exception while parsing %s: %r" % (filename, e))
+    finally:
+        state._contributions = None
+    attribs = dict([(attrib, {}) for attrib in snapshot.LazyDictAttribs])
+    for attrib, name in contrib.keys():
+        if attrib not in attribs: continue
+        v = getattr(state, attrib).get(name)
+        if v is not None: attribs[attrib][name] = v
+    # Like caching._CachePickler, but persistent_id is called for every object, so keep it minimal.
+    # Everything else in the dicts is from the base State (only the accessed entries are loaded)
+    # or from the global include wrappers. _loadResult puts these into the file State.
+    external = {}
+    for attrib in snapshot.LazyDictAttribs:
+        for name, v in dict.items(getattr(state, attrib)):
+            if name in attribs[attrib] and not isinstance(v, snapshot.ExternalTypes): continue
+            external[id(v)] = (attrib, name)
+    attribs["contentlist"] = state.contentlist[numContent:]
+    attribs["_errors"] = state._errors[numErrors:]
+    external[id(state)] = "state"
+    def persistent_id(obj, get=external.get, id=id):
+        return get(id(obj))
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(state._global_include_list)
+    pickler.dump(attribs)
+    return f.getvalue()
+
+
+def _loadResult(data, state):
+    """
+    :param bytes data: via _parseWorker
+    :param cparser.State state: base State
+    :rtype: cparser.State
+    """
+    fileState = cparser.State()
+    # Share the wrapper, so that the wrapped functions use the Interpreter of the base State.
+    fileState._global_include_wrapper = state._global_include_wrapper
+    unpickler = caching._CacheUnpickler(io.BytesIO(data), fileState)
+    for filename in unpickler.load():
+        if filename in fileState._global_include_list: continue
+        fileState._global_include_wrapper.find_handler_func(filename)(fileState)
+        fileState._global_include_list.append(filename)
+    # The file has seen all the declarations of the base State, so also the lookups later should.
+    for attrib in snapshot.LazyDictAttribs:
+        getattr(fileState, attrib).update(getattr(state, attrib))
+    for attrib, value in unpickler.load().items():
+        if attrib in snapshot.LazyDictAttribs:
+            getattr(fileState, attrib).update(value)
+        else:
+            setattr(fileState, attrib, value)
+    return fileState
+
+
+def parseFiles(filenames, state=None, processes=None):
+    """
+    Parses each file into its own State, in parallel.
+
+    :param list[str] filenames:
+    :param cparser.State|None state: base State, where we take the macros and declarations,
+        the global include wrapper and the FuncBodyMode from
+    :param int|None processes: number of worker processes. None -> number of CPUs. 0 -> no workers
+    :return: one State per file
+    :rtype: list[cparser.State]
+    """
+    if state is None:
+        state = cparser.State()
+        state.autoSetupSystemMacros()
+    baseData = snapshot.dumps(state)
+    jobs = [
+        (filename, baseData, bool(state._global_include_wrapper), state.FuncBodyMode)
+        for filename in filenames]
+    if processes == 0 or len(jobs) <= 1:
+        results = [_parseWorker(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_parseWorker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    states = []
+    # Unpickling creates lots of objects but no garbage, so the garbage collector would only slow it down.
+    gcWasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for data in results:
+            states.append(_loadResult(data, state))
+    finally:
+        if gcWasEnabled: gc.enable()
+    return states
+
+
+def _isSameDecl(a, b):
+    if a is b: return True
+    if isinstance(a, snapshot.ExternalTypes) and isinstance(b, snapshot.ExternalTypes):
+        return True  # both from the same global include wrapper
+    if isinstance(a, cparser.Macro) and isinstance(b, cparser.Macro):
+        if (a.args is None) != (b.args is None): return False
+        return list(a.args or ()) == list(b.args or ()) and a.rightside == b.rightside
+    # E.g. the same header included by multiple files.
+    defPos = getattr(a, "defPos", None)
+    return defPos is not None and defPos == getattr(b, "defPos", None)
+
+
+def _hasBody(obj):
+    if isinstance(obj, cparser.Macro): return True
+    return getattr(obj, "body", None) is not None
+
+
+def _isDefinition(obj):
+    # A var without initializer is also a (tentative) definition, unless it is extern.
+    if isinstance(obj, cparser.CVarDecl) and "extern" not in (obj.attribs or ()): return True
+    return _hasBody(obj)
+
+
+def _isStaticPair(a, b):
+    """
+    :return: whether a and b are two definitions with the same name, i.e. from different translation units,
+      and one of them is static. Otherwise, one can be the declaration of the other
+      (e.g. from a header in the base State), and it is replaced by the definition.
+    :rtype: bool
+    """
+    if not _isStatic(a) and not _isStatic(b): return False
+    return _isDefinition(a) and _isDefinition(b) and _hasBody(a) == _hasBody(b)
+
+
+def _isStatic(obj):
+    return "static" in (getattr(obj, "attribs", None) or ())
+
+
+def _addStatic(d, obj):
+    """
+    Adds the static function or var under a new unique name.
+    The references to it are by object, so the Interpreter will use the new name.
+
+    :param dict d: e.g. state.funcs
+    :param cparser.CFunc|cparser.CVarDecl obj:
+    """
+    i = 1
+    while "%s__static%i" % (obj.name, i) in d:
+        i += 1
+    obj.name = "%s__static%i" % (obj.name, i)
+    d[obj.name] = obj
+
+
+def mergeStates(states, state=None):
+    """
+    :param list[cparser.State] states: e.g. via parseFiles
+    :param cparser.State|None state: where to merge into. a new State if None
+    :return: state, conflicts
+    :rtype: (cparser.State, list[MergeConflict])
+    """
+    if state is None:
+        state = cparser.State()
+    conflicts = []
+    for fileState in states:
+        for attrib in snapshot.LazyDictAttribs:
+            d = getattr(state, attrib)
+            for name, obj in getattr(fileState, attrib).items():
+                existing = d.get(name)
+                if existing is None:
+                    d[name] = obj
+                elif _isSameDecl(existing, obj):
+                    pass
+                elif attrib in ("funcs", "vars") and _isStaticPair(existing, obj):
+                    if _isStatic(obj):
+                        _addStatic(d, obj)
+                    else:
+                        _addStatic(d, existing)
+                        d[name] = obj
+                elif not _hasBody(existing) and _hasBody(obj):
+                    d[name] = obj  # declaration -> definition
+                elif _hasBody(existing) and not _hasBody(obj):
+                    pass
+                else:
+                    conflicts.append(MergeConflict(attrib, name, kept=existing, other=obj))
+        state.contentlist.extend(fileState.contentlist)
+        state._errors.extend(fileState._errors)
+        for filename in fileState._global_include_list:
+            if filename not in state._global_include_list:
+                state._global_include_list.append(filename)
+    cparser.invalidateCTypeCaches()
+    return state, conflicts
+
+
+def parse(filenames, state=None, processes=None):
+    """
+    Like cparser.parse for every file, but in parallel,
+    and every file is a separate translation unit.
+
+    :param list[str] filenames:
+    :param cparser.State|None state: base State. see parseFiles
+    :param int|None processes: see parseFiles
+    :return: state, conflicts
+    :rtype: (cparser.State, list[MergeConflict])
+    """
+    if state is None:
+        state = cparser.State()
+        state.autoSetupSystemMacros()
+    states = parseFiles(filenames, state=state, processes=processes)
+    return mergeStates(states, state=state)
@@ -23,6 +23,15 @@ example2.c
 
 If you want to include some c preprocessor defines or macros, just make a
 .h file and make that your first argument.
+
+With -jN (e.g. -j4) as the first argument, the .c files are parsed in
+parallel with N worker processes, each as a separate translation unit.
+The files given before the first .c file (e.g. your .h file with the defines)
+are parsed first and seen by all .c files.
+
+With --lazy-bodies (before the files), the function bodies are only parsed
+when they are run. Note that they are then parsed with all declarations of all
+files, not only with the ones before the function.
 """
 
 # Copyright (c) 2018, Mark Jenkins <mark@markjenkins.ca> www.markjenkins.ca
@@ -55,6 +64,7 @@ better_exchook.install()
 
 from cparser import State, parse
 from interpreter import Interpreter
+import parallel
 
 def main():
     # excluding this programs name (argv[0]) and all arguments up to and
@@ -64,17 +74,41 @@ def main():
     except ValueError: # there might be no "--"
         c_code_files = argv[1:]
 
+    jobs = None
+    lazy_bodies = False
+    while c_code_files and c_code_files[0].startswith("-"):
+        if c_code_files[0].startswith("-j"):
+            jobs = int(c_code_files[0][2:])
+        elif c_code_files[0] == "--lazy-bodies":
+            lazy_bodies = True
+        else:
+            raise Exception("unknown option %r" % c_code_files[0])
+        c_code_files = c_code_files[1:]
+
     if len(c_code_files) == 0:
         raise Exception("You must provide at least one C source file")
 
     state = State()
     state.autoSetupSystemMacros()
     state.autoSetupGlobalIncludeWrappers()
+    if lazy_bodies:
+        # Function bodies are parsed when the interpreter needs them (Interpreter.getFunc).
+        state.FuncBodyMode = "tokens"
     interpreter = Interpreter()
     interpreter.register(state)
 
-    for cfile in c_code_files:
-        state = parse(cfile, state)
+    if jobs is None:
+        for cfile in c_code_files:
+            state = parse(cfile, state)
+    else:
+        num_headers = 0
+        while num_headers < len(c_code_files) and not c_code_files[num_headers].endswith(".c"):
+            num_headers += 1
+        for cfile in c_code_files[:num_headers]:
+            state = parse(cfile, state)
+        state, conflicts = parallel.parse(c_code_files[num_headers:], state, processes=jobs)
+        for conflict in conflicts:
+            print("warning: %r" % conflict)
 
     main_func = interpreter.getFunc("main")
     if len(main_func.C_argTypes) == 0:
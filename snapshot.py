@@ -0,0 +1,956 @@
+# PyCParser - State snapshots
+# code under BSD 2-Clause License
+
+# A compact binary serialization of a parsed State.
+#
+# Format (all ints are unsigned LEB128 varints unless noted):
+#   Magic, FormatVersion
+#   string table: count, then (byte length, utf8 bytes) for each string
+#   class table: count, then (byte length, utf8 bytes) of the class name (see _SnapshotWriter._isObjClass)
+#   object table: count, then a little-endian uint32 offset (relative to the object data) for each object
+#   meta: value (dict)
+#   state attribs: count, then (string index of the attrib name, attrib kind, data) for each attrib
+#   object data: for each object: class index, number of fields, then (string index of the field name, value)
+# Values are tagged (see _Tag*). All C objects are stored in the object table
+# and referred to by their index (e.g. the parent links), so that we can load them lazily.
+# The dicts (funcs, typedefs, ...) and the contentlist of the State are loaded lazily, i.e.
+# a C object is only decoded when it is accessed, together with all the objects it refers to.
+#
+# C objects which wrap Python values (CWrapValue, added by the global include wrappers)
+# cannot be stored. They are stored as a reference by their name instead (_TagExternal)
+# and the global include wrappers are applied again when loading.
+
+import sys
+import struct
+import array
+if sys.version_info.major == 2:
+    import cparser
+    import caching
+    from cparser_utils import *
+else:
+    from . import cparser
+    from . import caching
+    from .cparser_utils import *
+
+Magic = b"PyCParser-snapshot\n"
+FormatVersion = 1
+
+_TagNone, _TagFalse, _TagTrue, _TagInt, _TagFloat, _TagStr, _TagBytes, \
+    _TagList, _TagTuple, _TagDict, _TagSet, _TagRef, _TagState, _TagGlobal, _TagExternal = range(15)
+
+_AttribValue, _AttribLazyDict, _AttribLazyList = range(3)
+
+LazyDictAttribs = ("macros", "typedefs", "structs", "unions", "enums", "funcs", "vars", "enumconsts")
+LazyListAttribs = ("contentlist",)
+ValueAttribs = ("_errors", "_include_guards", "_include_once", "_global_include_list")
+ExternalTypes = (cparser.CWrapValue, cparser.CWrapFuncType)
+
+# Modules from where we allow classes/types as values (e.g. ctypes.c_int in CBuiltinTypes).
+_GlobalModules = {
+    "ctypes": "ctypes", "_ctypes": "_ctypes", cparser.__name__: cparser,
+    "builtins": "builtins", "__builtin__": "__builtin__"}
+
+if sys.version_info.major == 2:
+    _IntTypes = (int, long)
+    _StrTypes = (str, unicode)
+    _BytesTypes = ()
+    intern = intern
+else:
+    _IntTypes = (int,)
+    _StrTypes = (str,)
+    _BytesTypes = (bytes,)
+    intern = sys.intern
+
+
+class SnapshotError(Exception): pass
+
+
+def _writeVarint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _getModule(name):
+    mod = _GlobalModules[name]
+    if isinstance(mod, str):
+        mod = __import__(mod)
+    return mod
+
+
+class _SnapshotWriter:
+    def __init__(self, state):
+        self.state = state
+        self.strings = []
+        self.stringIndex = {}
+        self.classes = []
+        self.classIndex = {}
+        self.objs = []
+        self.objIndex = {}  # id(obj) -> index in objs
+        self.objClassCache = {}  # class -> bool, see _isObjClass
+        self.slotsCache = {}  # class -> slot names
+        self.externals = {}  # id(obj) -> (attrib, name)
+        for attrib in LazyDictAttribs:
+            for name, v in getattr(state, attrib).items():
+                if isinstance(v, ExternalTypes):
+                    self.externals[id(v)] = (attrib, name)
+        self.curObj = None
+
+    def str(self, s):
+        idx = self.stringIndex.get(s)
+        if idx is None:
+            idx = self.stringIndex[s] = len(self.strings)
+            self.strings.append(s)
+        return idx
+
+    def _isObjClass(self, cls):
+        """
+        Whether we store instances of this class as C objects.
+        That are all classes from the cparser module.
+        """
+        r = self.objClassCache.get(cls)
+        if r is None:
+            r = cls.__module__ == cparser.__name__ and getattr(cparser, cls.__name__, None) is cls
+            self.objClassCache[cls] = r
+        return r
+
+    def _getSlots(self, cls):
+        slots = self.slotsCache.get(cls)
+        if slots is None:
+            slots = []
+            for c in getattr(cls, "__mro__", (cls,)):
+                s = c.__dict__.get("__slots__", ())
+                if isinstance(s, _StrTypes): s = (s,)
+                slots += [name for name in s if name not in ("__dict__", "__weakref__")]
+            self.slotsCache[cls] = slots
+        return slots
+
+    def obj(self, obj):
+        idx = self.objIndex.get(id(obj))
+        if idx is None:
+            idx = self.objIndex[id(obj)] = len(self.objs)
+            self.objs.append(obj)
+        return idx
+
+    def writeValue(self, buf, v):
+        t = type(v)
+        if t in _StrTypes:
+            buf.append(_TagStr)
+            idx = self.stringIndex.get(v)
+            if idx is None: idx = self.str(v)
+            if idx < 0x80: buf.append(idx)
+            else: _writeVarint(buf, idx)
+        elif v is None:
+            buf.append(_TagNone)
+        elif id(v) in self.objIndex:
+            buf.append(_TagRef)
+            _writeVarint(buf, self.objIndex[id(v)])
+        elif t is bool:
+            buf.append(_TagTrue if v else _TagFalse)
+        elif t in _IntTypes:
+            buf.append(_TagInt)
+            _writeVarint(buf, v * 2 if v >= 0 else -v * 2 - 1)  # zigzag
+        elif t is float:
+            buf.append(_TagFloat)
+            buf.extend(struct.pack("<d", v))
+        elif t in _BytesTypes:
+            buf.append(_TagBytes)
+            _writeVarint(buf, len(v))
+            buf.extend(v)
+        elif v is cparser._emptyList:  # shared default of the list attribs, keep it shared
+            buf.append(_TagGlobal)
+            _writeVarint(buf, self.str(cparser.__name__))
+            _writeVarint(buf, self.str("_emptyList"))
+        elif isinstance(v, (list, tuple, set, frozenset)):
+            buf.append(_TagTuple if isinstance(v, tuple) else _TagList if isinstance(v, list) else _TagSet)
+            _writeVarint(buf, len(v))
+            for x in v:
+                self.writeValue(buf, x)
+        elif isinstance(v, dict):
+            buf.append(_TagDict)
+            items = list(v.items())
+            _writeVarint(buf, len(items))
+            for k, x in items:
+                self.writeValue(buf, k)
+                self.writeValue(buf, x)
+        elif isinstance(v, (cparser.State, caching.StateWrapper)):
+            buf.append(_TagState)
+        elif id(v) in self.externals:
+            buf.append(_TagExternal)
+            attrib, name = self.externals[id(v)]
+            _writeVarint(buf, self.str(attrib))
+            self.writeValue(buf, name)
+        elif isinstance(v, type) or type(v).__name__ == "classobj":
+            modname = v.__module__
+            if modname not in _GlobalModules or getattr(_getModule(modname), v.__name__, None) is not v:
+                raise SnapshotError("cannot store type %r in %r" % (v, self.curObj))
+            buf.append(_TagGlobal)
+            _writeVarint(buf, self.str(modname))
+            _writeVarint(buf, self.str(v.__name__))
+        elif self._isObjClass(v.__class__):
+            buf.append(_TagRef)
+            _writeVarint(buf, self.obj(v))
+        else:
+            raise SnapshotError("cannot store %r in %r" % (v, self.curObj))
+
+    def writeObj(self, buf, obj):
+        self.curObj = obj
+        cls = obj.__class__
+        clsIdx = self.classIndex.get(cls)
+        if clsIdx is None:
+            clsIdx = self.classIndex[cls] = len(self.classes)
+            self.classes.append(cls)
+        fields = list(getattr(obj, "__dict__", {}).items())
+        for name in self._getSlots(cls):
+            if hasattr(obj, name):
+                fields.append((name, getattr(obj, name)))
+        # The ctypes type (see _getCTypeStruct) is created dynamically. It will be created again.
+        # The cached hash of an interned type is only valid in this process.
+        fields = [(k, v) for (k, v) in fields if not k.startswith("_ctype") and k != "_hash"]
+        _writeVarint(buf, clsIdx)
+        _writeVarint(buf, len(fields))
+        stringIndex = self.stringIndex
+        objIndex = self.objIndex
+        for name, v in fields:
+            idx = stringIndex.get(name)
+            if idx is None: idx = self.str(name)
+            if idx < 0x80: buf.append(idx)
+            else: _writeVarint(buf, idx)
+            # Inlined common cases of writeValue.
+            if v is None:
+                buf.append(_TagNone)
+                continue
+            idx = objIndex.get(id(v))
+            if idx is not None:
+                buf.append(_TagRef)
+                if idx < 0x80: buf.append(idx)
+                else: _writeVarint(buf, idx)
+                continue
+            self.writeValue(buf, v)
+
+    def write(self, meta):
+        """
+        :param dict meta:
+        :rtype: bytes
+        """
+        state = self.state
+        root = bytearray()
+        self.writeValue(root, meta)
+        attribs = []
+        for attrib in LazyDictAttribs:
+            d = getattr(state, attrib)
+            attribs.append((attrib, _AttribLazyDict, [
+                (k, v) for (k, v) in d.items() if not isinstance(v, ExternalTypes)]))
+        for attrib in LazyListAttribs:
+            attribs.append((attrib, _AttribLazyList, list(getattr(state, attrib))))
+        for attrib in ValueAttribs:
+            attribs.append((attrib, _AttribValue, getattr(state, attrib)))
+        _writeVarint(root, len(attribs))
+        for attrib, kind, v in attribs:
+            _writeVarint(root, self.str(attrib))
+            root.append(kind)
+            if kind == _AttribLazyDict:
+                _writeVarint(root, len(v))
+                for k, x in v:
+                    self.writeValue(root, k)
+                    self.writeValue(root, x)
+            elif kind == _AttribLazyList:
+                _writeVarint(root, len(v))
+                for x in v:
+                    self.writeValue(root, x)
+            else:
+                self.writeValue(root, v)
+
+        # writeObj can add new objects.
+        objData = bytearray()
+        offsets = array.array("I")
+        i = 0
+        while i < len(self.objs):
+            offsets.append(len(objData))
+            self.writeObj(objData, self.objs[i])
+            i += 1
+        if sys.byteorder != "little": offsets.byteswap()
+
+        out = bytearray(Magic)
+        _writeVarint(out, FormatVersion)
+        _writeVarint(out, len(self.strings))
+        for s in self.strings:
+            if not isinstance(s, bytes): s = s.encode("utf8")
+            _writeVarint(out, len(s))
+            out.extend(s)
+        _writeVarint(out, len(self.classes))
+        for cls in self.classes:
+            name = cls.__name__.encode("utf8")
+            _writeVarint(out, len(name))
+            out.extend(name)
+        _writeVarint(out, len(self.objs))
+        out.extend(_arrayToBytes(offsets))
+        out.extend(root)
+        out.extend(objData)
+        return bytes(out)
+
+
+def _arrayToBytes(a):
+    if hasattr(a, "tobytes"): return a.tobytes()
+    return a.tostring()
+
+
+def _arrayFromBytes(a, data):
+    if hasattr(a, "frombytes"): a.frombytes(data)
+    else: a.fromstring(data)
+
+
+def _newInstance(cls):
+    if isinstance(cls, type):
+        return cls.__new__(cls)
+    import types  # old-style class in Python 2
+    return types.InstanceType(cls)
+
+
+def _isFilledDirectly(cls):
+    """
+    Whether the reader fills objects of this class directly, and not later via the pending list.
+    That are the interned types, which we intern again (see _internLoaded),
+    and the tokens (e.g. CNumber as the array len), because the intern key needs their content.
+    Both only refer to few other objects, so there is not much recursion.
+    """
+    return isinstance(cls, type) and issubclass(cls, (cparser._InternedType, cparser._CBase))
+
+
+def _internLoaded(obj):
+    """
+    :param obj: filled C object
+    :return: the interned instance if it is an interned type, otherwise obj.
+      So it is identical to the types which we create in this process, and its hash is valid here.
+    """
+    if isinstance(obj, cparser._InternedType):
+        return obj.__class__(*obj._internArgs())
+    return obj
+
+
+class _SnapshotReader:
+    def __init__(self, data, state):
+        """
+        :param bytes data:
+        :param cparser.State state:
+        """
+        if not data.startswith(Magic):
+            raise SnapshotError("not a PyCParser snapshot")
+        self.data = data = bytearray(data)
+        self.state = state
+        pos = len(Magic)
+        version, pos = self.readVarint(pos)
+        if version != FormatVersion:
+            raise SnapshotError("snapshot format version %i not supported, expected %i" % (version, FormatVersion))
+        count, pos = self.readVarint(pos)
+        self.strings = strings = []
+        for i in range(count):
+            n, pos = self.readVarint(pos)
+            s = bytes(data[pos:pos + n])
+            if str is not bytes: s = s.decode("utf8")
+            strings.append(intern(s))
+            pos += n
+        count, pos = self.readVarint(pos)
+        self.classes = []
+        for i in range(count):
+            n, pos = self.readVarint(pos)
+            name = bytes(data[pos:pos + n]).decode("utf8")
+            pos += n
+            cls = getattr(cparser, name, None)
+            if cls is None or getattr(cls, "__module__", None) != cparser.__name__:
+                raise SnapshotError("unknown class %r" % name)
+            self.classes.append(cls)
+        count, pos = self.readVarint(pos)
+        self.offsets = array.array("I")
+        assert self.offsets.itemsize == 4
+        _arrayFromBytes(self.offsets, bytes(data[pos:pos + count * 4]))
+        if sys.byteorder != "little": self.offsets.byteswap()
+        pos += count * 4
+        self.objs = [None] * count
+        self.loaded = [False] * count
+        self.pending = []  # list of (obj, pos)
+        self.filling = False
+        self.rootPos = pos
+        self.objDataPos = None  # set by readRoot
+
+    def readVarint(self, pos):
+        data = self.data
+        n = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80: return n, pos
+            shift += 7
+
+    def readMeta(self):
+        """
+        :rtype: dict
+        """
+        meta, _ = self.readValue(self.rootPos, lazy=False)
+        return meta
+
+    def readRoot(self):
+        """
+        :return: meta, list of (attrib, kind, value or lazy refs)
+        :rtype: (dict, list[(str,int,object)])
+        """
+        meta, pos = self.readValue(self.rootPos, lazy=False)
+        count, pos = self.readVarint(pos)
+        attribs = []
+        for i in range(count):
+            attribIdx, pos = self.readVarint(pos)
+            kind = self.data[pos]
+            pos += 1
+            if kind == _AttribLazyDict:
+                n, pos = self.readVarint(pos)
+                lazy = {}
+                for j in range(n):
+                    k, pos = self.readValue(pos, lazy=False)
+                    lazy[k], pos = self.readValue(pos, lazy=True)
+                attribs.append((self.strings[attribIdx], kind, lazy))
+            elif kind == _AttribLazyList:
+                n, pos = self.readVarint(pos)
+                lazy = []
+                for j in range(n):
+                    v, pos = self.readValue(pos, lazy=True)
+                    lazy.append(v)
+                attribs.append((self.strings[attribIdx], kind, lazy))
+            else:
+                v, pos = self.readValue(pos, lazy=False)
+                attribs.append((self.strings[attribIdx], kind, v))
+        self.objDataPos = pos
+        return meta, attribs
+
+    def readValue(self, pos, lazy):
+        """
+        :param int pos:
+        :param bool lazy: if set, return _LazyRef for references to not yet loaded C objects
+        :return: value, new pos
+        """
+        data = self.data
+        tag = data[pos]
+        if tag == _TagStr:
+            idx = data[pos + 1]
+            if idx < 0x80: return self.strings[idx], pos + 2
+            idx, pos = self.readVarint(pos + 1)
+            return self.strings[idx], pos
+        pos += 1
+        if tag == _TagRef:
+            idx, pos = self.readVarint(pos)
+            if self.loaded[idx]:
+                return self.objs[idx], pos
+            if lazy:
+                return _LazyRef(idx), pos
+            return self.getObj(idx), pos
+        if tag == _TagNone: return None, pos
+        if tag == _TagFalse: return False, pos
+        if tag == _TagTrue: return True, pos
+        if tag == _TagInt:
+            n, pos = self.readVarint(pos)
+            return (n >> 1) if not (n & 1) else -((n + 1) >> 1), pos
+        if tag in (_TagList, _TagTuple, _TagSet):
+            n, pos = self.readVarint(pos)
+            l = []
+            for i in range(n):
+                v, pos = self.readValue(pos, lazy=False)
+                l.append(v)
+            if tag == _TagTuple: return tuple(l), pos
+            if tag == _TagSet: return set(l), pos
+            return l, pos
+        if tag == _TagDict:
+            n, pos = self.readVarint(pos)
+            d = {}
+            for i in range(n):
+                k, pos = self.readValue(pos, lazy=False)
+                d[k], pos = self.readValue(pos, lazy=False)
+            return d, pos
+        if tag == _TagState:
+            return self.state, pos
+        if tag == _TagFloat:
+            return struct.unpack("<d", bytes(data[pos:pos + 8]))[0], pos + 8
+        if tag == _TagBytes:
+            n, pos = self.readVarint(pos)
+            return bytes(data[pos:pos + n]), pos + n
+        if tag == _TagGlobal:
+            modIdx, pos = self.readVarint(pos)
+            nameIdx, pos = self.readVarint(pos)
+            modname, name = self.strings[modIdx], self.strings[nameIdx]
+            if modname not in _GlobalModules:
+                raise SnapshotError("type from module %r not allowed" % modname)
+            return getattr(_getModule(modname), name), pos
+        if tag == _TagExternal:
+            attribIdx, pos = self.readVarint(pos)
+            name, pos = self.readValue(pos, lazy=False)
+            attrib = self.strings[attribIdx]
+            d = getattr(self.state, attrib)
+            if name not in d:
+                raise SnapshotError(
+                    "%s %r not found. maybe the global include wrappers are not setup" % (attrib, name))
+            return d[name], pos
+        raise SnapshotError("invalid tag %i at pos %i" % (tag, pos - 1))
+
+    def getObj(self, idx):
+        """
+        :param int idx:
+        :return: the C object, together with all the objects it refers to
+        """
+        if self.loaded[idx]:
+            return self.objs[idx]
+        pos = self.objDataPos + self.offsets[idx]
+        clsIdx, pos = self.readVarint(pos)
+        cls = self.classes[clsIdx]
+        obj = self.objs[idx] = _newInstance(cls)
+        self.loaded[idx] = True
+        if _isFilledDirectly(cls):
+            self._fill(obj, pos)
+            obj = self.objs[idx] = _internLoaded(obj)
+            return obj
+        # Fill the fields without recursion, the object graph can be deep.
+        self.pending.append((obj, pos))
+        if not self.filling:
+            self.filling = True
+            try:
+                while self.pending:
+                    self._fill(*self.pending.pop())
+            finally:
+                self.filling = False
+        return obj
+
+    def _fill(self, obj, pos):
+        count, pos = self.readVarint(pos)
+        data = self.data
+        strings = self.strings
+        readValue = self.readValue
+        # With __slots__ (e.g. _CBaseWithOptBody), some fields are not in the __dict__.
+        objDict = None if hasattr(obj.__class__, "__slots__") else getattr(obj, "__dict__", None)
+        objs = self.objs
+        loaded = self.loaded
+        for i in range(count):
+            nameIdx = data[pos]
+            if nameIdx < 0x80: pos += 1
+            else: nameIdx, pos = self.readVarint(pos)
+            # Inlined common cases of readValue.
+            tag = data[pos]
+            if tag == _TagNone:
+                v = None
+                pos += 1
+            elif tag == _TagRef and data[pos + 1] < 0x80 and loaded[data[pos + 1]]:
+                v = objs[data[pos + 1]]
+                pos += 2
+            else:
+                v, pos = readValue(pos, False)
+            if objDict is not None:
+                objDict[strings[nameIdx]] = v
+            else:
+                setattr(obj, strings[nameIdx], v)
+
+
+class _LazyRef(object):
+    __slots__ = ("idx",)
+    def __init__(self, idx):
+        self.idx = idx
+
+
+class LazyDict(dict):
+    """
+    Dict where the values are loaded from the snapshot when they are accessed.
+    """
+
+    def __init__(self, reader, lazy, items=()):
+        """
+        :param _SnapshotReader reader:
+        :param dict lazy: key -> value or _LazyRef
+        :param items: initial items. the lazy ones overwrite them
+        """
+        dict.__init__(self, items)
+        self._reader = reader
+        self._lazy = {}
+        for k, v in lazy.items():
+            if isinstance(v, _LazyRef):
+                dict.pop(self, k, None)
+                self._lazy[k] = v.idx
+            else:
+                dict.__setitem__(self, k, v)
+
+    def _load(self, k):
+        v = self._reader.getObj(self._lazy[k])
+        del self._lazy[k]
+        dict.__setitem__(self, k, v)
+        return v
+
+    def _loadAll(self):
+        for k in list(self._lazy.keys()):
+            self._load(k)
+
+    def __getitem__(self, k):
+        if k in self._lazy: return self._load(k)
+        return dict.__getitem__(self, k)
+    def __contains__(self, k):
+        return k in self._lazy or dict.__contains__(self, k)
+    has_key = __contains__
+    def get(self, k, default=None):
+        if k in self._lazy: return self._load(k)
+        return dict.get(self, k, default)
+    def __setitem__(self, k, v):
+        self._lazy.pop(k, None)
+        dict.__setitem__(self, k, v)
+    def __delitem__(self, k):
+        if k in self._lazy:
+            del self._lazy[k]
+        else:
+            dict.__delitem__(self, k)
+    def pop(self, k, *default):
+        if k in self._lazy: self._load(k)
+        return dict.pop(self, k, *default)
+    def setdefault(self, k, default=None):
+        if k in self: return self[k]
+        self[k] = default
+        return default
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+    def clear(self):
+        self._lazy.clear()
+        dict.clear(self)
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+    def __iter__(self):
+        # Don't load anything for this.
+        return iter(list(dict.keys(self)) + list(self._lazy.keys()))
+    def keys(self):
+        return list(dict.keys(self)) + list(self._lazy.keys())
+    iterkeys = __iter__
+    def items(self):
+        self._loadAll()
+        return dict.items(self)
+    def values(self):
+        self._loadAll()
+        return dict.values(self)
+    def iteritems(self): return iter(self.items())
+    def itervalues(self): return iter(self.values())
+    def popitem(self):
+        self._loadAll()
+        return dict.popitem(self)
+    def copy(self):
+        self._loadAll()
+        return dict(dict.items(self))
+    def __eq__(self, other):
+        self._loadAll()
+        return dict.__eq__(self, other)
+    def __ne__(self, other): return not self == other
+    __hash__ = None
+    def __repr__(self):
+        self._loadAll()
+        return dict.__repr__(self)
+    def __reduce__(self):
+        return dict, (list(self.items()),)
+
+
+class LazyList(list):
+    """
+    List where the entries are loaded from the snapshot when the list is accessed.
+    """
+
+    def __init__(self, reader, lazy, items=()):
+        """
+        :param _SnapshotReader reader:
+        :param list lazy: values or _LazyRef
+        :param items: initial items. the lazy ones are appended
+        """
+        list.__init__(self, items)
+        self._reader = reader
+        self._lazy = lazy
+
+    def _loadAll(self):
+        if self._lazy:
+            lazy, self._lazy = self._lazy, []
+            list.extend(self, [
+                self._reader.getObj(v.idx) if isinstance(v, _LazyRef) else v
+                for v in lazy])
+
+    def __len__(self):
+        return list.__len__(self) + len(self._lazy)
+    def __reduce__(self):
+        return list, (list(iter(self)),)
+
+
+def _makeLoadingMethod(name):
+    method = getattr(list, name)
+    def loadingMethod(self, *args):
+        self._loadAll()
+        return method(self, *args)
+    loadingMethod.__name__ = name
+    return loadingMethod
+
+for _name in [
+        "__iter__", "__reversed__", "__getitem__", "__setitem__", "__delitem__",
+        "__getslice__", "__setslice__", "__delslice__", "__contains__",
+        "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__", "__add__", "__iadd__", "__mul__",
+        "__repr__", "__str__", "append", "extend", "insert", "pop", "remove", "index", "count", "sort", "reverse"]:
+    if hasattr(list, _name):
+        setattr(LazyList, _name, _makeLoadingMethod(_name))
+del _name
+
+
+def dumps(state, meta=None):
+    """
+    :param cparser.State state:
+    :param dict|None meta: custom data, can be retrieved via loads(..., withMeta=True)
+    :return: snapshot data
+    :rtype: bytes
+    """
+    return _SnapshotWriter(state).write(meta=meta or {})
+
+
+def loads(data, state=None, withMeta=False):
+    """
+    :param bytes data: from dumps()
+    :param cparser.State|None state: where to load the snapshot into. a new state if None
+    :param bool withMeta:
+    :return: state, or (state, meta) if withMeta
+    :rtype: cparser.State|(cparser.State,dict)
+    """
+    if state is None:
+        state = cparser.State()
+    return _loadInto(_SnapshotReader(data, state), state, withMeta=withMeta)
+
+
+def _loadInto(reader, state, withMeta=False):
+    meta, attribs = reader.readRoot()
+    attribs = dict([(attrib, (kind, v)) for (attrib, kind, v) in attribs])
+
+    # Apply the global include wrappers first. The snapshot has all the other stuff.
+    globalIncludes = attribs.pop("_global_include_list", (None, []))[1]
+    wrapper = state._global_include_wrapper
+    for filename in globalIncludes:
+        if filename in state._global_include_list: continue
+        f = wrapper.find_handler_func(filename) if wrapper else None
+        if f is None: continue  # we will fail later if some external object is needed
+        f(state)
+        state._global_include_list.append(filename)
+
+    for attrib, (kind, v) in sorted(attribs.items()):
+        old = getattr(state, attrib)
+        if kind == _AttribLazyDict:
+            setattr(state, attrib, LazyDict(reader, v, old))
+        elif kind == _AttribLazyList:
+            setattr(state, attrib, LazyList(reader, v, old))
+        elif isinstance(old, list):
+            old.extend(v)
+        else:
+            old.update(v)
+    cparser.invalidateCTypeCaches()
+
+    if withMeta:
+        return state, meta
+    return state
+
+
+def save(state, filename, meta=None):
+    data = dumps(state, meta=meta)
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def load(filename, state=None, withMeta=False):
+    with open(filename, "rb") as f:
+        data = f.read()
+    return loads(data, state=state, withMeta=withMeta)
+
+
+# Snapshot bundles: a set of headers, parsed once with a given macro configuration.
+# The meta data of the snapshot contains the macro configuration and all the files
+# which were read, and a fingerprint over both, so that we can validate the bundle on load.
+
+class BundleOutdated(SnapshotError): pass
+
+
+def _macroConfig(macros):
+    """
+    :param dict[str,cparser.Macro|str] macros:
+    :return: hashable and storable representation
+    :rtype: list[(str,tuple[str]|None,str)]
+    """
+    config = []
+    for name, macro in sorted(macros.items()):
+        if isinstance(macro, _StrTypes):
+            config.append((name, None, macro))
+        else:
+            args = tuple(macro.args) if macro.args is not None else None
+            config.append((name, args, macro.rightside))
+    return config
+
+
+def fingerprint(macroConfig, files):
+    """
+    :param list macroConfig: via _macroConfig
+    :param list[(str,float,str)] files: (filename, mtime, sha1)
+    :rtype: str
+    """
+    return caching.sha1((
+        tuple([(name, args, rightside) for (name, args, rightside) in macroConfig]),
+        tuple([(fn, h) for (fn, _, h) in files])))
+
+
+def buildBundle(filenames, bundleFilename=None, macros=None, state=None):
+    """
+    Parses the given files (in order) into one State and saves it as a bundle.
+
+    :param list[str] filenames:
+    :param str|None bundleFilename: where to save it. if None, we don't save it
+    :param dict[str,cparser.Macro|str]|None macros: additional macro configuration (name -> rightside)
+    :param cparser.State|None state: initial state. a new state with the system macros if None
+    :return: state, meta (see bundleInfo)
+    :rtype: (cparser.State,dict)
+    """
+    import os
+    if state is None:
+        state = cparser.State()
+        state.autoSetupSystemMacros()
+    for name, macro in (macros or {}).items():
+        if isinstance(macro, _StrTypes):
+            macro = cparser.Macro(state, name, None, macro)
+        state.macros[name] = macro
+    macroConfig = _macroConfig(state.macros)
+
+    readFiles = []
+    origReadLocalInclude = state.readLocalInclude
+    def readLocalInclude(filename):
+        reader, fullfilename = origReadLocalInclude(filename)
+        if fullfilename: readFiles.append(os.path.abspath(fullfilename))
+        return reader, fullfilename
+    state.readLocalInclude = readLocalInclude
+    try:
+        for filename in filenames:
+            cparser.parse(filename, state)
+    finally:
+        del state.readLocalInclude
+
+    files = []
+    for fn in sorted(set(readFiles)):
+        files.append((fn, caching.getLastChangeUnixTime(fn), caching.sha1_file(fn)))
+    meta = {
+        "bundle": {
+            "filenames": list(filenames),
+            "macros": macroConfig,
+            "files": files,
+            "globalIncludeWrappers": bool(state._global_include_wrapper),
+            "fingerprint": fingerprint(macroConfig, files)}}
+    if bundleFilename:
+        save(state, bundleFilename, meta=meta)
+    return state, meta["bundle"]
+
+
+def bundleInfo(bundleFilename):
+    """
+    :param str bundleFilename:
+    :return: the bundle meta data, without loading the state
+    :rtype: dict
+    """
+    with open(bundleFilename, "rb") as f:
+        data = f.read()
+    meta = _SnapshotReader(data, None).readMeta()
+    if "bundle" not in meta:
+        raise SnapshotError("%s is a snapshot but not a bundle" % bundleFilename)
+    return meta["bundle"]
+
+
+def checkBundle(info, macros=None):
+    """
+    :param dict info: via bundleInfo
+    :param dict[str,cparser.Macro|str]|None macros: if given, the expected macro configuration
+    :return: None if the bundle is up-to-date, otherwise the reason why not
+    :rtype: str|None
+    """
+    if macros is not None and _macroConfig(macros) != [tuple(c) for c in info["macros"]]:
+        return "different macro configuration"
+    files = []
+    for fn, mtime, h in info["files"]:
+        try:
+            # Like caching.FileCacheRef.checkFileDepListUpToDate.
+            if caching.getLastChangeUnixTime(fn) != mtime and caching.sha1_file(fn) != h:
+                return "file changed: %s" % fn
+        except (IOError, OSError):
+            return "file not found: %s" % fn
+        files.append((fn, mtime, h))
+    if fingerprint(info["macros"], files) != info["fingerprint"]:
+        return "fingerprint mismatch"
+    return None
+
+
+def loadBundle(bundleFilename, state=None, validate=True, macros=None):
+    """
+    :param str bundleFilename: via buildBundle
+    :param cparser.State|None state: where to load the bundle into. a new state if None
+    :param bool validate: check that the files did not change (see checkBundle)
+    :param dict[str,cparser.Macro|str]|None macros: if given, the expected macro configuration.
+      otherwise, the macro configuration is not checked. cparser.State.loadSnapshotBundle
+      passes the macros of the state
+    :rtype: cparser.State
+    """
+    with open(bundleFilename, "rb") as f:
+        data = f.read()
+    if state is None:
+        state = cparser.State()
+    reader = _SnapshotReader(data, state)
+    info = reader.readMeta().get("bundle")
+    if info is None:
+        raise SnapshotError("%s is a snapshot but not a bundle" % bundleFilename)
+    if validate:
+        reason = checkBundle(info, macros=macros)
+        if reason:
+            raise BundleOutdated("%s is outdated: %s" % (bundleFilename, reason))
+    if info["globalIncludeWrappers"]:
+        state.autoSetupGlobalIncludeWrappers()
+    return _loadInto(reader, state)
+
+
+def main(argv=None):
+    import argparse
+    argparser = argparse.ArgumentParser(description="Build and inspect PyCParser snapshot bundles.")
+    subparsers = argparser.add_subparsers(dest="command")
+    buildparser = subparsers.add_parser("build", help="parse headers and save them as a bundle")
+    buildparser.add_argument("files", nargs="+", help="C files/headers, parsed in this order")
+    buildparser.add_argument("-o", "--output", required=True, help="bundle filename")
+    buildparser.add_argument("-D", dest="defines", action="append", default=[], help="NAME or NAME=VALUE")
+    buildparser.add_argument("--no-system-macros", action="store_true", help="don't use State.autoSetupSystemMacros")
+    buildparser.add_argument("--global-include-wrappers", action="store_true",
+                             help="use State.autoSetupGlobalIncludeWrappers")
+    infoparser = subparsers.add_parser("info", help="show the bundle meta data and check whether it is up-to-date")
+    infoparser.add_argument("bundle")
+    args = argparser.parse_args(argv)
+
+    if args.command == "build":
+        state = cparser.State()
+        if not args.no_system_macros:
+            state.autoSetupSystemMacros()
+        if args.global_include_wrappers:
+            state.autoSetupGlobalIncludeWrappers()
+        macros = {}
+        for define in args.defines:
+            # Like `cc -D`: NAME alone defines it as 1.
+            name, eq, value = define.partition("=")
+            macros[name] = value if eq else "1"
+        state, info = buildBundle(args.files, args.output, macros=macros, state=state)
+        for err in state._errors:
+            print("error: %s" % err)
+        print("%s: %i files, fingerprint %s" % (args.output, len(info["files"]), info["fingerprint"]))
+        return 1 if state._errors else 0
+    elif args.command == "info":
+        info = bundleInfo(args.bundle)
+        print("fingerprint: %s" % info["fingerprint"])
+        print("macros: %i" % len(info["macros"]))
+        for fn, _, h in info["files"]:
+            print("file: %s %s" % (fn, h))
+        reason = checkBundle(info)
+        print("status: %s" % (("outdated, " + reason) if reason else "up-to-date"))
+        return 1 if reason else 0
+    else:
+        argparser.print_help()
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import cparser.arena as arena
+from cparser.interpreter import Interpreter
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+_src = """
+typedef struct node { struct node* next; int value; } node_t;
+enum color { RED, GREEN = 5, BLUE };
+int counter = 3;
+static int sum(node_t* n) {
+    int s = 0;
+    while (n) { s += n->value; n = n->next; }
+    return s + counter;
+}
+int main() { node_t a, b; a.value = 2; a.next = &b; b.value = BLUE; b.next = 0; return sum(&a); }
+"""
+
+
+def test_arena_columns():
+    state = parse(_src)
+    a = arena.Arena.fromState(state)
+    assert len(a) > 20
+    idx, = a.find("sum", CFunc)
+    assert a.getClass(idx) is CFunc
+    assert a.getName(idx) == "sum"
+    assert a.getDefPos(idx) == state.funcs["sum"].defPos
+    assert a.depth(idx) == state.funcs["sum"].depth() == 2
+    argIdx, = a.find("n", CFuncArgDecl)
+    assert a.getParent(argIdx) == idx
+    assert argIdx in a.getChildren(idx)
+    assert a.depth(argIdx) == state.funcs["sum"].args[0].depth() == 3
+    assert a.find("unknown") == []
+
+
+def test_arena_to_state():
+    state = parse(_src)
+    a = arena.Arena.fromState(state)
+    for a2 in [a, pickle.loads(pickle.dumps(a, pickle.HIGHEST_PROTOCOL)), a.copy()]:
+        state2 = a2.copy().toState()
+        assert isinstance(state2.funcs, cparser.snapshot.LazyDict)
+        assert len(state2.funcs._lazy) == 2
+        f = state2.funcs["sum"]
+        assert len(state2.funcs._lazy) == 1
+        assert isinstance(f, CFunc) and f.parent.body is state2
+        assert f.args[0].parent is f
+        assert f.args[0].type.pointerOf is state2.typedefs["node_t"]
+        for attrib in cparser.snapshot.LazyDictAttribs:
+            assert_equal(repr(getattr(state2, attrib)), repr(getattr(state, attrib)))
+        assert_equal(repr(state2.contentlist), repr(state.contentlist))
+        assert state2.vars["counter"].attribs is cparser.cparser._emptyList
+        interpreter = Interpreter()
+        interpreter.register(state2)
+        assert interpreter.runFunc("main", return_as_ctype=False) == 11
+    try:
+        a.toState()
+        a.toState()
+    except arena.ArenaError as e:
+        print("expected error:", e)
+    else:
+        assert False, "expected ArenaError"
+
+
+
+def test_arena_types_from_other_process():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    try:
+        fn = os.path.join(d, "types.arena")
+        code = (
+            "import helpers_test, pickle, cparser.arena as arena\n"
+            "a = arena.Arena.fromState(helpers_test.parse('int **p; struct S { int x; }; struct S *q;'))\n"
+            "pickle.dump(a, open(%r, 'wb'), pickle.HIGHEST_PROTOCOL)\n" % fn)
+        subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(fn, "rb") as f:
+            state = pickle.load(f).toState()
+        t = state.vars["p"].type
+        u = CPointerType(CPointerType(CBuiltinType(("int",))))
+        assert t is u
+        assert len({t, u}) == 1
+        assert state.vars["q"].type is CPointerType(state.structs["S"])
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main(globals())
@@ -0,0 +1,149 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import cparser.caching as caching
+import os
+import shutil
+import tempfile
+import time
+
+
+def _parse_cached(d, reads, macros=None):
+    """
+    :param str d: dir with main.c
+    :param list[str] reads: we add the basenames of all files here which really got read
+    :param dict[str,Macro]|None macros:
+    :rtype: State
+    """
+    state = State()
+    state.autoSetupSystemMacros()
+    state.macros.update(macros or {})
+    def readLocalInclude(filename):
+        reader, fullfilename = State.readLocalInclude(state, filename)
+        def tracked_reader():
+            reads.append(os.path.basename(filename))
+            for block in reader: yield block
+        return tracked_reader(), fullfilename
+    state.readLocalInclude = readLocalInclude
+    return caching.parse(os.path.join(d, "main.c"), state)
+
+
+def test_caching_parse():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    oldCachingDir = caching.CACHING_DIR
+    caching.CACHING_DIR = os.path.join(d, "cache") + "/"
+    try:
+        files = {
+            "a.h": "#ifndef A_H\n#define A_H\ntypedef int myint;\nstruct S { int x; myint y; };\n#endif\n",
+            "b.h": '#include "a.h"\n#ifdef USE_B\nint b_enabled;\n#endif\nmyint bfunc(struct S* s) { return s->x; }\n',
+            "main.c": '#include "a.h"\n#include "b.h"\nint main() { struct S s; return bfunc(&s); }\n'}
+        for fn, content in files.items():
+            with open(os.path.join(d, fn), "w") as f:
+                f.write(content)
+
+        reads = []
+        state = _parse_cached(d, reads)
+        assert not state._errors, state._errors
+        assert reads == ["main.c", "a.h", "b.h"]
+        assert state._include_guards == {d + "/a.h": "A_H"}
+        contentlist = [str(c) for c in state.contentlist]
+
+        # Everything is in the cache now.
+        reads = []
+        state = _parse_cached(d, reads)
+        assert reads == []
+        assert not state._errors, state._errors
+        assert [str(c) for c in state.contentlist] == contentlist
+        assert set(state.funcs.keys()) == {"bfunc", "main"}
+        assert state._include_guards == {d + "/a.h": "A_H"}
+
+        # main.c changed, but the headers are still cached.
+        with open(os.path.join(d, "main.c"), "w") as f:
+            f.write(files["main.c"] + "int y;\n")
+        reads = []
+        state = _parse_cached(d, reads)
+        assert reads == ["main.c"]
+        assert set(state.vars.keys()) == {"y"}
+        assert state.funcs["bfunc"].type is state.typedefs["myint"]
+
+        # Only the mtime changed, thus the content hash still matches.
+        st = os.stat(os.path.join(d, "b.h"))
+        os.utime(os.path.join(d, "b.h"), (st.st_atime + 10, st.st_mtime + 10))
+        reads = []
+        _parse_cached(d, reads)
+        assert reads == []
+
+        # Different macro dependencies.
+        reads = []
+        state = _parse_cached(d, reads, macros={"USE_B": Macro(rightside="1")})
+        assert reads == ["main.c", "b.h"]
+        assert set(state.vars.keys()) == {"b_enabled", "y"}
+
+        # Changed content.
+        with open(os.path.join(d, "b.h"), "w") as f:
+            f.write(files["b.h"] + "int b2;\n")
+        reads = []
+        state = _parse_cached(d, reads)
+        assert reads == ["main.c", "b.h"]
+        assert set(state.vars.keys()) == {"b2", "y"}
+        assert not state._errors, state._errors
+    finally:
+        caching.CACHING_DIR = oldCachingDir
+        shutil.rmtree(d)
+
+
+def test_cache_manager():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    oldCachingDir = caching.CACHING_DIR
+    caching.setCachingDir(os.path.join(d, "cache"))
+    try:
+        for i in range(3):
+            with open(os.path.join(d, "h%i.h" % i), "w") as f:
+                f.write("int v%i;\n" % i)
+        with open(os.path.join(d, "main.c"), "w") as f:
+            f.write("".join(['#include "h%i.h"\n' % i for i in range(3)]))
+        _parse_cached(d, [])
+        manager = caching.CacheManager()
+        info = manager.info()
+        assert info[caching.FileCache.Namespace][0] == 4
+        assert info[caching.FileCacheRefs.Namespace][0] == 4
+        now = time.time()
+        assert manager.prune(now=now) == (0, 0)
+
+        # h0.h was used last, h2.h first.
+        for i in range(3):
+            t = now - 100 * (i + 1)
+            os.utime(caching.FileCache.GetFilePath(caching.FileCacheRefs.Load(d + "/h%i.h" % i)[0]), (t, t))
+            os.utime(caching.FileCacheRefs.GetFilePath(d + "/h%i.h" % i), (t, t))
+        count, size = manager.prune(maxAge=250, now=now)
+        assert count == 2  # h2.h
+        assert caching.check_cache(caching.StateWrapper(State()), d + "/h1.h") is not None
+        assert caching.FileCacheRefs.Load(d + "/h2.h") is None
+
+        totalSize = sum([sum([e[1] for e in manager.entries(ns)]) for ns in manager.Namespaces])
+        smallestSize = min([e[1] for ns in manager.Namespaces for e in manager.entries(ns)])
+        count, size = manager.prune(maxBytes=totalSize - smallestSize, now=now)
+        assert count >= 1 and size >= smallestSize
+
+        # Unreferenced old entry.
+        with open(os.path.join(d, "cache", caching.FileCache.Namespace, "orphan"), "w") as f:
+            f.write("x")
+        os.utime(os.path.join(d, "cache", caching.FileCache.Namespace, "orphan"), (0, 0))
+        assert manager.prune(now=now) == (1, 1)
+
+        assert caching.main(["--dir", manager.cachingDir, "info"]) == 0
+        assert caching.main(["--dir", manager.cachingDir, "clear"]) == 0
+        assert manager.info() == {ns: (0, 0) for ns in manager.Namespaces}
+        assert caching.parseBytes("10k") == 10240
+        assert caching.formatBytes(1536) == "1.5KB"
+    finally:
+        caching.CACHING_DIR = oldCachingDir
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main(globals())
@@ -0,0 +1,92 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import cparser.incremental as incremental
+from cparser.interpreter import Interpreter
+import os
+import shutil
+import tempfile
+
+
+_files = {
+    "common.h": (
+        "#ifndef COMMON_H\n#define COMMON_H\ntypedef struct { int x, y; } point;\n"
+        "int bfunc(point* p);\n#endif\n"),
+    "a.c": (
+        '#include "common.h"\nstatic int helper(int v) { return v + 1; }\n'
+        "int afunc() { point p; p.x = 2; p.y = 3; return helper(bfunc(&p)); }\n"),
+    "b.c": (
+        '#include "common.h"\n#define FACTOR 10\nint counter = 0;\n'
+        "int bfunc(point* p) { counter++; return (p->x + p->y) * FACTOR; }\n"),
+}
+
+
+def test_incremental_parse():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    try:
+        def write(fn, content):
+            with open(os.path.join(d, fn), "w") as f:
+                f.write(content)
+        for fn, content in _files.items():
+            write(fn, content)
+        fa, fb = os.path.join(d, "a.c"), os.path.join(d, "b.c")
+        parser = incremental.IncrementalParser()
+        state = parser.state
+        parser.parse(fa)
+        parser.parse(fb)
+        assert not state._errors, state._errors
+        assert set(state.funcs.keys()) == {"helper", "afunc", "bfunc"}
+        interpreter = Interpreter()
+        parser.register(interpreter)
+        assert interpreter.runFunc("afunc", return_as_ctype=False) == 51
+        assert interpreter.runFunc("afunc", return_as_ctype=False) == 51
+        assert interpreter.globalScope.vars["counter"].value == 2
+        afunc = interpreter.getFunc("afunc")
+
+        # Change only a function body. The macros from b.c are the same, so they are not reported.
+        write("b.c", _files["b.c"].replace("* FACTOR", "* FACTOR + 1"))
+        changes = parser.parse(fb)
+        assert not state._errors, state._errors
+        assert changes == [("funcs", "bfunc"), ("vars", "counter")]
+        assert state.funcs["bfunc"].body is not None
+        assert "bfunc" not in interpreter._func_cache
+        assert "afunc" not in interpreter._func_cache  # it calls bfunc
+        assert "helper" in interpreter._func_cache
+        assert "counter" not in interpreter.globalScope.vars
+        assert interpreter.runFunc("afunc", return_as_ctype=False) == 52
+        assert interpreter.getFunc("afunc") is not afunc
+        assert interpreter.globalScope.vars["counter"].value == 1
+        assert len([obj for obj in state.contentlist if getattr(obj, "name", None) == "bfunc"]) == 2  # decl + def
+
+        # Parsing a.c again also parses common.h again, which redeclares bfunc.
+        write("a.c", _files["a.c"].replace("v + 1", "v + 2"))
+        changes = parser.parse(fa)
+        assert not state._errors, state._errors
+        assert ("funcs", "helper") in changes and ("typedefs", "point") in changes
+        assert ("funcs", "bfunc") not in changes
+        assert state.funcs["bfunc"].body is not None
+        assert interpreter.runFunc("afunc", return_as_ctype=False) == 53
+
+        # Introduce an error and fix it again.
+        write("b.c", _files["b.c"] + "int counter = 1;\n")
+        parser.parse(fb)
+        assert state._errors
+        write("b.c", _files["b.c"])
+        parser.parse(fb)
+        assert not state._errors, state._errors
+        assert interpreter.runFunc("afunc", return_as_ctype=False) == 52
+
+        changes = parser.retract(fb)
+        assert ("macros", "FACTOR") in changes
+        assert "FACTOR" not in state.macros and "counter" not in state.vars
+        assert state.funcs["bfunc"].body is None  # the declaration from common.h
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main(globals())
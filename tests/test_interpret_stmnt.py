@@ -724,6 +724,27 @@ def test_interpret_init_array():
     assert r.value == 3
 
 
+def test_interpret_init_array_implicit_len_shared_type():
+    state = parse("""
+    int f() {
+        int a[] = {1, 2, 3};
+        return sizeof(a);
+    }
+    int g() {
+        int b[] = {1, 2, 3, 4, 5};
+        return sizeof(b);
+    }
+    """)
+    # Give both the same (interned) incomplete array type, which must not be modified.
+    t = CArrayType(arrayOf=CBuiltinType(("int",)), arrayLen=None)
+    state.funcs["f"].body.contentlist[0].type = state.funcs["g"].body.contentlist[0].type = t
+    interpreter = Interpreter()
+    interpreter.register(state)
+    assert interpreter.runFunc("f").value == 3 * ctypes.sizeof(ctypes.c_int)
+    assert interpreter.runFunc("g").value == 5 * ctypes.sizeof(ctypes.c_int)
+    assert not t.arrayLen
+
+
 def test_interpret_init_array_sizeof():
     state = parse("""
     int f() {
@@ -2814,6 +2835,20 @@ def test_interpret_offsetof():
     assert r.value == ctypes.sizeof(ctypes.c_long)
 
 
+def test_interpret_offsetof_unnamed_bitfield():
+    state = parse("""
+    struct s { int a; int :4; int b; };
+    #define offsetof(type, member) ( (int) & ((type*)0) -> member )
+    int f() {
+        return offsetof(struct s, b);
+    }
+    """)
+    interpreter = Interpreter()
+    interpreter.register(state)
+    r = interpreter.runFunc("f")
+    assert r.value == 2 * ctypes.sizeof(ctypes.c_int)
+
+
 def test_interpret_offsetof_substruct():
     state = parse("""
     typedef int PyObject;
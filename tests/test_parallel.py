@@ -0,0 +1,90 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import cparser.parallel as parallel
+from cparser.interpreter import Interpreter
+import os
+import shutil
+import tempfile
+
+
+_files = {
+    "common.h": (
+        "#ifndef COMMON_H\n#define COMMON_H\ntypedef struct { int x, y; } point;\n"
+        "int bfunc(point* p);\n#endif\n"),
+    "a.c": (
+        '#include "common.h"\nstatic int helper(int v) { return v + 1; }\n'
+        "int afunc() { point p; p.x = 2; p.y = 3; return helper(bfunc(&p)) + OFFSET; }\n"),
+    "b.c": (
+        '#include "common.h"\nstatic int helper_b(int v) { return v * 10; }\n'
+        "int bfunc(point* p) { return helper_b(p->x + p->y); }\n"),
+    "c.c": "static int helper(int v) { return v; }\nint cfunc() { return helper(5); }\n#define OFFSET 1\n",
+    "h.h": "typedef int myint;\nstruct pair { myint a, b; };\nint sum(struct pair* p);\nstatic int twice(int v);\n",
+    "d.c": (
+        "static int twice(int v) { return v * 2; }\n"
+        "int sum(struct pair* p) { myint s = p->a + p->b; return twice(s); }\n"),
+    "e.c": "int efunc() { struct pair p; p.a = 4; p.b = 5; return sum(&p); }\n",
+}
+
+
+def test_parallel_parse():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    try:
+        for fn, content in _files.items():
+            with open(os.path.join(d, fn), "w") as f:
+                f.write(content)
+        filenames = [os.path.join(d, fn) for fn in ["a.c", "b.c"]]
+        for processes in [0, 2]:
+            state = State()
+            state.autoSetupSystemMacros()
+            state.macros["OFFSET"] = Macro(rightside="100")
+            state, conflicts = parallel.parse(filenames, state, processes=processes)
+            assert not state._errors, state._errors
+            assert not conflicts, conflicts
+            assert set(state.funcs.keys()) == {"helper", "helper_b", "afunc", "bfunc"}
+            assert state.funcs["bfunc"].body is not None  # the definition, not the declaration
+            interpreter = Interpreter()
+            interpreter.register(state)
+            assert interpreter.runFunc("afunc", return_as_ctype=False) == 151
+
+        states = parallel.parseFiles(filenames + [os.path.join(d, "c.c")], processes=2)
+        assert [sorted(s.funcs.keys()) for s in states] == [
+            ["afunc", "bfunc", "helper"], ["bfunc", "helper_b"], ["cfunc", "helper"]]
+        assert "OFFSET" not in states[0].macros  # independent translation units
+        state, conflicts = parallel.mergeStates(states)
+        assert not conflicts, conflicts
+        # Both static helper funcs are kept. The second one gets a new name.
+        assert state.funcs["helper"] is states[0].funcs["helper"]
+        assert state.funcs["helper__static1"] is states[2].funcs["helper"]
+        assert state.macros["OFFSET"] is states[2].macros["OFFSET"]
+        assert len(state.contentlist) == sum([len(s.contentlist) for s in states])
+        interpreter = Interpreter()
+        interpreter.register(state)
+        assert interpreter.runFunc("cfunc", return_as_ctype=False) == 5
+
+        # The declarations from the headers parsed into the base State are seen by all files.
+        for processes in [0, 2]:
+            state = State()
+            state.autoSetupSystemMacros()
+            cparser.parse(os.path.join(d, "h.h"), state)
+            state, conflicts = parallel.parse([os.path.join(d, fn) for fn in ["d.c", "e.c"]], state, processes=processes)
+            assert not state._errors, state._errors
+            assert not conflicts, conflicts
+            assert state.funcs["sum"].body is not None
+            assert state.funcs["efunc"].body is not None
+            # The static declaration from the header is replaced by its definition, not renamed.
+            assert state.funcs["twice"].body is not None
+            assert "twice__static1" not in state.funcs
+            interpreter = Interpreter()
+            interpreter.register(state)
+            assert interpreter.runFunc("efunc", return_as_ctype=False) == 18
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main(globals())
@@ -4,6 +4,7 @@ from __future__ import print_function
 import helpers_test  # side effect: make cparser importable
 from cparser import *
 from helpers_test import *
+import cparser
 
 
 def test_parse_void_func():
@@ -48,5 +49,55 @@ def test_parse_void_func_self_call():
     assert isinstance(f, CFunc)
 
 
+def test_parse_func_body_mode():
+    from cparser.interpreter import Interpreter
+    code = "int g;\nint f(int x) {\n  int y = x * 2;\n  return y + g; }\nint h(void) { return 1; }\n"
+    eager = parse(code)
+    for useTokenArray in [False, True]:
+        state = cparser.State()
+        state.UseTokenArray = useTokenArray
+        state.FuncBodyMode = "tokens"
+        cparser.parse_code(code, state)
+        assert not state._errors, state._errors
+        f = state.funcs["f"]
+        assert isinstance(f.body, CFuncBodyTokens)
+        assert len(f.body.tokens) == 13  # including the closing bracket
+        assert f.defPos == eager.funcs["f"].defPos
+        body = f.parseBody()
+        assert body is f.body and isinstance(body, CBody)
+        assert not state._errors, state._errors
+        assert repr(body) == repr(eager.funcs["f"].body)
+        assert body.contentlist[0].defPos == eager.funcs["f"].body.contentlist[0].defPos
+        assert isinstance(state.funcs["h"].body, CFuncBodyTokens)
+        interpreter = Interpreter()
+        interpreter.register(state)
+        assert interpreter.runFunc("h", return_as_ctype=False) == 1
+        assert isinstance(state.funcs["h"].body, CBody)
+
+    # The body is parsed on the first access of a CBody attrib.
+    state = cparser.State()
+    state.FuncBodyMode = "tokens"
+    cparser.parse_code(code, state)
+    f = state.funcs["f"]
+    lazyBody = f.body
+    assert "CFunc 'f'" in str(f) and f and lazyBody  # does not parse
+    assert isinstance(f.body, CFuncBodyTokens)
+    assert [c.name for c in lazyBody.contentlist] == ["y", None]
+    assert isinstance(f.body, CBody)
+    assert lazyBody.contentlist is f.body.contentlist
+    assert "y" in lazyBody.vars
+    assert repr(f.body) == repr(eager.funcs["f"].body)
+    assert not state._errors, state._errors
+
+    state = cparser.State()
+    state.FuncBodyMode = "skip"
+    cparser.parse_code(code, state)
+    assert not state._errors, state._errors
+    assert state.funcs["f"].body.isSkipped()
+    assert state.funcs["f"].parseBody() is None
+    assert len(state._errors) == 1
+    assert not hasattr(state.funcs["f"].body, "contentlist")
+
+
 if __name__ == "__main__":
     main(globals())
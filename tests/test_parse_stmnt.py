@@ -298,5 +298,152 @@ def test_parse_const_func_ptr():
     assert "const" in v.type.attribs
 
 
+def test_token_array():
+    from cparser.cparser import _cpre3_parse_skipbracketcontent
+    state = State()
+    tokens = CTokenArray(cpre2_parse(state, "f(a, (b), {c}); g;"))
+    assert len(tokens) == 15
+    assert tokens.matching[1] == 11 and tokens.matching[11] == 1
+    assert tokens.matching[4] == 6 and tokens.matching[8] == 10
+    assert next(tokens) == CIdentifier("f")
+    assert next(tokens) == COpeningBracket("(")
+    assert tokens.peek() == CIdentifier("a")
+    _cpre3_parse_skipbracketcontent(state, 0, tokens)
+    assert tokens.pos == 12
+    assert [t for t in tokens] == [CSemicolon(), CIdentifier("g"), CSemicolon()]
+    assert not state._errors, state._errors
+
+
+def test_parse_token_array():
+    code = "typedef int T;\nint f(int a(b, (c)), T d);\nstruct S { T x; };\nint g(T x) {\n return x + 1; }\n"
+    results = []
+    for useTokenArray in [False, True]:
+        state = State()
+        state.UseTokenArray = useTokenArray
+        cparser.parse_code(code, state)
+        results.append((
+            state._errors, sorted([(k, repr(v), v.defPos) for (k, v) in state.funcs.items()]),
+            state.structs["S"].defPos, repr(state.funcs["g"].body)))
+    assert len(results[0][0]) == 1  # the unexpected '(' in the args of f
+    assert results[0] == results[1]
+
+
+def test_node_shared_defaults():
+    import pickle
+    state = parse("int x;\nstatic int f(int a) { x = a; return x; }\n")
+    x, f = state.vars["x"], state.funcs["f"]
+    assert x.attribs is x.args is f.body.contentlist[0].args  # shared empty default
+    assert x.attribs == [] and not x.args
+    assert f.attribs == ["static"] and len(f.args) == 1
+    try:
+        x.args.append(1)
+    except TypeError as e:
+        print("expected error:", e)
+    else:
+        assert False, "expected TypeError"
+    assert x.args == []
+    x.args += [1]
+    assert x.args == [1] and x.attribs == []
+    assert not hasattr(x, "bitsize")
+    f2 = pickle.loads(pickle.dumps(f, pickle.HIGHEST_PROTOCOL))
+    assert f2.body.contentlist[0].args is x.attribs
+    assert repr(f2) == repr(f) and f2.defPos == f.defPos
+
+
+def test_ctype_cache():
+    state = parse("struct S;\ntypedef struct S* P;\ntypedef int I;\n")
+    P, I = state.typedefs["P"], state.typedefs["I"]
+    assert cparser.getCType(I, state) is ctypes.c_int
+    assert len(state._ctype_cache) > 0
+    ptr_t = cparser.getCType(P, state)
+    assert ptr_t is ctypes.c_void_p  # incomplete struct, falls back to void-ptr
+    assert len(state._errors) == 1
+    state._errors[:] = []
+    assert cparser.getCType(P, state) is ptr_t  # cached, no new error
+    assert not state._errors
+    cparser.parse_code("struct S { int a; };\n", state)  # invalidates the cache
+    ptr_t = cparser.getCType(P, state)
+    assert ptr_t is not ctypes.c_void_p and ptr_t._type_ is state.structs["S"]._ctype
+    assert cparser.getCType(P, state) is ptr_t
+    assert cparser.getCType(cparser.CPointerType(state.structs["S"]), state) is ptr_t
+    assert not state._errors
+
+
+def test_type_interning():
+    import pickle
+    state = parse("int* a;\nint *b;\nchar c[4];\n")
+    a, b = state.vars["a"].type, state.vars["b"].type
+    assert a is b is CPointerType(CBuiltinType(("int",)))
+    assert state.vars["c"].type.arrayOf is CBuiltinType(("char",))
+    c = CArrayType(arrayOf=CBuiltinType(("char",)), arrayLen=CNumber(4))
+    assert c is CArrayType(CBuiltinType(("char",)), CNumber(4))
+    assert c is not CArrayType(CBuiltinType(("char",)), CNumber(5))
+    assert CVoidType() is CVoidType()
+    assert pickle.loads(pickle.dumps(a, pickle.HIGHEST_PROTOCOL)) is a
+    assert isSameType(state, a, b)
+    assert getCommonValueType(state, a, b) is a
+    # Objects which are not interned (e.g. loaded from a snapshot) still compare equal.
+    a2 = CPointerType.__new__(CPointerType)
+    a2.__dict__.update(a.__dict__)
+    assert a2 is not a and a2 == a and hash(a2) == hash(a)
+    assert isSameType(state, a, a2)
+    assert "_hash" not in a.__dict__  # the cached hash is not compared
+
+
+def test_struct_layout():
+    state = parse("struct S { char c; int i; unsigned int b1:3, b2:5; struct S* next; };\n"
+                  "typedef union { int x; double y; } U;\n")
+    s = state.structs["S"]
+    assert s.findAttrib(state, "i") is s.body.contentlist[1]
+    assert s.findAttrib(state, "nope") is None
+    layout = s.getLayout(state)
+    assert layout is s.getLayout(state)
+    assert layout.ctype is getCType(s, state) and layout.size == ctypes.sizeof(layout.ctype)
+    assert sorted(layout.fields.keys()) == ["b1", "b2", "c", "i", "next"]
+    assert layout.fields["i"].offset == layout.ctype.i.offset == ctypes.sizeof(ctypes.c_int)
+    assert layout.fields["i"].decl is s.findAttrib(state, "i")
+    assert (layout.fields["b1"].bitoffset, layout.fields["b1"].bitsize) == (0, 3)
+    assert (layout.fields["b2"].bitoffset, layout.fields["b2"].bitsize) == (3, 5)
+    assert layout.fields["b1"].offset == layout.fields["b2"].offset
+    assert isPointerType(layout.fields["next"].decl.type)
+    u = state.typedefs["U"].type
+    assert u.getLayout(state).fields["y"].offset == 0
+    assert u.getLayout(state).size == ctypes.sizeof(ctypes.c_double)
+    # The pre-declaration resolves to the real struct.
+    assert CStruct(name="S").getLayout(state) is layout
+    # Unnamed bitfields are only padding.
+    state = parse("struct P { int a; int :4; int b; };\n")
+    layout = state.structs["P"].getLayout(state)
+    assert sorted(layout.fields.keys()) == ["a", "b"]
+    assert layout.fields["b"].offset == layout.ctype.b.offset
+
+
+def test_scoped_symbols():
+    state = parse("""
+    typedef int T;
+    struct S { int a; };
+    int f(int n) {
+        T x = n;
+        { typedef char U; U x = 1; { U z = x; n = z; } }
+        { struct S s; s.a = x + n; }
+        return x;
+    }
+    """)
+    scopes = state._cpre3_scopes
+    assert not scopes.levels and not scopes.globalLevels and not scopes.names  # all popped again
+    body = state.funcs["f"].body
+    outer_x = body.contentlist[0]
+    block1, block2 = body.contentlist[1:3]
+    inner_x = block1.body.vars["x"]
+    assert inner_x is not outer_x and inner_x.type is block1.body.typedefs["U"]
+    z_stmnt = block1.body.contentlist[-1].body.contentlist[-1]
+    assert z_stmnt._rightexpr is block1.body.contentlist[-1].body.vars["z"]
+    assert block1.body.contentlist[-1].body.vars["z"].body._leftexpr is inner_x
+    s = block2.body.vars["s"]
+    assert s.type is state.structs["S"]
+    assert block2.body.contentlist[-1]._rightexpr._leftexpr is outer_x
+    assert block2.body.contentlist[-1]._rightexpr._rightexpr is state.funcs["f"].args[0]
+
+
 if __name__ == "__main__":
     main(globals())
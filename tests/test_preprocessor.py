@@ -0,0 +1,222 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import os
+import shutil
+import tempfile
+
+
+def _write_files(files):
+    """
+    :param dict[str,str] files: filename -> content
+    :return: temp dir
+    :rtype: str
+    """
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    for fn, content in files.items():
+        with open(os.path.join(d, fn), "w") as f:
+            f.write(content)
+    return d
+
+
+def test_local_include_small_blocks():
+    d = _write_files({
+        "main.c": '#include "defs.h"\nint f(int x) { return x + DEFS_OFFSET; }\n',
+        "defs.h": '/* comment */\n#define DEFS_OFFSET 42\nint g;\t// tab\n'})
+    try:
+        state = State()
+        state.ReadBlockSize = 3  # tokens and comments get split across blocks
+        cparser.parse(os.path.join(d, "main.c"), state)
+        assert not state._errors, state._errors
+        assert set(state.funcs.keys()) == {"f"}
+        assert set(state.vars.keys()) == {"g"}
+        assert state.macros["DEFS_OFFSET"].rightside == "42"
+        assert state.macros["DEFS_OFFSET"].defPos == "defs.h:2:22"
+    finally:
+        shutil.rmtree(d)
+
+
+def test_preprocess_line_positions():
+    state = State()
+    tokens = list(cpre2_parse(state, state.preprocess_source_code(
+        "/* multi-line\n comment */ int a = __LINE__;\n\t\"str /* no comment */\" // c\nint b = __LINE__;\n")))
+    assert not state._errors, state._errors
+    numbers = [t.content for t in tokens if isinstance(t, CNumber)]
+    assert numbers == [2, 4]
+    assert CStr("str /* no comment */") in tokens
+
+    # A token gets the position of the char after it, or of itself if it is a single char.
+    state = State()
+    positions = [state.curPosAsStr() for t in cpre2_parse(state, state.preprocess_source_code("x =\ty+1;\n"))]
+    assert positions == ["<input>:1:1", "<input>:1:3", "<input>:1:5", "<input>:1:6", "<input>:1:7", "<input>:1:7"]
+
+    state = parse("int a; int b;\nstruct S { int x; };  int f(int y) { return y; }\n")
+    assert not state._errors, state._errors
+    assert state.vars["a"].defPos == "<input>:1:5"
+    assert state.vars["b"].defPos == "<input>:1:12"
+    assert state.structs["S"].defPos == "<input>:2:6"
+    assert state.funcs["f"].defPos == "<input>:2:27"
+
+
+def test_preprocess_char_chunks_same_as_str():
+    src = '#define X(a) a\nint x = X(1); /* c\nc */ char *s = "a\\"b";\n\tchar c = \'\\\'\';\n'
+    state1 = State()
+    out1 = "".join(state1.preprocess(src, None, "<input>"))
+    state2 = State()
+    out2 = "".join(state2.preprocess(iter(list(src)), None, "<input>"))
+    assert out1 == out2
+    assert out1 == 'int x = X(1);  char *s = "a\\"b";\n\tchar c = \'\\\'\';\n\n'
+    assert state1.macros["X"].defPos == state2.macros["X"].defPos == "<input>:1:14"
+
+
+def test_cpre2_chunk_boundaries():
+    src = 'int foo = FOO(1, "a b"); char c = \'x\'; long l = 123L;\n'
+    state = State()
+    state.macros["FOO"] = Macro(state, "FOO", ("x", "y"), "x + sizeof(y)")
+    tokens = list(cpre2_parse(state, src))
+    for chunkSize in [1, 2, 3, 5]:
+        chunks = [src[i:i + chunkSize] for i in range(0, len(src), chunkSize)]
+        assert list(cpre2_parse(state, chunks)) == tokens
+    assert not state._errors, state._errors
+    assert CIdentifier("foo") in tokens
+    assert CIdentifier("FOO") not in tokens
+    assert CStr("a b") in tokens
+    assert CNumber(123) in tokens
+
+
+def test_cpre2_bracket_level():
+    state = State()
+    tokens = list(cpre2_parse(state, "f(a[1], {b}); a;"))
+    assert not state._errors, state._errors
+    assert [(t.content, t.level) for t in tokens if isinstance(t, (COpeningBracket, CClosingBracket))] == [
+        ("(", 0), ("[", 1), ("]", 1), ("{", 1), ("}", 1), (")", 0)]
+    assert not hasattr(tokens[0], "__dict__")
+    assert tokens[2].content is tokens[-2].content  # interned
+
+
+def test_cpre2_shared_tokens():
+    state = State()
+    tokens = list(cpre2_parse(state, "int a = b + 1; int b = a + 2;"))
+    assert not state._errors, state._errors
+    assert tokens[0] is tokens[7] is state._tokens["int"]  # keyword
+    assert tokens[1] is tokens[10]  # identifier
+    assert tokens[4] is tokens[11]  # op
+    assert tokens[1] != tokens[8] and tokens[1] == CIdentifier("a")
+    assert list(cpre2_parse(state, "int a;"))[0] is tokens[0]
+
+
+def test_cpre2_macro_blacklist():
+    state = State()
+    tokens = list(cpre2_parse(state, state.preprocess_source_code(
+        "#define f(x) f(x + 1)\n#define g f(g)\n#define h(x) x x\nf(2); g; h(h(a));\n")))
+    assert not state._errors, state._errors
+    assert " ".join([t.asCCode() for t in tokens]) == "f ( 2 + 1 ) ; f ( f ( g ) + 1 ) ; a a a a ;"
+
+
+def test_macro_template():
+    state = State()
+    tokens = list(cpre2_parse(state, state.preprocess_source_code(
+        "#define CAT(a, b) a ## b\n#define STR(x) #x\n#define CALL(f, x) f(x, #x)\n"
+        "CAT(foo, bar); STR(hello); CALL(g, 1 + 2); CAT(x , STR(y));\n")))
+    assert not state._errors, state._errors
+    assert " ".join([t.asCCode() for t in tokens]) == (
+        'foobar ; "hello" ; g ( 1 + 2 , "1 + 2" ) ; x "y" ;')
+    macro = state.macros["CALL"]
+    assert macro.eval(state, ["h", "z"]) == ' h(z, "z")'
+    template = macro._template[2]
+    assert template.parts[1:4] == [(template.Arg, 0), (template.Literal, "("), (template.Arg, 1)]
+
+
+def test_include_guard():
+    d = _write_files({
+        "main.c": "".join(['#include "%s"\n#include "%s"\n' % (fn, fn) for fn in [
+            "guard.h", "guard2.h", "once.h", "noguard.h", "noguard2.h"]]) + "int x;\n",
+        "guard.h": "// comment\n#ifndef GUARD_H\n#define GUARD_H\nint a;\n#endif /* GUARD_H */\n\n",
+        "guard2.h": "#if !defined(GUARD2_H)\n#define GUARD2_H\n#if 0\n#else\n#endif\nint b;\n#endif\n",
+        "once.h": "#pragma once\nint c;\n",
+        "noguard.h": "#ifndef NOGUARD_H\n#define NOGUARD_H\n#endif\nint d;\n",
+        "noguard2.h": "#ifndef NOGUARD2_H\nint e;\n#else\nint f;\n#endif\n"})
+    try:
+        state = State()
+        reads = []
+        def readLocalInclude(filename):
+            reads.append(filename)
+            return State.readLocalInclude(state, filename)
+        state.readLocalInclude = readLocalInclude
+        cparser.parse(os.path.join(d, "main.c"), state)
+        assert reads.count("guard.h") == 1
+        assert reads.count("guard2.h") == 1
+        assert reads.count("once.h") == 1
+        assert reads.count("noguard.h") == 2
+        assert reads.count("noguard2.h") == 2
+        assert sorted(state._include_guards.values()) == ["GUARD2_H", "GUARD_H"]
+        assert set(state.vars.keys()) == {"a", "b", "c", "d", "e", "x"}
+    finally:
+        shutil.rmtree(d)
+
+
+def test_preprocess_cond():
+    state = State()
+    state.macros["VER"] = Macro(rightside="0x0300")
+    state.macros["MAX"] = Macro(args=("a", "b"), rightside="((a) > (b) ? (a) : (b))")
+    state.macros["EMPTY"] = Macro(rightside="")
+    for cond, value in [
+            ("VER >= 0x0300 && defined(VER)", True), ("defined VER && !defined(NOPE)", True),
+            ("MAX(2, VER) == VER", True), ("1 + 2 * 3 == 7", True), ("10 - 2 - 3", 5), ("-1 < 0", True),
+            ("'A' == 65", True), ("NOPE", 0), ("EMPTY", 0), ("0 && NOPE(1)", 0), ("1 || NOPE(1)", 1),
+            ("1 ? 2 : 3", 2), ("010 + 1UL", 9), ("~0", -1),
+            ("-7 / 2 == -3", True), ("7 / -2", -3), ("-7 % 2", -1), ("7 % -2", 1), ("-8 / 2", -4)]:
+        assert cpreprocess_evaluate_cond(state, cond) == value, cond
+    assert not state._errors, state._errors
+    for cond in ["NOPE(1)", "1 +", "(1", "1 / 0", "a = 1"]:
+        assert cpreprocess_evaluate_cond(state, cond) is None, cond
+        assert len(state._errors) == 1, (cond, state._errors)
+        state._errors[:] = []
+
+
+def test_preprocess_cond_cache():
+    state = State()
+    tokens = list(cpre2_parse(state, state.preprocess_source_code(
+        "#define A 1\n#if A + 1 == 2\nint a;\n#endif\n#undef A\n#define A 2\n#if A + 1 == 2\nint b;\n#endif\n"
+        "#if A + 1 == 2\nint c;\n#endif\n")))
+    assert not state._errors, state._errors
+    assert [t.content for t in tokens if isinstance(t, CIdentifier)] == ["int", "a"]
+    assert set(state._preprocess_cond_trees.keys()) == {"A + 1 == 2", "1", "2"}
+    value, deps = state._preprocess_cond_results["A + 1 == 2"]
+    assert value is False
+    assert deps == [("A", state.macros["A"])]
+
+
+def test_preprocess_skip_disabled():
+    src = (
+        "#if 0\n/* #endif */\n// #endif\nx = \"/*\"; don't\n#if 1\nint no1;\n#else\nint no2;\n#endif\n"
+        "  #  endif\nint a = __LINE__;\n"
+        "#ifdef NOPE\n#elif 1\nint b;\n#else\nint no3;\n#endif\n")
+    outs = []
+    for input in [src, iter(list(src))]:
+        state = State()
+        tokens = list(cpre2_parse(state, state.preprocess_source_code(input)))
+        assert not state._errors, state._errors
+        assert state._preprocessInactiveDepth == 0
+        outs.append([t.content for t in tokens if isinstance(t, (CIdentifier, CNumber))])
+    assert outs[0] == outs[1] == ["int", "a", 11, "int", "b"]
+
+
+def test_preprocess_skip_disabled_chunks():
+    # Comments and literals in a disabled region can be split across the input chunks.
+    src = (
+        "#if 0\n/*\n#endif\n*/\nint no;\n#endif\n"
+        "#if 0\nx = \"a /* b\";\n#endif\nint yes;\n")
+    for k in range(len(src) + 1):
+        state = State()
+        tokens = list(cpre2_parse(state, cpreprocess_parse(state, [src[:k], src[k:]])))
+        assert not state._errors, (k, state._errors)
+        assert [t.content for t in tokens if isinstance(t, CIdentifier)] == ["int", "yes"], k
+
+
+if __name__ == "__main__":
+    main(globals())
@@ -0,0 +1,189 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from helpers_test import *
+import cparser
+import cparser.snapshot as snapshot
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+_src = """
+#define MAX(a, b) ((a) > (b) ? (a) : (b))
+typedef unsigned int uint;
+typedef struct node { struct node* next; uint value; } node_t;
+enum color { RED, GREEN = 5, BLUE };
+uint counter = 3;
+int get(node_t* n) { return n ? (int) MAX(n->value, 1) : BLUE; }
+int proto(const char* s, ...);
+"""
+
+
+def test_snapshot_roundtrip():
+    state = parse(_src)
+    data = snapshot.dumps(state, meta={"name": "test"})
+    state2, meta = snapshot.loads(data, withMeta=True)
+    assert meta == {"name": "test"}
+    for attrib in snapshot.LazyDictAttribs:
+        assert_equal(sorted(getattr(state2, attrib).keys()), sorted(getattr(state, attrib).keys()))
+        assert_equal(repr(getattr(state2, attrib)), repr(getattr(state, attrib)))
+    assert_equal(repr(state2.contentlist), repr(state.contentlist))
+    assert state2.macros["MAX"].eval(state2, ["x", "y"]) == state.macros["MAX"].eval(state, ["x", "y"])
+    assert state2.enumconsts["BLUE"].value == 6
+    # Object identity is preserved, e.g. the struct is the same object in both dicts.
+    node = state2.typedefs["node_t"].type
+    assert node is state2.structs["node"]
+    assert node.body.contentlist[1].type.pointerOf.name == "node"
+    assert state2.vars["counter"].type is state2.typedefs["uint"]
+    # Parent links to the (top-level) state refer to the state we loaded into.
+    assert state2.funcs["get"].parent.body is state2
+    assert getConstValue(state2, state2.vars["counter"].body) == 3
+
+
+def test_snapshot_lazy():
+    state = parse(_src)
+    state2 = snapshot.loads(snapshot.dumps(state))
+    funcs = state2.funcs
+    assert isinstance(funcs, snapshot.LazyDict)
+    assert len(funcs) == 2
+    assert set(funcs._lazy.keys()) == {"get", "proto"}
+    assert "get" in funcs
+    assert len(funcs._lazy) == 2  # `in` does not load
+    f = funcs["get"]
+    assert isinstance(f, CFunc)
+    assert set(funcs._lazy.keys()) == {"proto"}
+    assert funcs["get"] is f
+    state2.funcs["new"] = None
+    assert len(funcs) == 3
+    assert isinstance(state2.contentlist, snapshot.LazyList)
+    assert len(state2.contentlist) == len(state.contentlist)
+    assert state2.contentlist[-1] is funcs["proto"]
+    assert not funcs._lazy
+
+
+def test_snapshot_load_into_state():
+    state = parse(_src)
+    data = snapshot.dumps(state)
+    state2 = State()
+    state2.macros["OTHER"] = Macro(rightside="1")
+    state2.macros["MAX"] = Macro(rightside="0")
+    snapshot.loads(data, state2)
+    assert state2.macros["OTHER"].rightside == "1"
+    assert state2.macros["MAX"].args == ["a", "b"]  # the snapshot overrides
+
+
+def test_snapshot_external():
+    state = State()
+    state.autoSetupGlobalIncludeWrappers()
+    cparser.parse_code("#include <stdio.h>\nint main() { printf(\"%d\", 1); return 0; }\n", state)
+    assert not state._errors, state._errors
+    data = snapshot.dumps(state)
+    state2 = State()
+    state2.autoSetupGlobalIncludeWrappers()
+    snapshot.loads(data, state2)
+    assert state2._global_include_list == state._global_include_list
+    assert isinstance(state2.funcs["printf"], CWrapValue)
+    assert repr(state2.funcs["main"]) == repr(state.funcs["main"])
+    # Without the global include wrappers, we cannot resolve the external refs.
+    try:
+        snapshot.loads(data).funcs["main"].body.contentlist
+    except snapshot.SnapshotError as e:
+        print("expected error:", e)
+    else:
+        assert False, "expected SnapshotError"
+
+
+def test_snapshot_types_from_other_process():
+    # The hash of a type is not the same in another process, so the types get interned again.
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    try:
+        fn = os.path.join(d, "types.snap")
+        code = (
+            "import helpers_test, cparser.snapshot as snapshot\n"
+            "snapshot.save(helpers_test.parse('int **p; struct S { int x; }; struct S *q;'), %r)\n" % fn)
+        subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        state = snapshot.load(fn)
+        t = state.vars["p"].type
+        u = CPointerType(CPointerType(CBuiltinType(("int",))))
+        assert t is u
+        assert len({t, u}) == 1
+        assert state.vars["q"].type is CPointerType(state.structs["S"])
+    finally:
+        shutil.rmtree(d)
+
+
+def test_snapshot_bad_data():
+    data = snapshot.dumps(parse("int x;"))
+    for bad in [b"", b"foo", data[:len(snapshot.Magic)] + b"\xff" + data[len(snapshot.Magic) + 1:]]:
+        try:
+            snapshot.loads(bad)
+        except snapshot.SnapshotError as e:
+            print("expected error:", e)
+        else:
+            assert False, "expected SnapshotError for %r" % bad[:30]
+
+
+def test_snapshot_bundle():
+    d = tempfile.mkdtemp(prefix="cparser-test-")
+    try:
+        with open(os.path.join(d, "a.h"), "w") as f:
+            f.write('#include "b.h"\n#ifdef WITH_C\nint c(void);\n#endif\nint a(myint x);\n')
+        with open(os.path.join(d, "b.h"), "w") as f:
+            f.write("typedef int myint;\n")
+        bundle = os.path.join(d, "a.snap")
+        state, info = snapshot.buildBundle([os.path.join(d, "a.h")], bundle, macros={"WITH_C": "1"})
+        assert not state._errors, state._errors
+        assert [os.path.basename(fn) for (fn, _, _) in info["files"]] == ["a.h", "b.h"]
+        assert snapshot.bundleInfo(bundle) == info
+
+        # The bundle was built with other macros.
+        state2 = State()
+        try:
+            state2.loadSnapshotBundle(bundle)
+        except snapshot.BundleOutdated as e:
+            print("expected error:", e)
+        else:
+            assert False, "expected BundleOutdated"
+
+        state2 = State()
+        state2.autoSetupSystemMacros()
+        state2.macros["WITH_C"] = Macro(state2, "WITH_C", None, "1")
+        state2.loadSnapshotBundle(bundle)
+        assert set(state2.funcs.keys()) == {"a", "c"}
+        assert state2.funcs["a"].args[0].type is state2.typedefs["myint"]
+        assert snapshot.checkBundle(info, macros=state2.macros) is None
+        assert snapshot.checkBundle(info, macros={}) == "different macro configuration"
+
+        # Touching a file without changing it is fine.
+        mtime = os.path.getmtime(os.path.join(d, "b.h"))
+        os.utime(os.path.join(d, "b.h"), (mtime + 10, mtime + 10))
+        snapshot.loadBundle(bundle)
+        with open(os.path.join(d, "b.h"), "w") as f:
+            f.write("typedef long myint;\n")
+        try:
+            snapshot.loadBundle(bundle)
+        except snapshot.BundleOutdated as e:
+            print("expected error:", e)
+        else:
+            assert False, "expected BundleOutdated"
+        assert "myint" in snapshot.loadBundle(bundle, validate=False).typedefs
+        assert snapshot.main(["info", bundle]) == 1
+
+        assert snapshot.main(["build", "-o", bundle, "-D", "WITH_C", "-D", "EMPTY=", os.path.join(d, "a.h")]) == 0
+        assert snapshot.main(["info", bundle]) == 0
+        info = snapshot.bundleInfo(bundle)
+        assert ("WITH_C", None, "1") in info["macros"]
+        assert ("EMPTY", None, "") in info["macros"]
+        assert str(snapshot.loadBundle(bundle).typedefs["myint"].type) == str(CBuiltinType(("long",)))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main(globals())